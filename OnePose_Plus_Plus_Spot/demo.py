@@ -6,15 +6,17 @@ import os
 os.environ["TORCH_USE_RTLD_GLOBAL"] = "TRUE"  # important for DeepLM module, this line should before import torch
 import os.path as osp
 import glob
+import json
 import numpy as np
 import natsort
+import cv2
 import torch
 
 from src.utils import data_utils
 from src.utils import vis_utils
-from src.utils.metric_utils import ransac_PnP
-from src.datasets.OnePosePlus_inference_dataset import OnePosePlusInferenceDataset
 from src.inference.inference_OnePosePlus import build_model
+from src.utils.model_io import resolve_device
+from src.inference.pose_tracking_session import PoseTrackingSession
 from src.local_feature_object_detector.local_feature_2D_detector import LocalFeatureObjectDetector
 
 def get_default_paths(cfg, data_root, data_dir, sfm_model_dir):
@@ -64,74 +66,50 @@ def get_default_paths(cfg, data_root, data_dir, sfm_model_dir):
     }
     return img_lists, paths
 
-def inference_core(cfg, data_root, seq_dir, sfm_model_dir):
-    img_list, paths = get_default_paths(cfg, data_root, seq_dir, sfm_model_dir)
-    dataset = OnePosePlusInferenceDataset(
-        paths['sfm_dir'],
-        img_list,
-        load_3d_coarse=cfg.datamodule.load_3d_coarse,
-        shape3d=cfg.datamodule.shape3d_val,
-        img_pad=cfg.datamodule.img_pad,
-        img_resize=None,
-        df=cfg.datamodule.df,
-        pad=cfg.datamodule.pad3D,
-        load_pose_gt=False,
-        n_images=None,
-        demo_mode=True,
-        preload=True,
-    )
+def build_session(cfg, paths, output_results=True):
+    device = resolve_device(cfg.get("device", "cuda"))
+    num_threads = cfg.get("cpu_num_threads", None)
+    logger.info(f"Inference device: {device}")
 
     # NOTE: if you find pose estimation results are not good, problem maybe due to the poor object detection at the very beginning of the sequence.
     # You can set `output_results=True`, the detection results will thus be saved in the `detector_vis` directory in folder of the test sequence.
     local_feature_obj_detector = LocalFeatureObjectDetector(
         sfm_ws_dir=paths["sfm_ws_dir"],
-        output_results=True, 
+        output_results=output_results,
         detect_save_dir=paths["vis_detector_dir"],
+        device=device,
+        num_threads=num_threads,
+        **cfg.get("detector", {}),
     )
     match_2D_3D_model = build_model(cfg['model']["OnePosePlus"], cfg['model']['pretrained_ckpt'])
-    match_2D_3D_model.cuda()
 
     K, _ = data_utils.get_K(paths["intrin_full_path"])
 
     bbox3d = np.loadtxt(paths["bbox3d_path"])
-    pred_poses = {}  # {id:[pred_pose, inliers]}
-    for id in tqdm(range(len(dataset))):
-        data = dataset[id]
-        query_image = data['query_image']
-        query_image_path = data['query_image_path']
-
-        # Detect object:
-        if id == 0:
-            # Detect object by 2D local feature matching for the first frame:
-            bbox, inp_crop, K_crop = local_feature_obj_detector.detect(query_image, query_image_path, K)
-        else:
-            # Use 3D bbox and previous frame's pose to yield current frame 2D bbox:
-            previous_frame_pose, inliers = pred_poses[id - 1]
-
-            if len(inliers) < 20:
-                # Consider previous pose estimation failed, reuse local feature object detector:
-                bbox, inp_crop, K_crop = local_feature_obj_detector.detect(
-                    query_image, query_image_path, K
-                )
-            else:
-                (
-                    bbox,
-                    inp_crop,
-                    K_crop,
-                ) = local_feature_obj_detector.previous_pose_detect(
-                    query_image_path, K, previous_frame_pose, bbox3d
-                )
-        
-        data.update({"query_image": inp_crop.cuda()})
-
-        # Perform keypoint-free 2D-3D matching and then estimate object pose of query image by PnP:
-        with torch.no_grad():
-            match_2D_3D_model(data)
-        mkpts_3d = data["mkpts_3d_db"].cpu().numpy() # N*3
-        mkpts_query = data["mkpts_query_f"].cpu().numpy() # N*2
-        pose_pred, _, inliers, _ = ransac_PnP(K_crop, mkpts_query, mkpts_3d, scale=1000, pnp_reprojection_error=7, img_hw=[512,512], use_pycolmap_ransac=True)
-
-        pred_poses[id] = [pose_pred, inliers]
+    session = PoseTrackingSession(
+        match_2D_3D_model,
+        local_feature_obj_detector,
+        paths['sfm_dir'],
+        K,
+        bbox3d,
+        shape3d=cfg.datamodule.shape3d_val,
+        load_3d_coarse=cfg.datamodule.load_3d_coarse,
+        pad=cfg.datamodule.pad3D,
+        df=cfg.datamodule.df,
+        device=device,
+        num_threads=num_threads,
+        **cfg.get("tracking", {}),
+    )
+    return session, K, bbox3d
+
+def inference_core(cfg, data_root, seq_dir, sfm_model_dir):
+    img_list, paths = get_default_paths(cfg, data_root, seq_dir, sfm_model_dir)
+    session, K, bbox3d = build_session(cfg, paths)
+
+    for id, query_image_path in enumerate(tqdm(img_list)):
+        # Each frame is read from disk once, tracking itself runs on the in-memory frame:
+        image_full = cv2.imread(query_image_path)
+        pose_pred, inliers, bbox, timings = session.track(image_full, frame_name=query_image_path)
 
         # Visualize:
         vis_utils.save_demo_image(
@@ -141,13 +119,58 @@ def inference_core(cfg, data_root, seq_dir, sfm_model_dir):
             box3d=bbox3d,
             draw_box=len(inliers) > 20,
             save_path=osp.join(paths["vis_box_dir"], f"{id}.jpg"),
+            image=image_full,
         )
     
     # Output video to visualize estimated poses:
     logger.info(f"Generate demo video begin...")
     vis_utils.make_video(paths["vis_box_dir"], paths["demo_video_path"])
 
-def inference(cfg):
+def benchmark_core(cfg, data_root, seq_dir, sfm_model_dir):
+    """
+    Per-stage latency of frame-by-frame tracking on one sequence (no visualization).
+    Frames are read from disk before timing; the first `n_warmup` frames are not counted.
+    """
+    img_list, paths = get_default_paths(cfg, data_root, seq_dir, sfm_model_dir)
+    session, _, _ = build_session(cfg, paths, output_results=False)
+
+    bench_cfg = cfg.get("benchmark", {})
+    n_warmup = bench_cfg.get("n_warmup", 5)
+    n_frames = bench_cfg.get("n_frames", None)
+    img_list = img_list[: n_warmup + n_frames] if n_frames is not None else img_list
+    frames = [cv2.imread(query_image_path) for query_image_path in img_list]
+
+    stage_timings = {}
+    for id, frame in enumerate(tqdm(frames)):
+        _, _, _, timings = session.track(frame)
+        if id < n_warmup:
+            continue
+        for stage, t in timings.items():
+            stage_timings.setdefault(stage, []).append(t)
+
+    report = {
+        "device": str(session.device),
+        "num_threads": torch.get_num_threads(),
+        "n_frames": len(frames) - n_warmup,
+        "latency_ms": {
+            stage: {
+                "mean": float(np.mean(ts) * 1000),
+                "median": float(np.median(ts) * 1000),
+                "p90": float(np.percentile(ts, 90) * 1000),
+            }
+            for stage, ts in stage_timings.items()
+        },
+    }
+    for stage, latency in report["latency_ms"].items():
+        logger.info(f"{stage:>10}: mean {latency['mean']:.1f} ms, median {latency['median']:.1f} ms, p90 {latency['p90']:.1f} ms")
+
+    report_path = osp.join(seq_dir, f"benchmark_{session.device.type}.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Benchmark report saved to {report_path}")
+    return report
+
+def run_sequences(cfg, core_fn):
     data_dirs = cfg.data_base_dir
     sfm_model_dirs = cfg.sfm_base_dir
 
@@ -163,7 +186,13 @@ def inference(cfg):
         for seq_name in splits[1:]:
             seq_dir = osp.join(data_root, seq_name)
             logger.info(f"Eval {seq_dir}")
-            inference_core(cfg, data_root, seq_dir, sfm_model_dir)
+            core_fn(cfg, data_root, seq_dir, sfm_model_dir)
+
+def inference(cfg):
+    run_sequences(cfg, inference_core)
+
+def benchmark(cfg):
+    run_sequences(cfg, benchmark_core)
 
 @hydra.main(config_path="configs/", config_name="config.yaml")
 def main(cfg: DictConfig):
@@ -188,6 +188,24 @@ def merge_anno(cfg):
     merge_(cfg, cfg.names, split=cfg.split)
 
 
+def pack_images(cfg):
+    """ Pack the images of a merged annotation file into one memory-mapped shard for training """
+    from src.utils.image_store import pack_image_store
+
+    anno_path = cfg.datamodule.out_path.format(cfg.split)
+    with open(anno_path, "r") as f:
+        img_files = [image["img_file"] for image in json.load(f)["images"]]
+    logger.info(f"Packing {len(img_files)} images of {anno_path}")
+
+    pack_image_store(
+        img_files,
+        cfg.datamodule.image_store_path,
+        resize=cfg.datamodule.img_resize,
+        df=cfg.datamodule.df,
+        n_threads=cfg.n_threads,
+    )
+
+
 @hydra.main(config_path="configs/", config_name="config.yaml")
 def main(cfg):
     globals()[cfg.type](cfg)
@@ -0,0 +1,165 @@
+import os
+import cv2
+import json
+import tqdm
+import argparse
+import numpy as np
+import os.path as osp
+from pathlib import Path
+from multiprocessing import Pool
+
+from src.utils import data_utils
+from src.utils.frame_index import FrameIndexWriter, remove_frame_index
+from parse_scanned_data import get_bbox3d, reproj
+
+
+"""
+Convert rendered BOP data (all chunks of e.g. bop_data/train_pbr) directly to an annotated OnePose++ sequence,
+i.e. the layout parse_scanned_data produces from an ARKit scan, without the video encode / decode round trip:
+
+    - out_dir (e.g. <obj_root>/<obj>-annotate)
+        - color/ color_full/ intrin_ba/ poses_ba/ M/ bbox/ (<frame_index>.png / .txt)
+        - intrinsics.txt
+        - frame_index.npz (intrin_ba, poses_ba and M, their .txt files are only written with write_txt)
+    - <obj_root>/box3d_corners.txt
+"""
+
+
+def load_bop_frames(bop_dir, obj_id=None):
+    """
+    Returns:
+        frames (list): [{'rgb_path', 'K' [3*3], 'pose' [4*4], object to camera}], in chunk and image id order
+    """
+    frames = []
+    chunk_dirs = sorted(
+        chunk_dir for chunk_dir in Path(bop_dir).iterdir()
+        if chunk_dir.is_dir() and (chunk_dir / "scene_gt.json").exists()
+    )
+    assert len(chunk_dirs) > 0, f"No BOP chunk (with scene_gt.json) found in {bop_dir}"
+
+    for chunk_dir in chunk_dirs:
+        with open(chunk_dir / "scene_gt.json", "r") as f:
+            scene_gt = json.load(f)
+        with open(chunk_dir / "scene_camera.json", "r") as f:
+            scene_camera = json.load(f)
+
+        for im_id in sorted(scene_gt.keys(), key=int):
+            obj_gts = scene_gt[im_id]
+            if obj_id is not None:
+                obj_gts = [obj_gt for obj_gt in obj_gts if obj_gt["obj_id"] == obj_id]
+            if len(obj_gts) == 0:
+                continue
+
+            pose = np.eye(4)
+            pose[:3, :3] = np.array(obj_gts[0]["cam_R_m2c"]).reshape(3, 3)
+            pose[:3, 3] = np.array(obj_gts[0]["cam_t_m2c"])
+
+            rgb_path = chunk_dir / "rgb" / f"{int(im_id):06d}.png"
+            if not rgb_path.exists():
+                rgb_path = rgb_path.with_suffix(".jpg")
+
+            frames.append(
+                {
+                    "rgb_path": str(rgb_path),
+                    "K": np.array(scene_camera[im_id]["cam_K"]).reshape(3, 3),
+                    "pose": pose,
+                }
+            )
+    return frames
+
+
+def convert_frame(args):
+    """ Crop one frame around its projected 3D box, same crops as parse_scanned_data.parse_video """
+    index, frame, bbox_3d_homo, out_dir, hw, write_txt = args
+    K, pose = frame["K"], frame["pose"]
+    K_homo = np.concatenate([K, np.zeros((3, 1))], axis=-1)
+
+    reproj_box3d = reproj(K_homo, pose, bbox_3d_homo.T)
+    x0, y0 = reproj_box3d.min(0)
+    x1, y1 = reproj_box3d.max(0)
+    if x0 < -1000 or y0 < -1000 or x1 > 3000 or y1 > 3000:
+        return None
+
+    # parse_video reads the box back from integer-truncated text
+    x0, y0 = reproj_box3d.astype(int).min(0)
+    x1, y1 = reproj_box3d.astype(int).max(0)
+    image = cv2.imread(frame["rgb_path"])
+    assert image is not None, f"{frame['rgb_path']} not properly loaded"
+
+    box = np.array([x0, y0, x1, y1])
+    resize_shape = np.array([y1 - y0, x1 - x0])
+    K_crop, K_crop_homo = data_utils.get_K_crop_resize(box, K, resize_shape)
+    image_crop, trans1 = data_utils.get_image_crop_resize(image, box, resize_shape)
+
+    box_new = np.array([0, 0, x1 - x0, y1 - y0])
+    resize_shape = np.array([hw, hw])
+    K_crop, K_crop_homo = data_utils.get_K_crop_resize(box_new, K_crop, resize_shape)
+    image_crop, trans2 = data_utils.get_image_crop_resize(image_crop, box_new, resize_shape)
+
+    trans_crop_to_full = np.linalg.inv(trans2 @ trans1)
+
+    reproj_crop = reproj(K_crop_homo, pose, bbox_3d_homo.T)
+    box_crop = np.concatenate([reproj_crop.min(0), reproj_crop.max(0)])
+
+    cv2.imwrite(osp.join(out_dir, "color", f"{index}.png"), image_crop)
+    cv2.imwrite(osp.join(out_dir, "color_full", f"{index}.png"), image)
+    if write_txt:
+        np.savetxt(osp.join(out_dir, "intrin_ba", f"{index}.txt"), K_crop)
+        np.savetxt(osp.join(out_dir, "poses_ba", f"{index}.txt"), pose)
+        np.savetxt(osp.join(out_dir, "M", f"{index}.txt"), trans_crop_to_full)
+    np.savetxt(osp.join(out_dir, "bbox", f"{index}.txt"), box_crop)
+    return index, K_crop, pose, trans_crop_to_full
+
+
+def convert_bop_sequence(bop_dir, box_file, out_dir, obj_id=None, hw=512, n_workers=4, write_txt=True):
+    frames = load_bop_frames(bop_dir, obj_id=obj_id)
+    remove_frame_index(out_dir)
+    for sub_dir in ["color", "color_full", "intrin_ba", "poses_ba", "M", "bbox"]:
+        Path(out_dir, sub_dir).mkdir(parents=True, exist_ok=True)
+
+    bbox_3d, bbox_3d_homo = get_bbox3d(box_file)
+    np.savetxt(osp.join(osp.dirname(osp.abspath(out_dir)), "box3d_corners.txt"), bbox_3d)
+
+    # Rendered with a fixed camera, keep the (first) intrinsics as the sequence intrinsics
+    fx, fy, cx, cy = frames[0]["K"][0, 0], frames[0]["K"][1, 1], frames[0]["K"][0, 2], frames[0]["K"][1, 2]
+    with open(osp.join(out_dir, "intrinsics.txt"), "w") as f:
+        f.write("fx: {0}\nfy: {1}\ncx: {2}\ncy: {3}".format(fx, fy, cx, cy))
+
+    frame_index = FrameIndexWriter(out_dir)
+    tasks = [(index, frame, bbox_3d_homo, out_dir, hw, write_txt) for index, frame in enumerate(frames)]
+    with Pool(n_workers) as pool:
+        for result in tqdm.tqdm(pool.imap(convert_frame, tasks, chunksize=8), total=len(tasks)):
+            if result is None:
+                continue
+            index, K_crop, pose, trans_crop_to_full = result
+            frame_index.add("intrin_ba", index, K_crop)
+            frame_index.add("poses_ba", index, pose)
+            frame_index.add("M", index, trans_crop_to_full)
+    frame_index.save()
+    print(f"=> Converted {len(frame_index.matrices.get('poses_ba', {}))}/{len(frames)} frames to {out_dir}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument("--bop_dir", type=str, required=True, help="BOP split dir with chunks, e.g. bop_data/train_pbr")
+    parser.add_argument("--box_file", type=str, required=True, help="Box.txt of the object 3D bounding box")
+    parser.add_argument("--out_dir", type=str, required=True, help="Output sequence dir, e.g. <obj_root>/<obj>-annotate")
+    parser.add_argument("--obj_id", type=int, default=None, help="BOP obj_id of the object, default: first object of each frame")
+    parser.add_argument("--hw", type=int, default=512)
+    parser.add_argument("--n_workers", type=int, default=4,
+                        help="conversion processes, run.sh passes the CPU_THREADS budget of the scene")
+    parser.add_argument("--no_txt", action="store_true",
+                        help="only write the intrinsics / poses / crop transforms to frame_index.npz, no per-frame .txt")
+
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    convert_bop_sequence(
+        args.bop_dir, args.box_file, args.out_dir, obj_id=args.obj_id, hw=args.hw, n_workers=args.n_workers,
+        write_txt=not args.no_txt
+    )
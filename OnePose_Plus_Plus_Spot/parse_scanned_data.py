@@ -7,6 +7,7 @@ import argparse
 from pathlib import Path
 from transforms3d import affines, quaternions
 from src.utils import data_utils
+from src.utils.frame_index import FrameIndexWriter, FRAME_INDEX_NAME, remove_frame_index
 
 def get_arkit_default_path(data_dir):
     video_file = osp.join(data_dir, 'Frames.m4v')
@@ -130,7 +131,8 @@ def reproj(K_homo, pose, points3d_homo):
     return reproj_points # [n, 2]
 
 
-def parse_video(paths, downsample_rate=5, bbox_3d_homo=None, hw=512):
+def parse_video(paths, downsample_rate=5, bbox_3d_homo=None, hw=512, frame_index=None):
+    """ frame_index (FrameIndexWriter): also collect intrinsics and crop transforms in the sequence frame index """
     orig_intrin_file = paths['final_intrin_file']
     K, K_homo = data_utils.get_K(orig_intrin_file)
 
@@ -166,6 +168,8 @@ def parse_video(paths, downsample_rate=5, bbox_3d_homo=None, hw=512):
             trans_crop_to_full = np.linalg.inv(trans_full_to_crop)
 
             np.savetxt(osp.join(paths['M_dir'], '{}.txt'.format(index)), trans_crop_to_full)
+            if frame_index is not None:
+                frame_index.add(osp.basename(paths['M_dir']), index, trans_crop_to_full)
 
             pose = np.loadtxt(osp.join(paths['out_pose_dir'], '{}.txt'.format(index)))
             reproj_crop = reproj(K_crop_homo, pose, bbox_3d_homo.T)
@@ -180,6 +184,8 @@ def parse_video(paths, downsample_rate=5, bbox_3d_homo=None, hw=512):
             Path(full_img_dir).mkdir(exist_ok=True, parents=True)
             cv2.imwrite(osp.join(full_img_dir, '{}.png'.format(index)), image)
             np.savetxt(save_intrin_path, K_crop)
+            if frame_index is not None:
+                frame_index.add(osp.basename(intrin_dir), index, K_crop)
 
         index += 1
     cap.release()
@@ -203,6 +209,9 @@ def data_process_anno(data_dir, downsample_rate=1, hw=512):
         [0, fy, cy, 0],
         [0,  0,  1, 0]
     ])
+    # Per-frame matrices are also gathered in one binary index, much cheaper to read than the txt files
+    remove_frame_index(data_dir)
+    frame_index = FrameIndexWriter(data_dir)
     with open(paths['pose_file'], 'r') as f:
         lines = [l.strip() for l in f.readlines()]
         index = 0
@@ -232,10 +241,11 @@ def data_process_anno(data_dir, downsample_rate=1, hw=512):
                     continue
 
                 np.savetxt(pose_save_path, T_oc)
+                frame_index.add(osp.basename(paths['out_pose_dir']), index, T_oc)
                 np.savetxt(box_save_path, reproj_box3d)
             index += 1
 
-    parse_video(paths, downsample_rate, bbox_3d_homo, hw=hw)
+    parse_video(paths, downsample_rate, bbox_3d_homo, hw=hw, frame_index=frame_index)
 
     # Make fake data for demo annotate video without BA refinement:
     if osp.exists(osp.join(osp.dirname(paths['intrin_dir']), 'intrin_ba')):
@@ -246,6 +256,10 @@ def data_process_anno(data_dir, downsample_rate=1, hw=512):
         os.system(f"rm -rf {osp.join(osp.dirname(paths['out_pose_dir']), 'poses_ba')}")
     os.system(f"ln -s {paths['out_pose_dir']} {osp.join(osp.dirname(paths['out_pose_dir']), 'poses_ba')}")
 
+    frame_index.alias('intrin_ba', osp.basename(paths['intrin_dir']))
+    frame_index.alias('poses_ba', osp.basename(paths['out_pose_dir']))
+    frame_index.save()
+
 def data_process_test(data_dir, downsample_rate=1):
     paths = get_test_default_path(data_dir)
 
@@ -293,6 +307,10 @@ if __name__ == "__main__":
             print('=> Processing test sequence: ', seq_dir)
             data_process_test(osp.join(data_dir, seq_dir), downsample_rate=1)
         elif '-annotate' in seq_dir:
+            if not osp.exists(osp.join(data_dir, seq_dir, 'Frames.m4v')) and \
+                    osp.exists(osp.join(data_dir, seq_dir, FRAME_INDEX_NAME)):
+                print('=> Skip annotate sequence already converted by parse_bop_data.py: ', seq_dir)
+                continue
             print('=> Processing annotate sequence: ', seq_dir)
             data_process_anno(osp.join(data_dir, seq_dir), downsample_rate=1, hw=512)
         else:
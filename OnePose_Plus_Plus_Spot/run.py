@@ -148,7 +148,6 @@ def sfm_core(cfg, img_lists, outputs_dir_root, obj_name):
     from src.sfm_utils import (
         generate_empty,
         triangulation,
-        pairs_exhaustive_all, pairs_from_index, pairs_from_poses
     )
     from src.KeypointFreeSfM import coarse_match, post_optimization
 
@@ -180,13 +179,75 @@ def sfm_core(cfg, img_lists, outputs_dir_root, obj_name):
     matches_out = osp.join(outputs_dir, f"matches-{cfg.network.matching}.h5")
     empty_dir = osp.join(outputs_dir, "sfm_empty")
     deep_sfm_dir = osp.join(outputs_dir, "sfm_ws")
+    feature_coarse_out = osp.splitext(feature_out)[0] + "_coarse" + osp.splitext(feature_out)[1]
+    match_cache_path = osp.join(outputs_dir_root, "match_cache", f"{obj_name}.h5") # survives overwrite_all
+    raw_matches_out = osp.join(outputs_dir, "raw_matches.h5") # raw matches of all pairs, written for incremental SfM only
 
     if cfg.overwrite_all:
         os.system(f"rm -rf {outputs_dir}")
         os.system(f"rm -rf {vis3d_pth}")
     Path(outputs_dir).mkdir(exist_ok=True, parents=True)
 
-    if (
+    # Register appended sequences into the existing coarse reconstruction instead of rebuilding it:
+    incremental = cfg.sfm.get("incremental", False) and all(
+        osp.exists(path)
+        for path in [
+            osp.join(deep_sfm_dir, "model_coarse"),
+            osp.join(deep_sfm_dir, "database.db"),
+            feature_coarse_out,
+            covis_pairs_out,
+            raw_matches_out,
+        ]
+    )
+    reuse_fine_matches = False
+
+    if incremental:
+        logger.info("Keypoint-Free SfM incremental coarse reconstruction begin...")
+        registered_names = triangulation.get_registered_image_ids(osp.join(deep_sfm_dir, "database.db"))
+        new_img_lists = [img_path for img_path in img_lists if img_path not in registered_names]
+        logger.info(f"{len(new_img_lists)} new images, {len(img_lists) - len(new_img_lists)} images already reconstructed")
+
+        if len(new_img_lists) != 0:
+            covis_pairs_new_out = osp.splitext(covis_pairs_out)[0] + "-new.txt"
+            merge_incremental_pairs(cfg, img_lists, new_img_lists, covis_pairs_out, covis_pairs_new_out)
+
+            # Only the new pairs are matched, the raw matches of the old ones are read from the last run
+            coarse_match.detector_free_coarse_matching(
+                img_lists,
+                covis_pairs_new_out,
+                feature_out,
+                matches_out,
+                use_ray=cfg.use_local_ray,
+                verbose=cfg.verbose,
+                match_cache_path=match_cache_path,
+                existing_feature_path=feature_coarse_out,
+                existing_raw_match_path=raw_matches_out,
+                save_raw_matches=True,
+            )
+            os.system(f"rm -rf {empty_dir}")
+            generate_empty.generate_model(img_lists, empty_dir)
+
+            os.system(f"rm -rf {osp.join(deep_sfm_dir, 'model')}")
+            triangulation.main_incremental(
+                deep_sfm_dir,
+                empty_dir,
+                osp.join(deep_sfm_dir, "model_coarse"),
+                outputs_dir,
+                covis_pairs_new_out,
+                feature_out,
+                matches_out,
+                match_model=cfg.network.matching,
+                image_dir=None,
+                verbose=cfg.verbose,
+            )
+
+            os.system(f"mv {feature_out} {feature_coarse_out}")
+            os.system(f"rm -rf {osp.join(deep_sfm_dir, 'model_coarse')}")
+            os.system(
+                f"mv {osp.join(deep_sfm_dir, 'model')} {osp.join(deep_sfm_dir, 'model_coarse')}"
+            )
+            reuse_fine_matches = True
+    elif (
         not osp.exists(osp.join(deep_sfm_dir, "model_coarse"))
         or cfg.overwrite_coarse
     ):
@@ -196,28 +257,9 @@ def sfm_core(cfg, img_lists, outputs_dir_root, obj_name):
         os.system(
             f'rm -rf {osp.join(covis_pairs_out.rsplit("/", 1)[0], "fine_matches.pkl")}'
         )  # Force refinement to recompute fine match
+        os.system(f"rm -f {raw_matches_out}")  # raw matches of the last model_coarse, rewritten if incremental
 
-        if covis_num == -1:
-            pairs_exhaustive_all.exhaustive_all_pairs(
-                img_lists, covis_pairs_out
-            )
-        else:
-            if cfg.sfm.gen_cov_from == 'index':
-                pairs_from_index.covis_from_index(
-                    img_lists,
-                    covis_pairs_out,
-                    num_matched=covis_num,
-                    gap=cfg.sfm.gap,
-                )
-            elif cfg.sfm.gen_cov_from == 'pose':
-                pairs_from_poses.covis_from_pose(
-                    img_lists,
-                    covis_pairs_out,
-                    covis_num,
-                    min_rotation=cfg.sfm.min_rotation
-                )
-            else:
-                raise NotImplementedError
+        generate_covis_pairs(cfg, img_lists, covis_pairs_out)
 
         coarse_match.detector_free_coarse_matching(
             img_lists,
@@ -225,7 +267,9 @@ def sfm_core(cfg, img_lists, outputs_dir_root, obj_name):
             feature_out,
             matches_out,
             use_ray=cfg.use_local_ray,
-            verbose=cfg.verbose
+            verbose=cfg.verbose,
+            match_cache_path=match_cache_path,
+            save_raw_matches=cfg.sfm.get("incremental", False),
         )
         generate_empty.generate_model(img_lists, empty_dir)
 
@@ -269,6 +313,7 @@ def sfm_core(cfg, img_lists, outputs_dir_root, obj_name):
         if (
             not osp.exists(osp.join(deep_sfm_dir, "model"))
             or cfg.overwrite_fine
+            or reuse_fine_matches
         ):
             assert osp.exists(
                 osp.join(deep_sfm_dir, "model_coarse")
@@ -290,13 +335,71 @@ def sfm_core(cfg, img_lists, outputs_dir_root, obj_name):
                 fine_match_use_ray=cfg.use_local_ray,
                 vis3d_pth=vis3d_pth,
                 verbose=cfg.verbose,
-                args=post_optim_configs
+                args=post_optim_configs,
+                reuse_fine_matches=reuse_fine_matches,
             )
             if state == False:
                 logger.error("Coarse reconstruction failed!")
     else:
         raise NotImplementedError
 
+def generate_covis_pairs(cfg, img_lists, covis_pairs_out):
+    """ Select image pairs to match, by index / pose covisibility or exhaustively """
+    from src.sfm_utils import pairs_exhaustive_all, pairs_from_index, pairs_from_poses
+
+    covis_num = cfg.sfm.covis_num
+    if covis_num == -1:
+        pairs_exhaustive_all.exhaustive_all_pairs(
+            img_lists, covis_pairs_out
+        )
+    else:
+        if cfg.sfm.gen_cov_from == 'index':
+            pairs_from_index.covis_from_index(
+                img_lists,
+                covis_pairs_out,
+                num_matched=covis_num,
+                gap=cfg.sfm.gap,
+            )
+        elif cfg.sfm.gen_cov_from == 'pose':
+            pairs_from_poses.covis_from_pose(
+                img_lists,
+                covis_pairs_out,
+                covis_num,
+                min_rotation=cfg.sfm.min_rotation,
+                method=cfg.sfm.get("covis_search", "dense"),
+            )
+        else:
+            raise NotImplementedError
+
+
+def merge_incremental_pairs(cfg, img_lists, new_img_lists, covis_pairs_out, covis_pairs_new_out):
+    """
+    Incremental SfM pairs: the already reconstructed pairs are kept as they are (their matches are in the database),
+    and pairs with at least one new image are selected over all images.
+    Write all pairs to covis_pairs_out and only the new ones to covis_pairs_new_out.
+    """
+    with open(covis_pairs_out, "r") as f:
+        old_pairs = f.read().rstrip("\n").split("\n")
+
+    generate_covis_pairs(cfg, img_lists, covis_pairs_new_out)
+    with open(covis_pairs_new_out, "r") as f:
+        all_pairs = f.read().rstrip("\n").split("\n")
+
+    new_img_set = set(new_img_lists)
+    old_pair_set = set(old_pairs)
+    new_pairs = [
+        pair
+        for pair in all_pairs
+        if pair not in old_pair_set and any(name in new_img_set for name in pair.split(" "))
+    ]
+    logger.info(f"{len(new_pairs)} new image pairs, {len(old_pairs)} pairs already matched")
+
+    with open(covis_pairs_out, "w") as f:
+        f.write("\n".join(old_pairs + new_pairs))
+    with open(covis_pairs_new_out, "w") as f:
+        f.write("\n".join(new_pairs))
+
+
 def postprocess(cfg, img_lists, root_dir, sub_dirs, outputs_dir_root, obj_name):
     """ Filter points and average feature"""
     from src.sfm_utils.postprocess import filter_points, feature_process, filter_tkl
@@ -0,0 +1,69 @@
+"""
+Benchmark of the offline evaluation RANSAC PnP: serial `ransac_PnP` loop against the frames spread over
+processes (`eval_metrics.pnp_workers`, see PnPPool in src/inference/inference_OnePosePlus_worker.py).
+Synthetic frames with 50-1500 matches, 0.7 px noise and 10-60% outliers, fixed seed.
+
+Usage (from the OnePose_Plus_Plus_Spot dir):
+    python -m scripts.benchmark_pnp --n_frames 500 --n_workers 2 4 8
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from src.utils.metric_utils import ransac_PnP
+
+
+def make_frames(n_frames, seed=0):
+    rng = np.random.default_rng(seed)
+    K = np.array([[600.0, 0, 256], [0, 600.0, 256], [0, 0, 1]])
+    frames = []
+    for _ in range(n_frames):
+        n_pts = int(rng.integers(50, 1500))
+        pts_3d = rng.uniform(-0.1, 0.1, (n_pts, 3))
+        rvec = rng.normal(0, 0.5, 3)
+        tvec = np.array([rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05), rng.uniform(0.4, 1.0)])
+        pts_2d = cv2.projectPoints(pts_3d, rvec, tvec, K, None)[0][:, 0]
+        pts_2d += rng.normal(0, 0.7, pts_2d.shape)
+        outliers = rng.random(n_pts) < rng.uniform(0.1, 0.6)
+        pts_2d[outliers] = rng.uniform(0, 512, (outliers.sum(), 2))
+        frames.append(
+            dict(K=K, pts_2d=pts_2d, pts_3d=pts_3d, scale=1000, img_hw=[512, 512], pnp_reprojection_error=3.3)
+        )
+    return frames
+
+
+def solve(frame):
+    return ransac_PnP(**frame)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_frames", type=int, default=500)
+    parser.add_argument("--n_workers", type=int, nargs="+", default=[2, 4, 8])
+    args = parser.parse_args()
+
+    frames = make_frames(args.n_frames)
+    start = time.time()
+    serial = [solve(frame) for frame in frames]
+    serial_seconds = time.time() - start
+    print(f"serial: {serial_seconds:.2f}s for {args.n_frames} frames")
+
+    for n_workers in args.n_workers:
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            list(executor.map(solve, frames[: n_workers]))  # exclude the worker start up
+            start = time.time()
+            pooled = list(executor.map(solve, frames, chunksize=4))
+            seconds = time.time() - start
+        identical = all(
+            np.array_equal(a[1], b[1]) and np.array_equal(np.asarray(a[2]), np.asarray(b[2]))
+            for a, b in zip(serial, pooled)
+        )
+        print(f"{n_workers} workers: {seconds:.2f}s ({serial_seconds / seconds:.2f}x), identical results: {identical}")
+
+
+if __name__ == "__main__":
+    main()
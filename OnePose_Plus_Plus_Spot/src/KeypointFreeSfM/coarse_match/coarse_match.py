@@ -8,9 +8,11 @@ from typing import ChainMap
 
 from src.utils.ray_utils import ProgressBar, chunks, chunk_index, split_dict
 from src.utils.data_io import save_h5, load_h5
-from .utils import Match2Pts2D
+from .utils import Match2Pts2D, align_keypoints_to_existing
+from .match_cache import PairMatchCache
 from .coarse_match_worker import *
 from ..dataset.loftr_coarse_dataset import LoftrCoarseDataset
+from ..loftr_for_sfm import default_cfg
 
 cfgs = {
     "data": {"img_resize": None, "df": 8, "shuffle": True}, # None means use original size
@@ -21,7 +23,11 @@ cfgs = {
         },
         "pair_name_split": " ",
     },
-    "coarse_match_debug": True,
+    "match_cache": {
+        "enable": True,
+        "max_entries": None,
+        "max_size_gb": 20, # LRU eviction beyond this size
+    },
     "ray": {
         "slurm": False,
         "n_workers": 4, 
@@ -39,7 +45,22 @@ def detector_free_coarse_matching(
     match_out,
     use_ray=False,
     verbose=False,
+    match_cache_path=None,
+    existing_feature_path=None,
+    existing_raw_match_path=None,
+    save_raw_matches=True,
 ):
+    """
+    match_cache_path[optional]: persistent per-pair match store (see `PairMatchCache`),
+        only pairs missing from it are matched by LoFTR.
+    existing_feature_path[optional]: keypoints of an existing reconstruction (incremental SfM),
+        the keypoint indices of its images are kept and new keypoints appended.
+    existing_raw_match_path[optional]: raw matches of the pairs of an existing reconstruction (its raw_matches.h5,
+        incremental SfM), only the pairs of covis_pairs_out are matched, the keypoints and matches are written for
+        the existing and the new pairs.
+    save_raw_matches: write the raw matches of all pairs to raw_matches.h5 next to feature_out, only read back as
+        existing_raw_match_path by incremental SfM. Pair matches are reused across runs by the match cache.
+    """
     # Build dataset:
     dataset = LoftrCoarseDataset(cfgs["data"], image_lists, covis_pairs_out)
 
@@ -47,6 +68,12 @@ def detector_free_coarse_matching(
     base_dir = feature_out.rsplit("/", 1)[0]
     os.makedirs(base_dir, exist_ok=True)
     cache_dir = osp.join(feature_out.rsplit("/", 1)[0], "raw_matches.h5")
+    existing_keypoints = (
+        load_keypoints(existing_feature_path, image_lists) if existing_feature_path is not None else None
+    )
+    existing_raw_matches = (
+        load_h5(existing_raw_match_path, transform_slash=True) if existing_raw_match_path is not None else {}
+    )
 
     if use_ray:
         # Initial ray:
@@ -61,37 +88,17 @@ def detector_free_coarse_matching(
                 ignore_reinit_error=True,
             )
 
-        # Matcher runner
-        if not cfgs["coarse_match_debug"] and osp.exists(cache_dir):
-            matches = load_h5(cache_dir, transform_slash=True)
-            logger.info("Caches raw matches loaded!")
-        else:
-            pb = (
-                ProgressBar(len(dataset), "Matching image pairs...")
-                if verbose
-                else None
-            )
-            all_subset_ids = chunk_index(
-                len(dataset), math.ceil(len(dataset) / cfg_ray["n_workers"])
-            )
-            obj_refs = [
-                match_worker_ray_wrapper.remote(
-                    dataset,
-                    subset_ids,
-                    cfgs["matcher"],
-                    pb.actor if pb is not None else None,
-                    verbose=verbose,
-                )
-                for subset_ids in all_subset_ids
-            ]
-            pb.print_until_done() if pb is not None else None
-            results = ray.get(obj_refs)
-            matches = dict(ChainMap(*results))
-            logger.info("Matcher finish!")
-
-            save_h5(matches, cache_dir)
-            logger.info(f"Raw matches cached: {cache_dir}")
+    # Matcher runner
+    matches = coarse_match_pairs(dataset, match_cache_path=match_cache_path, use_ray=use_ray, verbose=verbose)
+    if len(existing_raw_matches) != 0:
+        matches = {**existing_raw_matches, **matches}
+        logger.info(f"{len(existing_raw_matches)} pairs of the existing reconstruction added to the matches")
 
+    if save_raw_matches:
+        save_h5(matches, cache_dir)
+        logger.info(f"Raw matches saved: {cache_dir}")
+
+    if use_ray:
         # Combine keypoints
         n_imgs = len(dataset.img_dir)
         pb = ProgressBar(n_imgs, "Combine points 2D...") if verbose else None
@@ -106,6 +113,8 @@ def detector_free_coarse_matching(
         pb.print_until_done() if pb is not None else None
         keypoints = dict(ChainMap(*ray.get(obj_refs)))
         logger.info("Combine keypoints finish!")
+        if existing_keypoints is not None:
+            keypoints = align_keypoints_to_existing(keypoints, existing_keypoints)
 
         # Convert keypoints match to keypoints indexs
         pb = ProgressBar(len(matches), "Updating matches...") if verbose else None
@@ -139,19 +148,6 @@ def detector_free_coarse_matching(
         final_keypoints = dict(ChainMap(*[k for k, _ in kpts_scores]))
         final_scores = dict(ChainMap(*[s for _, s in kpts_scores]))
     else:
-        # Matcher runner
-        if not cfgs["coarse_match_debug"] and osp.exists(cache_dir):
-            matches = load_h5(cache_dir, transform_slash=True)
-            logger.info("Caches raw matches loaded!")
-        else:
-            all_ids = np.arange(0, len(dataset))
-            matches = match_worker(dataset, all_ids, cfgs["matcher"], verbose=verbose)
-            logger.info("Matcher finish!")
-
-            # over write anyway
-            save_h5(matches, cache_dir)
-            logger.info(f"Raw matches cached: {cache_dir}")
-
         # Combine keypoints
         n_imgs = len(dataset.img_dir)
         logger.info("Combine 2D points!")
@@ -161,6 +157,8 @@ def detector_free_coarse_matching(
         sub_kpts = chunks(all_kpts, math.ceil(n_imgs / 1))  # equal to only 1 worker
         obj_refs = [points2D_worker(sub_kpt, verbose=verbose) for sub_kpt in sub_kpts]
         keypoints = dict(ChainMap(*obj_refs))
+        if existing_keypoints is not None:
+            keypoints = align_keypoints_to_existing(keypoints, existing_keypoints)
 
         # Convert points2D match to points2D indexs
         logger.info("Update matches")
@@ -213,3 +211,85 @@ def detector_free_coarse_matching(
             grp.create_dataset("matches0", data=matches)
 
     return final_keypoints, updated_matches
+
+
+def load_keypoints(feature_path, image_names):
+    """ {image_name: keypoints[N*2]} of the images found in a feature file written by `detector_free_coarse_matching` """
+    with h5py.File(feature_path, "r") as feature_file:
+        return {
+            image_name: feature_file[image_name]["keypoints"].__array__()
+            for image_name in image_names
+            if image_name in feature_file
+        }
+
+
+def coarse_match_pairs(dataset, match_cache_path=None, use_ray=False, verbose=False):
+    """
+    Match all image pairs of the dataset, reusing the pair matches found in the persistent match cache.
+    Ray should already be initialized if use_ray.
+    Output:
+        matches: dict{"img_path0 img_path1": np.ndarray[N*5]}, in dataset pair order
+    """
+    pair_name_split = cfgs["matcher"]["pair_name_split"]
+    pair_keys = {}
+    for pair in dataset.pair_list:
+        img_path0, img_path1 = pair.split(" ")
+        pair_keys[pair_name_split.join([img_path0, img_path1])] = (img_path0, img_path1)
+
+    match_cache = None
+    cached_matches = {}
+    if match_cache_path is not None and cfgs["match_cache"]["enable"]:
+        match_cache = PairMatchCache(
+            match_cache_path,
+            cfgs["data"]["img_resize"],
+            cfgs["data"]["df"],
+            cfgs["matcher"]["model"]["weight_path"],
+            default_cfg, # matcher (coarse thr, match type, ...) config of build_model
+            max_entries=cfgs["match_cache"]["max_entries"],
+            max_size_gb=cfgs["match_cache"]["max_size_gb"],
+        )
+        cached_matches = match_cache.load(pair_keys)
+
+    todo_ids = np.array(
+        [id for id, pair_name in enumerate(pair_keys) if pair_name not in cached_matches], dtype=int
+    )
+    logger.info(f"{len(cached_matches)} pairs loaded from match cache, {len(todo_ids)} pairs to match")
+
+    if len(todo_ids) == 0:
+        new_matches = {}
+    elif use_ray:
+        cfg_ray = cfgs["ray"]
+        pb = (
+            ProgressBar(len(todo_ids), "Matching image pairs...")
+            if verbose
+            else None
+        )
+        all_subset_ids = [
+            todo_ids[sub_ids]
+            for sub_ids in chunk_index(len(todo_ids), math.ceil(len(todo_ids) / cfg_ray["n_workers"]))
+        ]
+        obj_refs = [
+            match_worker_ray_wrapper.remote(
+                dataset,
+                subset_ids,
+                cfgs["matcher"],
+                pb.actor if pb is not None else None,
+                verbose=verbose,
+            )
+            for subset_ids in all_subset_ids
+        ]
+        pb.print_until_done() if pb is not None else None
+        results = ray.get(obj_refs)
+        new_matches = dict(ChainMap(*results))
+    else:
+        new_matches = match_worker(dataset, todo_ids, cfgs["matcher"], verbose=verbose)
+    logger.info("Matcher finish!")
+
+    if match_cache is not None:
+        match_cache.save(new_matches, pair_keys)
+
+    matches = {
+        pair_name: cached_matches[pair_name] if pair_name in cached_matches else new_matches[pair_name]
+        for pair_name in pair_keys
+    }
+    return matches
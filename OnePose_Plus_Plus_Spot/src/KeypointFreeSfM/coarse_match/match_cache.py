@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import h5py
+import hashlib
+import numpy as np
+import os.path as osp
+from loguru import logger
+
+from src.utils.misc import file_hash
+
+
+class PairMatchCache():
+    """
+    Persistent cache of raw coarse LoFTR matches of image pairs, stored in one HDF5 file.
+
+    Entries are content addressed: the key is built from the md5 of both images (in pair order),
+    the resize / df settings, the matcher config (coarse threshold, match type, ...) and the md5 of the
+    LoFTR checkpoint, so renaming or re-listing images reuses their matches while re-rendered images,
+    changed matcher settings or a new checkpoint miss.
+    Each entry stores the (N, 5) [x0, y0, x1, y1, conf] array in original image coordinates
+    and its last access time, which is used for LRU eviction once `max_entries` or `max_size_gb` is exceeded.
+
+    Only the main process reads / writes the store, ray workers just receive the missing pairs.
+    """
+
+    def __init__(self, cache_path, img_resize, df, weight_path, matcher_cfg, max_entries=None, max_size_gb=None):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_size = max_size_gb * (1 << 30) if max_size_gb is not None else None
+        matcher_cfg = json.dumps(matcher_cfg, sort_keys=True, default=str)
+        self.settings = f"resize={img_resize},df={df},ckpt={file_hash(weight_path)},cfg={matcher_cfg}"
+        self._img_hashes = {}
+
+        os.makedirs(osp.dirname(osp.abspath(cache_path)), exist_ok=True)
+
+    def _img_hash(self, img_path):
+        if img_path not in self._img_hashes:
+            self._img_hashes[img_path] = file_hash(img_path)
+        return self._img_hashes[img_path]
+
+    def make_key(self, img_path0, img_path1):
+        content = " ".join([self._img_hash(img_path0), self._img_hash(img_path1), self.settings])
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def load(self, pair_keys):
+        """
+        Args:
+            pair_keys (dict): {pair_name: (img_path0, img_path1)}
+        Returns:
+            matches (dict): {pair_name: np.ndarray[N*5]} of the cached pairs
+        """
+        if not osp.exists(self.cache_path):
+            return {}
+
+        matches = {}
+        now = time.time()
+        with h5py.File(self.cache_path, "a") as f:
+            for pair_name, (img_path0, img_path1) in pair_keys.items():
+                key = self.make_key(img_path0, img_path1)
+                if key not in f:
+                    continue
+                matches[pair_name] = f[key][()]
+                f[key].attrs["last_access"] = now
+        return matches
+
+    def save(self, matches, pair_keys):
+        """
+        Args:
+            matches (dict): {pair_name: np.ndarray[N*5]}
+            pair_keys (dict): {pair_name: (img_path0, img_path1)}
+        """
+        if len(matches) == 0:
+            return
+
+        now = time.time()
+        with h5py.File(self.cache_path, "a") as f:
+            for pair_name, pair_matches in matches.items():
+                key = self.make_key(*pair_keys[pair_name])
+                if key in f:
+                    del f[key]
+                dset = f.create_dataset(key, data=pair_matches)
+                dset.attrs["last_access"] = now
+            n_evicted = self._evict(f)
+        logger.info(f"{len(matches)} pair matches cached, {n_evicted} stale entries evicted: {self.cache_path}")
+
+        if n_evicted > 0:
+            self._repack()
+
+    def _evict(self, f):
+        """ Drop least recently used entries until the store fits `max_entries` and `max_size` """
+        if self.max_entries is None and self.max_size is None:
+            return 0
+
+        keys = list(f.keys())
+        last_access = np.array([f[key].attrs["last_access"] for key in keys])
+        sizes = np.array([f[key].id.get_storage_size() for key in keys])
+
+        # Keep the most recently used entries that fit:
+        order = np.argsort(-last_access, kind="stable")
+        keep = np.ones((len(keys),), dtype=bool)
+        if self.max_entries is not None:
+            keep[order[self.max_entries:]] = False
+        if self.max_size is not None:
+            keep[order[np.cumsum(sizes[order]) > self.max_size]] = False
+
+        for key in np.array(keys)[~keep]:
+            del f[key]
+        return int((~keep).sum())
+
+    def _repack(self):
+        """ HDF5 does not release space of deleted datasets, rewrite the live entries to a fresh file """
+        tmp_path = self.cache_path + ".tmp"
+        with h5py.File(self.cache_path, "r") as src, h5py.File(tmp_path, "w") as dst:
+            for key in src.keys():
+                src.copy(src[key], dst, name=key)
+        os.replace(tmp_path, self.cache_path)
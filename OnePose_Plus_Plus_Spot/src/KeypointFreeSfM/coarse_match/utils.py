@@ -58,4 +58,27 @@ class Match2Pts2D(object):
                         logger.warning(f"no keypoints in image:{name}")
             return list(zip(names, kpts))
         else:
-            raise TypeError(f'{type(self).__name__} indices must be integers')
\ No newline at end of file
+            raise TypeError(f'{type(self).__name__} indices must be integers')
+
+def align_keypoints_to_existing(keypoints, existing_keypoints):
+    """
+    Make keypoint indices of already reconstructed images stable, used by incremental SfM:
+    keypoints in the existing model keep their index, newly matched ones are appended (score order).
+    Args:
+        keypoints: {name: {(x, y): (idx, score)}}
+        existing_keypoints: {name: np.ndarray[N*2]}
+    Returns:
+        keypoints: {name: {(x, y): (idx, score)}}
+    """
+    for name, kpt2id_score in keypoints.items():
+        if name not in existing_keypoints:
+            continue
+        aligned = {}
+        for kpt in map(tuple, existing_keypoints[name].astype(int)):
+            score = kpt2id_score[kpt][1] if kpt in kpt2id_score else 0.0
+            aligned[kpt] = (len(aligned), score)
+        for kpt, (_, score) in kpt2id_score.items():
+            if kpt not in aligned:
+                aligned[kpt] = (len(aligned), score)
+        keypoints[name] = aligned
+    return keypoints
@@ -31,6 +31,10 @@ class LoFTR_for_OnePose_Plus(nn.Module):
         self.loftr_fine = LocalFeatureTransformer(config["fine"])
         self.fine_matching = FineMatching()
 
+    def extract_backbone_features(self, image):
+        """ Coarse and fine backbone feature maps of image (N, 1, H, W), e.g. to keep features of reference images resident """
+        return self.backbone(image)
+
     def forward(self, data, **kwargs):
         """ 
         Update:
@@ -39,6 +43,8 @@ class LoFTR_for_OnePose_Plus(nn.Module):
                 'image1': (torch.Tensor): (N, 1, H, W)
                 'mask0'(optional) : (torch.Tensor): (N, H, W) '0' indicates a padded position
                 'mask1'(optional) : (torch.Tensor): (N, H, W)
+                'feats0'(optional) : (feat_c0, feat_f0) precomputed backbone features of image0, batch size N
+                'feats1'(optional) : (feat_c1, feat_f1) precomputed backbone features of image1, batch size N
             }
         """
         # 1. Local Feature CNN
@@ -47,7 +53,10 @@ class LoFTR_for_OnePose_Plus(nn.Module):
             'hw0_i': data['image0'].shape[2:], 'hw1_i': data['image1'].shape[2:]
         })
 
-        if data['hw0_i'] == data['hw1_i']:  # faster & better BN convergence
+        if 'feats0' in data or 'feats1' in data:  # skip backbone of images with precomputed features
+            feat_c0, feat_f0 = data['feats0'] if 'feats0' in data else self.backbone(data['image0'])
+            feat_c1, feat_f1 = data['feats1'] if 'feats1' in data else self.backbone(data['image1'])
+        elif data['hw0_i'] == data['hw1_i']:  # faster & better BN convergence
             feats_c, feats_f = self.backbone(torch.cat([data['image0'], data['image1']], dim=0))
             (feat_c0, feat_c1), (feat_f0, feat_f1) = feats_c.split(data['bs']), feats_f.split(data['bs'])
         else:  # handle different input shapes
@@ -58,10 +67,11 @@ class LoFTR_for_OnePose_Plus(nn.Module):
             'hw0_f': feat_f0.shape[2:], 'hw1_f': feat_f1.shape[2:]
         })
 
-        feat_c0_backbone = feat_c0.clone()
-        feat_c1_backbone = feat_c1.clone()
-        feat_f0_backbone = feat_f0.clone()
-        feat_f1_backbone = feat_f1.clone()
+        if kwargs.get("extract_coarse_feature", False) or kwargs.get("extract_fine_feature", False):
+            feat_c0_backbone = feat_c0.clone()
+            feat_c1_backbone = feat_c1.clone()
+            feat_f0_backbone = feat_f0.clone()
+            feat_f1_backbone = feat_f1.clone()
 
         if 'mkpts0_c' not in data:
             # 2. coarse-level loftr module
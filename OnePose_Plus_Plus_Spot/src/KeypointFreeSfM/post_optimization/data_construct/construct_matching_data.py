@@ -2,6 +2,13 @@ from torch.utils.data.dataset import Dataset
 import numpy as np
 import torch
 
+def coarse_matches_signature(mkpts0_c, mkpts1_c, mkpts0_idx):
+    """ Fine matches of a pair are reusable as long as its input coarse matches are unchanged """
+    return np.concatenate(
+        [mkpts0_c, mkpts1_c, mkpts0_idx.reshape(-1, 1)], axis=-1
+    ).astype(np.float64)  # N*5
+
+
 class MatchingPairData(Dataset):
     """
     Construct image pair for refinement matching
@@ -38,7 +45,14 @@ class MatchingPairData(Dataset):
     def __len__(self):
         return len(self.all_pairs)
 
-    def __getitem__(self, index):
+    def get_coarse_matches(self, index):
+        """
+        Coarse matches of a pair along the feature tracks of the left (key)frame, no image is loaded.
+        Returns:
+            left_kpts: np.array N*2
+            right_kpts: np.array N*2
+            left_kpts_idx: np.array N, index in left frame keypoints
+        """
         left_img_id, right_img_id = self.all_pairs[index]  # colmap id
 
         # Get coarse matches
@@ -82,6 +96,11 @@ class MatchingPairData(Dataset):
         left_kpts = np.stack(left_kpts, axis=0)  # N*2
         right_kpts = np.stack(right_kpts, axis=0)  # N*2
         left_kpts_idx = np.concatenate(left_kpts_idx)  # N*1
+        return left_kpts, right_kpts, left_kpts_idx
+
+    def __getitem__(self, index):
+        left_img_id, right_img_id = self.all_pairs[index]  # colmap id
+        left_kpts, right_kpts, left_kpts_idx = self.get_coarse_matches(index)
 
         # Get images information
         left_id = self.colmap_image_dataset.colmapID2frameID_dict[
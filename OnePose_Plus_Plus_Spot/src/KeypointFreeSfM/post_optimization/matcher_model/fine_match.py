@@ -11,13 +11,19 @@ def fine_matcher(
     matching_pairs_dataset,
     use_ray=False,
     verbose=True,
+    pair_ids=None,
 ):
+    """
+    pair_ids[optional]: only match these pairs of matching_pairs_dataset, all pairs by default
+    """
     matcher = build_model(
         cfgs["model"]
     )
 
+    pair_ids = np.arange(len(matching_pairs_dataset)) if pair_ids is None else np.asarray(pair_ids, dtype=int)
+
     if not use_ray:
-        subset_ids = range(len(matching_pairs_dataset))
+        subset_ids = pair_ids
         fine_match_results = matchWorker(
             matching_pairs_dataset,
             subset_ids,
@@ -39,14 +45,17 @@ def fine_matcher(
             )
 
         pb = (
-            ProgressBar(len(matching_pairs_dataset), "Matching image pairs...")
+            ProgressBar(len(pair_ids), "Matching image pairs...")
             if verbose
             else None
         )
-        all_subset_ids = chunk_index(
-            len(matching_pairs_dataset),
-            math.ceil(len(matching_pairs_dataset) / cfg_ray["n_workers"]),
-        )
+        all_subset_ids = [
+            pair_ids[sub_ids]
+            for sub_ids in chunk_index(
+                len(pair_ids),
+                math.ceil(len(pair_ids) / cfg_ray["n_workers"]),
+            )
+        ]
         obj_refs = [
             matchWorker_ray_wrapper.remote(
                 matching_pairs_dataset,
@@ -6,6 +6,7 @@ from ray.actor import ActorHandle
 from tqdm import tqdm
 
 from src.KeypointFreeSfM.loftr_for_sfm import LoFTR_for_OnePose_Plus, default_cfg
+from ..data_construct.construct_matching_data import coarse_matches_signature
 
 
 def build_model(args):
@@ -127,6 +128,9 @@ def matchWorker(
             "feature_c1": feature_c1,
             "feature0": feature0,
             "feature1": feature1,
+            "coarse_signature": coarse_matches_signature(
+                data["mkpts0_c"].numpy(), data["mkpts1_c"].numpy(), data["mkpts0_idx"].numpy()
+            ),  # input coarse matches (before clipping), to reuse results in incremental SfM
         }
         if pba is not None:
             pba.update.remote(1)
@@ -3,6 +3,7 @@ import os.path as osp
 
 os.environ["TORCH_USE_RTLD_GLOBAL"] = "TRUE"  # important for DeepLM module
 from loguru import logger
+import numpy as np
 import ray
 from src.utils.data_io import load_obj, save_obj
 
@@ -11,6 +12,7 @@ from .data_construct import (
     MatchingPairData,
     ConstructOptimizationData,
 )
+from .data_construct.construct_matching_data import coarse_matches_signature
 from .matcher_model import *
 from .optimizer.optimizer import Optimizer
 from .feature_aggregation import feature_aggregation_and_update
@@ -69,7 +71,12 @@ def post_optimization(
     vis3d_pth=None,
     verbose=True,
     args=None,
+    reuse_fine_matches=False,
 ):
+    """
+    reuse_fine_matches: incremental SfM, keep the saved fine matches of pairs whose coarse matches
+        are unchanged and only refine the pairs along new or extended feature tracks.
+    """
     # Overwrite some configs
     cfgs["coarse_recon_data"]["verbose"] = verbose
     cfgs["optimizer"]["verbose"] = verbose
@@ -107,7 +114,25 @@ def post_optimization(
 
     # 2D point refinement:
     save_path = osp.join(match_out_pth.rsplit("/", 2)[0], "fine_matches.pkl")
-    if not osp.exists(save_path) or cfgs["fine_match_debug"]:
+    if reuse_fine_matches and osp.exists(save_path):
+        fine_match_results_dict, affected_pair_ids = reuse_fine_match_results(
+            matching_pairs_dataset, load_obj(save_path)
+        )
+        logger.info(
+            f"{len(fine_match_results_dict)} fine matched pairs reused, {len(affected_pair_ids)} pairs affected by new tracks"
+        )
+        if len(affected_pair_ids) != 0:
+            fine_match_results_dict.update(
+                fine_matcher(
+                    cfgs["fine_matcher"],
+                    matching_pairs_dataset,
+                    use_ray=fine_match_use_ray,
+                    verbose=verbose,
+                    pair_ids=affected_pair_ids,
+                )
+            )
+        save_obj(fine_match_results_dict, save_path)
+    elif not osp.exists(save_path) or cfgs["fine_match_debug"]:
         logger.info(f"2D points refinement begin!")
         fine_match_results_dict = fine_matcher(
             cfgs["fine_matcher"],
@@ -150,4 +175,25 @@ def post_optimization(
             verbose=verbose,
         )
 
-    return state
\ No newline at end of file
+    return state
+
+
+def reuse_fine_match_results(matching_pairs_dataset, saved_results_dict):
+    """
+    Split pairs into the ones whose saved fine matches are still valid and the ones to refine again.
+    Returns:
+        reused_results_dict: {pair_name: results}
+        affected_pair_ids: list of pair index in matching_pairs_dataset
+    """
+    reused_results_dict = {}
+    affected_pair_ids = []
+    for pair_id, (frameID0, frameID1) in enumerate(matching_pairs_dataset.all_pairs):
+        pair_name = "-".join([str(frameID0), str(frameID1)])
+        saved_results = saved_results_dict.get(pair_name, None)
+        if saved_results is not None and "coarse_signature" in saved_results:
+            signature = coarse_matches_signature(*matching_pairs_dataset.get_coarse_matches(pair_id))
+            if np.array_equal(signature, saved_results["coarse_signature"]):
+                reused_results_dict[pair_name] = saved_results
+                continue
+        affected_pair_ids.append(pair_id)
+    return reused_results_dict, affected_pair_ids
@@ -28,10 +28,15 @@ class OnePosePlusDataModule(LightningDataModule):
         self.train_percent = kwargs["train_percent"]
         self.val_percent = kwargs["val_percent"]
         self.train_image_warp_adapt = kwargs['train_image_warp_adapt']
+        self.sparse_gt = kwargs.get('sparse_gt', True)
         # 3D part
         self.shape3d_train = kwargs["shape3d_train"]
         self.shape3d_val = kwargs["shape3d_val"]
         self.load_3d_coarse = kwargs["load_3d_coarse"]
+        self.cache_anno3d = kwargs.get("cache_anno3d", True)
+        self.anno3d_cache_dir = kwargs.get("anno3d_cache_dir", None)
+        self.train_image_store = kwargs.get("train_image_store", None)
+        self.val_image_store = kwargs.get("val_image_store", None)
         # 2D part
         self.img_pad = kwargs["img_pad"]
         self.img_resize = kwargs["img_resize"]
@@ -76,7 +81,11 @@ class OnePosePlusDataModule(LightningDataModule):
             load_pose_gt=True,
             load_3d_coarse_feature=self.load_3d_coarse,
             image_warp_adapt=self.train_image_warp_adapt,
-            augmentor=self.augmentor
+            augmentor=self.augmentor,
+            sparse_gt=self.sparse_gt,
+            cache_anno3d=self.cache_anno3d,
+            anno3d_cache_dir=self.anno3d_cache_dir,
+            image_store=self.train_image_store,
         )
         print("=> Read train anno file: ", self.train_anno_file)
 
@@ -91,7 +100,10 @@ class OnePosePlusDataModule(LightningDataModule):
             percent=self.val_percent,
             split='val',
             load_pose_gt=True,
-            load_3d_coarse_feature=self.load_3d_coarse
+            load_3d_coarse_feature=self.load_3d_coarse,
+            cache_anno3d=self.cache_anno3d,
+            anno3d_cache_dir=self.anno3d_cache_dir,
+            image_store=self.val_image_store,
         )
 
         self.data_train = train_set
@@ -13,8 +13,11 @@ from torch.utils.data import Dataset
 
 from kornia import homography_warp, normalize_homography, normal_transform_pixel
 from src.utils.data_io import read_grayscale
+from src.utils.image_store import PackedImageStore
+from src.utils.frame_index import load_frame_matrix
 from src.utils import data_utils
 from src.utils.sample_homo import sample_homography_sap
+from src.datasets.anno3d_cache import Anno3DCache
 
 
 class OnePosePlusDataset(Dataset):
@@ -32,7 +35,11 @@ class OnePosePlusDataset(Dataset):
         load_pose_gt=False,
         load_3d_coarse_feature=False,
         image_warp_adapt=False,
-        augmentor=None
+        augmentor=None,
+        sparse_gt=True,
+        cache_anno3d=True,
+        anno3d_cache_dir=None,
+        image_store=None,
     ):
         super(Dataset, self).__init__()
 
@@ -52,13 +59,32 @@ class OnePosePlusDataset(Dataset):
         self.load_3d_coarse = load_3d_coarse_feature
         self.shape3d = shape3d
 
+        # Objects' 3D annotations are converted once to memory-mapped arrays shared by all workers
+        if cache_anno3d:
+            self.anno3d_cache = Anno3DCache(
+                shape3d, load_3d_coarse=load_3d_coarse_feature, cache_dir=anno3d_cache_dir
+            )
+            annos = self.coco.loadAnns(self.coco.getAnnIds(imgIds=self.anns.tolist()))
+            self.anno3d_cache.build([anno["avg_anno3d_file"] for anno in annos])
+        else:
+            self.anno3d_cache = None
+
         # 2D query image part
         self.img_pad = img_pad
         self.img_resize = img_resize
         self.df = df
         self.coarse_scale = coarse_scale
+        # Packed images (with intrinsics and poses) written by merge.py pack_images, None: read PNG files
+        self.image_store = PackedImageStore(image_store) if image_store is not None else None
 
         self.augmentor = augmentor
+        if self.image_store is not None and augmentor is not None:
+            # Augmentors work on the full resolution colour image, only intrinsics and poses come from the store
+            logger.warning(
+                f"{image_store} keeps resized grayscale images only, query images are read from PNG files with augmentor"
+            )
+        # GT correspondences as per 3D point grid ids instead of dense [n_pointcloud, n_coarse_grid] matrices
+        self.sparse_gt = sparse_gt
 
     def read_anno2d(self, anno2d_file):
         """ Read (and pad) 2d info"""
@@ -81,6 +107,11 @@ class OnePosePlusDataset(Dataset):
         load_3d_coarse=False,
     ):
         """ Read(and pad) 3d info"""
+        if self.anno3d_cache is not None:
+            return self.read_anno3d_cached(
+                avg_anno3d_file, pad=pad, assignmatrix=assignmatrix, load_3d_coarse=load_3d_coarse
+            )
+
         avg_data = np.load(avg_anno3d_file)
 
         keypoints3d = torch.Tensor(avg_data["keypoints3d"])  # [m, 3]
@@ -171,26 +202,83 @@ class OnePosePlusDataset(Dataset):
             assignmatrix,  # Update assignmatrix
         )
 
+    def read_anno3d_cached(
+        self,
+        avg_anno3d_file,
+        pad=True,
+        assignmatrix=None,
+        load_3d_coarse=False,
+    ):
+        """
+        Same as read_anno3d, from the shared 3D anno cache.
+        Features are stored padded to self.shape3d, only slice or gather them here.
+        """
+        entry = self.anno3d_cache.get(avg_anno3d_file)
+        keypoints3d = torch.from_numpy(entry["keypoints3d"])  # [m, 3]
+        n_points = keypoints3d.shape[0]
+
+        index = None  # Gather features by index, otherwise keep the first n_target
+        n_target = self.shape3d
+        if not pad:
+            n_target = n_points
+        elif self.split == "train":
+            if assignmatrix is not None:
+                (
+                    keypoints3d,
+                    assignmatrix,
+                    index,
+                ) = data_utils.pad_keypoints3d_according_to_assignmatrix(
+                    keypoints3d, self.shape3d, assignmatrix=assignmatrix
+                )
+            else:
+                keypoints3d = data_utils.pad_keypoints3d_top_n(keypoints3d, self.shape3d)
+        else:
+            keypoints3d, padding_index = data_utils.pad_keypoints3d_random(
+                keypoints3d, self.shape3d
+            )
+            if n_points > self.shape3d:
+                index = padding_index
+            else:
+                n_target = n_points
+
+        def select(descriptors, scores):
+            if index is not None:
+                index_np = index.numpy()
+                return torch.from_numpy(descriptors[:, index_np]), torch.from_numpy(scores[index_np])
+            return torch.from_numpy(descriptors[:, :n_target]), torch.from_numpy(scores[:n_target])
+
+        avg_descriptors3d, avg_scores = select(entry["descriptors3d"], entry["scores3d"])
+        if load_3d_coarse:
+            avg_coarse_descriptors3d, _ = select(
+                entry["coarse_descriptors3d"], entry["coarse_scores3d"]
+            )
+        else:
+            avg_coarse_descriptors3d = None
+
+        return (
+            keypoints3d,
+            avg_descriptors3d,
+            avg_coarse_descriptors3d,
+            avg_scores,
+            assignmatrix,  # Update assignmatrix
+        )
+
     def build_assignmatrix(
-        self, keypoints2D_coarse, keypoints2D_fine, assign_matrix, pad=True
+        self, keypoints2D_coarse, keypoints2D_fine, assign_matrix, pad=True, sparse=False
     ):
         """
         Build assign matrix for coarse and fine
         Coarse assign matrix: store 0 or 1
         Fine matrix: store corresponding 2D fine location in query image of the matched coarse grid point (N*M*2)
         Reshape assign matrix (from 2xk to nxm)
+
+        sparse: each 3D point matches at most one coarse grid point, instead return
+            spv_j_ids: [n_pointcloud] coarse grid id matched by each 3D point (-1: no match)
+            spv_fine_location: [n_pointcloud, 2] its 2D fine location in query image (-50: no match)
         """
         assign_matrix = assign_matrix.long()
 
         if pad:
-            conf_matrix = torch.zeros(
-                self.shape3d, self.n_query_coarse_grid, dtype=torch.int16
-            )  # [n_pointcloud, n_coarse_grid]
-
-            fine_location_matrix = torch.full(
-                (self.shape3d, self.n_query_coarse_grid, 2), -50, dtype=torch.float
-            )
-
             # Padding
             valid = assign_matrix[1] < self.shape3d
             assign_matrix = assign_matrix[:, valid]
@@ -222,11 +310,26 @@ class OnePosePlusDataset(Dataset):
             )
             j_ids = j_ids.long()
 
-            invalid_mask = j_ids > conf_matrix.shape[1]
+            invalid_mask = j_ids >= self.n_query_coarse_grid
             j_ids = j_ids[~invalid_mask]
             assign_matrix = assign_matrix[:, ~invalid_mask]
             keypoints2D_fine_selected = keypoints2D_fine_selected[~invalid_mask]
 
+            if sparse:
+                spv_j_ids = torch.full((self.shape3d,), -1, dtype=torch.long)
+                spv_fine_location = torch.full((self.shape3d, 2), -50, dtype=torch.float)
+                spv_j_ids[assign_matrix[1]] = j_ids
+                spv_fine_location[assign_matrix[1]] = keypoints2D_fine_selected
+                return spv_j_ids, spv_fine_location
+
+            conf_matrix = torch.zeros(
+                self.shape3d, self.n_query_coarse_grid, dtype=torch.int16
+            )  # [n_pointcloud, n_coarse_grid]
+
+            fine_location_matrix = torch.full(
+                (self.shape3d, self.n_query_coarse_grid, 2), -50, dtype=torch.float
+            )
+
             conf_matrix[assign_matrix[1], j_ids] = 1
             fine_location_matrix[assign_matrix[1], j_ids] = keypoints2D_fine_selected
 
@@ -236,15 +339,19 @@ class OnePosePlusDataset(Dataset):
         return conf_matrix, fine_location_matrix
 
     def get_intrin_by_color_pth(self, img_path):
+        if self.image_store is not None and img_path in self.image_store:
+            return self.image_store.get_intrinsic(img_path)
         img_ext = osp.splitext(img_path)[1]
         intrin_path = img_path.replace("/color/", "/intrin_ba/").replace(img_ext, ".txt")
-        K_crop = torch.from_numpy(np.loadtxt(intrin_path))  # [3*3]
+        K_crop = torch.from_numpy(load_frame_matrix(intrin_path))  # [3*3]
         return K_crop
 
     def get_gt_pose_by_color_pth(self, img_path):
+        if self.image_store is not None and img_path in self.image_store:
+            return self.image_store.get_pose(img_path)
         img_ext = osp.splitext(img_path)[1]
         gt_pose_path = img_path.replace("/color/", "/poses_ba/").replace(img_ext, ".txt")
-        pose_gt = torch.from_numpy(np.loadtxt(gt_pose_path))  # [4*4]
+        pose_gt = torch.from_numpy(load_frame_matrix(gt_pose_path))  # [4*4]
         return pose_gt
 
     def read_anno(self, img_id, image_warp_adapt=False):
@@ -257,7 +364,11 @@ class OnePosePlusDataset(Dataset):
 
         color_path = self.coco.loadImgs(int(img_id))[0]["img_file"]
 
-        query_img, query_img_scale, query_img_mask = read_grayscale(
+        if self.image_store is not None and color_path in self.image_store and self.augmentor is None:
+            read_fn = self.image_store.read_grayscale
+        else:
+            read_fn = read_grayscale
+        query_img, query_img_scale, query_img_mask = read_fn(
             color_path,
             resize=self.img_resize,
             pad_to=self.img_resize if self.img_pad else None,
@@ -432,16 +543,27 @@ class OnePosePlusDataset(Dataset):
 
             keypoints2d_fine[assign_matrix[0, :]] = mkpts_proj
 
-            (conf_matrix, fine_location_matrix) = self.build_assignmatrix(
-                keypoints2d_coarse, keypoints2d_fine, assign_matrix, pad=self.pad
-            )
+            if self.sparse_gt:
+                spv_j_ids, spv_fine_location = self.build_assignmatrix(
+                    keypoints2d_coarse, keypoints2d_fine, assign_matrix, pad=self.pad, sparse=True
+                )
+                data.update(
+                    {
+                        "spv_j_ids": spv_j_ids,  # [n_point_cloud] Used for coarse GT
+                        "spv_fine_location": spv_fine_location,  # [n_point_cloud, 2] (x,y)
+                    }
+                )
+            else:
+                (conf_matrix, fine_location_matrix) = self.build_assignmatrix(
+                    keypoints2d_coarse, keypoints2d_fine, assign_matrix, pad=self.pad
+                )
 
-            data.update(
-                {
-                    "conf_matrix_gt": conf_matrix,  # [n_point_cloud, n_query_coarse_grid] Used for coarse GT
-                    "fine_location_matrix_gt": fine_location_matrix,  # [n_point_cloud, n_query_coarse_grid, 2] (x,y)
-                }
-            )
+                data.update(
+                    {
+                        "conf_matrix_gt": conf_matrix,  # [n_point_cloud, n_query_coarse_grid] Used for coarse GT
+                        "fine_location_matrix_gt": fine_location_matrix,  # [n_point_cloud, n_query_coarse_grid, 2] (x,y)
+                    }
+                )
 
         return data
 
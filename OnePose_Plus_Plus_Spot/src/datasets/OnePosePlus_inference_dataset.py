@@ -7,6 +7,9 @@ from torch.utils.data import Dataset
 
 from src.utils.data_io import read_grayscale
 from src.utils import data_utils
+from src.utils.frame_index import load_frame_matrix, frame_matrix_exists
+
+SHARED_3D_KEYS = ["keypoints3d", "descriptors3d_db", "descriptors3d_coarse_db"]
 
 class OnePosePlusInferenceDataset(Dataset):
     def __init__(
@@ -24,6 +27,7 @@ class OnePosePlusInferenceDataset(Dataset):
         n_images=None,  # Used for debug
         demo_mode=False,
         preload=False,
+        device="cuda",
     ) -> None:
         super().__init__()
 
@@ -44,6 +48,7 @@ class OnePosePlusInferenceDataset(Dataset):
 
         # Load pointcloud and point feature
         avg_anno_3d_path = self.get_default_paths(sfm_dir)
+        self.avg_anno_3d_path = avg_anno_3d_path
         (
             self.keypoints3d,
             self.avg_descriptors3d,
@@ -54,9 +59,12 @@ class OnePosePlusInferenceDataset(Dataset):
             avg_anno_3d_path, pad=self.pad, load_3d_coarse=load_3d_coarse
         )
 
-        # Preload 3D features to cuda:
+        # Preload 3D features to device:
         if preload:
-            self.keypoints3d, self.avg_descriptors3d, self.avg_coarse_descriptors3d = map(lambda x: x.cuda(), [self.keypoints3d, self.avg_descriptors3d, self.avg_coarse_descriptors3d])
+            self.keypoints3d, self.avg_descriptors3d, self.avg_coarse_descriptors3d = map(
+                lambda x: x.to(device) if x is not None else None,
+                [self.keypoints3d, self.avg_descriptors3d, self.avg_coarse_descriptors3d],
+            )
 
     def get_default_paths(self, sfm_model_dir):
         anno_dir = osp.join(sfm_model_dir, f"anno")
@@ -81,8 +89,8 @@ class OnePosePlusInferenceDataset(Dataset):
 
         img_ext = osp.splitext(img_path)[1]
         intrin_path = img_path.replace("/"+image_dir_name+"/", "/"+intrin_name+"/").replace(img_ext, ".txt")
-        assert osp.exists(intrin_path), f"{intrin_path}"
-        K_crop = torch.from_numpy(np.loadtxt(intrin_path))  # [3*3]
+        assert frame_matrix_exists(intrin_path), f"{intrin_path}"
+        K_crop = torch.from_numpy(load_frame_matrix(intrin_path))  # [3*3]
         return K_crop
 
     def get_intrin_original_by_color_pth(self, img_path):
@@ -91,19 +99,19 @@ class OnePosePlusInferenceDataset(Dataset):
         img_ext = osp.splitext(img_path)[1]
         try:
             intrin_path = img_path.replace("/"+image_dir_name+"/", "/intrin/").replace(img_ext, ".txt")
-            assert osp.exists(intrin_path), f"{intrin_path}"
+            assert frame_matrix_exists(intrin_path), f"{intrin_path}"
         except:
             intrin_path = img_path.replace("/"+image_dir_name+"/", "/intrin_ba/").replace(img_ext, ".txt")
-            assert osp.exists(intrin_path), f"{intrin_path}"
-        K = torch.from_numpy(np.loadtxt(intrin_path))  # [3*3]
+            assert frame_matrix_exists(intrin_path), f"{intrin_path}"
+        K = torch.from_numpy(load_frame_matrix(intrin_path))  # [3*3]
         return K
 
     def get_gt_pose_by_color_pth(self, img_path):
         image_dir_name = osp.basename(osp.dirname(img_path))
         img_ext = osp.splitext(img_path)[1]
         gt_pose_path = img_path.replace("/" + image_dir_name + "/", "/poses_ba/").replace(img_ext, ".txt")
-        assert osp.exists(gt_pose_path), f"{gt_pose_path}"
-        pose_gt = torch.from_numpy(np.loadtxt(gt_pose_path))  # [4*4]
+        assert frame_matrix_exists(gt_pose_path), f"{gt_pose_path}"
+        pose_gt = torch.from_numpy(load_frame_matrix(gt_pose_path))  # [4*4]
         return pose_gt
 
     def read_anno3d(
@@ -178,7 +186,7 @@ class OnePosePlusInferenceDataset(Dataset):
         self.query_img_scale = query_img_scale
         
         image_dir_name = osp.basename(osp.dirname(image_path))
-        data = {}
+        data = {"anno_3d_path": self.avg_anno_3d_path}  # key of the model's 3D feature cache
 
         if self.avg_coarse_descriptors3d is not None:
             data.update({
@@ -220,3 +228,21 @@ class OnePosePlusInferenceDataset(Dataset):
             )
 
         return data
+
+    def get_batch(self, indices):
+        """
+        Load several query images as one batch for batched inference.
+        Per-query entries are concatenated along batch dim, while the 3D entries
+        (keypoints3d, descriptors3d_db, descriptors3d_coarse_db) are kept once with
+        batch dim 1 and shared by all queries (broadcast inside the model).
+        """
+        items = [self[index] for index in indices]
+        batch = {}
+        for k, v in items[0].items():
+            if k in SHARED_3D_KEYS or k == "anno_3d_path":
+                batch[k] = v
+            elif isinstance(v, torch.Tensor):
+                batch[k] = torch.cat([item[k] for item in items], dim=0)
+            else:
+                batch[k] = [item[k] for item in items]
+        return batch
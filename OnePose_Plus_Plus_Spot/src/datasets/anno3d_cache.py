@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import os.path as osp
+from loguru import logger
+
+
+def coarse_anno3d_path(avg_anno3d_file):
+    return osp.splitext(avg_anno3d_file)[0] + "_coarse" + osp.splitext(avg_anno3d_file)[1]
+
+
+class Anno3DCache():
+    """
+    Per-object cache of the averaged 3D annotation (anno_3d_average.npz and its _coarse counterpart).
+
+    All images of one object share the same 3D annotation, so each object is converted once
+    (in the main process, before DataLoader workers start) to plain .npy files which every worker
+    memory-maps. The pages live in the OS page cache and are shared by all workers and processes.
+    Descriptors and scores are stored already padded to `shape3d` (ones / zeros), which is the
+    deterministic part of the padding, so that per item only a slice or a gather is left.
+
+    Layout: <cache_root>/pad<shape3d>/{keypoints3d, descriptors3d, scores3d, ...}.npy, with
+    cache_root defaulting to `anno_3d_average_cache` next to the npz. Entries older than the npz are rebuilt.
+    """
+
+    def __init__(self, shape3d, load_3d_coarse=False, cache_dir=None):
+        self.shape3d = shape3d
+        self.load_3d_coarse = load_3d_coarse
+        self.cache_dir = cache_dir
+        self._entries = {}  # per process, filled lazily
+
+    def entry_dir(self, avg_anno3d_file):
+        if self.cache_dir is None:
+            cache_root = osp.splitext(avg_anno3d_file)[0] + "_cache"
+        else:
+            obj_dir = osp.dirname(osp.abspath(avg_anno3d_file)).strip(os.sep).replace(os.sep, "_")
+            cache_root = osp.join(self.cache_dir, obj_dir)
+        return osp.join(cache_root, f"pad{self.shape3d}")
+
+    def array_names(self):
+        names = ["keypoints3d", "descriptors3d", "scores3d"]
+        if self.load_3d_coarse:
+            names += ["coarse_descriptors3d", "coarse_scores3d"]
+        return names
+
+    def is_valid(self, avg_anno3d_file):
+        entry_dir = self.entry_dir(avg_anno3d_file)
+        done_file = osp.join(entry_dir, "done")
+        if not osp.exists(done_file):
+            return False
+        if not all(osp.exists(osp.join(entry_dir, f"{name}.npy")) for name in self.array_names()):
+            return False
+        src_files = [avg_anno3d_file] + ([coarse_anno3d_path(avg_anno3d_file)] if self.load_3d_coarse else [])
+        return all(osp.getmtime(done_file) >= osp.getmtime(src_file) for src_file in src_files)
+
+    def build(self, avg_anno3d_files):
+        """ Convert all objects missing in the cache, call from the main process """
+        avg_anno3d_files = sorted(set(avg_anno3d_files))
+        n_built = 0
+        for avg_anno3d_file in avg_anno3d_files:
+            if not self.is_valid(avg_anno3d_file):
+                self._build_entry(avg_anno3d_file)
+                n_built += 1
+        logger.info(f"3D anno cache: {n_built} objects converted, {len(avg_anno3d_files) - n_built} reused")
+
+    def _build_entry(self, avg_anno3d_file):
+        entry_dir = self.entry_dir(avg_anno3d_file)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        avg_data = np.load(avg_anno3d_file)
+        arrays = {
+            "keypoints3d": avg_data["keypoints3d"],
+            "descriptors3d": avg_data["descriptors3d"],
+            "scores3d": avg_data["scores3d"],
+        }
+        if self.load_3d_coarse:
+            avg_coarse_data = np.load(coarse_anno3d_path(avg_anno3d_file))
+            arrays.update(
+                {
+                    "coarse_descriptors3d": avg_coarse_data["descriptors3d"],
+                    "coarse_scores3d": avg_coarse_data["scores3d"],
+                }
+            )
+
+        n_pad = self.shape3d - arrays["keypoints3d"].shape[0]
+        for name, array in arrays.items():
+            array = np.asarray(array, dtype=np.float32)
+            # Same constant padding as data_utils.pad_features3d_*:
+            if n_pad > 0 and name.endswith("scores3d"):  # [m, 1]
+                array = np.concatenate([array, np.zeros((n_pad, array.shape[1]), np.float32)], axis=0)
+            elif n_pad > 0 and name.endswith("descriptors3d"):  # [dim, m]
+                array = np.concatenate([array, np.ones((array.shape[0], n_pad), np.float32)], axis=1)
+
+            # Atomic, other ranks may build the same entry concurrently
+            tmp_path = osp.join(entry_dir, f"{name}.{os.getpid()}.tmp.npy")
+            np.save(tmp_path, np.ascontiguousarray(array))
+            os.replace(tmp_path, osp.join(entry_dir, f"{name}.npy"))
+
+        with open(osp.join(entry_dir, "done"), "w") as f:
+            f.write(osp.abspath(avg_anno3d_file))
+
+    def get(self, avg_anno3d_file):
+        """
+        Returns:
+            entry (dict): memory-mapped np.ndarray
+                'keypoints3d': [m, 3]
+                'descriptors3d': [dim, max(m, shape3d)]
+                'scores3d': [max(m, shape3d), 1]
+                ('coarse_descriptors3d', 'coarse_scores3d' if load_3d_coarse)
+        """
+        entry = self._entries.get(avg_anno3d_file, None)
+        if entry is None:
+            if not self.is_valid(avg_anno3d_file):
+                # Not built by the main process (e.g. new file), build in place
+                self._build_entry(avg_anno3d_file)
+            entry_dir = self.entry_dir(avg_anno3d_file)
+            # Copy-on-write mapping: writable views for torch.from_numpy, file never modified
+            entry = {
+                name: np.load(osp.join(entry_dir, f"{name}.npy"), mmap_mode="c")
+                for name in self.array_names()
+            }
+            self._entries[avg_anno3d_file] = entry
+        return entry
@@ -9,7 +9,9 @@ import torch
 from src.datasets.OnePosePlus_inference_dataset import OnePosePlusInferenceDataset
 from src.utils.ray_utils import ProgressBar, chunks, chunk_index, split_dict
 from src.models.OnePosePlus.OnePosePlusModel import OnePosePlus_model
+from src.utils.misc import file_hash
 from src.utils.metric_utils import aggregate_metrics
+from src.utils.model_io import resolve_device
 
 from .inference_OnePosePlus_worker import (
     inference_onepose_plus_worker, inference_onepose_plus_worker_ray_wrapper
@@ -35,6 +37,7 @@ def build_model(model_configs, ckpt_path):
 
     match_model.load_state_dict(state_dict, strict=True)
     match_model.eval()
+    match_model.ckpt_hash = file_hash(ckpt_path)
     return match_model
 
 def inference_onepose_plus(
@@ -57,6 +60,12 @@ def inference_onepose_plus(
         n_images=None
     )
     match_model = build_model(cfg['model']["OnePosePlus"], cfg['model']['pretrained_ckpt'])
+    # Number of query images stacked per forward pass:
+    batch_size = cfg.datamodule.get("inference_batch_size", 1)
+    # Inference device ("cuda" / "cpu" / "auto") and number of intra-op threads on CPU:
+    device = resolve_device(cfg.get("device", "cuda"))
+    num_threads = cfg.get("cpu_num_threads", None)
+    n_gpus_per_worker = args["ray"]["n_gpus_per_worker"] if device.type == "cuda" else 0
 
     # Run matching
     if use_ray:
@@ -67,7 +76,7 @@ def inference_onepose_plus(
         else:
             ray.init(
                 num_cpus=math.ceil(cfg_ray["n_workers"] * cfg_ray["n_cpus_per_worker"]),
-                num_gpus=math.ceil(cfg_ray["n_workers"] * cfg_ray["n_gpus_per_worker"]),
+                num_gpus=math.ceil(cfg_ray["n_workers"] * n_gpus_per_worker),
                 local_mode=cfg_ray["local_mode"],
                 ignore_reinit_error=True,
             )
@@ -83,13 +92,16 @@ def inference_onepose_plus(
         all_subset_ids = all_subset_ids
 
         obj_refs = [
-            inference_onepose_plus_worker_ray_wrapper.remote(
+            inference_onepose_plus_worker_ray_wrapper.options(num_gpus=n_gpus_per_worker).remote(
                 dataset,
                 match_model,
                 subset_ids,
                 cfg['model'],
                 pb.actor if pb is not None else None,
                 verbose=verbose,
+                batch_size=batch_size,
+                device=device,
+                num_threads=num_threads,
             )
             for subset_ids in all_subset_ids
         ]
@@ -100,7 +112,9 @@ def inference_onepose_plus(
         logger.info("Matcher finish!")
     else:
         all_ids = np.arange(0, len(dataset))
-        results = inference_onepose_plus_worker(dataset, match_model, all_ids, cfg['model'], verbose=verbose)
+        results = inference_onepose_plus_worker(
+            dataset, match_model, all_ids, cfg['model'], verbose=verbose, batch_size=batch_size, device=device, num_threads=num_threads
+        )
         logger.info("Match and compute pose error finish!")
     
     # Parse results:
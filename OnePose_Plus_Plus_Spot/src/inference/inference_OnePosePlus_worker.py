@@ -1,16 +1,102 @@
 import ray
 import torch
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from src.utils.metric_utils import compute_query_pose_errors
+from src.utils.metric_utils import compute_query_pose_errors, ransac_PnP, ransac_PnP_tasks
+from src.utils.model_io import resolve_device, to_device, prepare_inference_model
+from src.datasets.OnePosePlus_inference_dataset import SHARED_3D_KEYS
+
+
+PER_FRAME_KEYS = ["query_image_scale", "query_intrinsic", "query_intrinsic_origin", "query_pose_gt"]
+PER_MATCH_KEYS = ["mkpts_3d_db", "mkpts_query_f", "mconf"]
+RESULT_KEYS = ["bs", "q_hw_i", "m_bids", "query_image_path"] + PER_FRAME_KEYS + PER_MATCH_KEYS
+
+
+def split_batch_by_frame(data):
+    """
+    Split the output of a batched forward pass into per-frame data dicts,
+    matches are assigned to their frame by `m_bids`.
+    """
+    m_bids = data["m_bids"]
+    frames_data = []
+    for bs in range(data["bs"]):
+        mask = m_bids == bs
+        frame_data = {
+            "bs": 1,
+            "q_hw_i": data["q_hw_i"],
+            "m_bids": torch.zeros_like(m_bids[mask]),
+            "query_image_path": data["query_image_path"][bs],
+        }
+        frame_data.update({k: data[k][mask] for k in PER_MATCH_KEYS})
+        frame_data.update({k: data[k][bs : bs + 1] for k in PER_FRAME_KEYS if k in data})
+        frames_data.append(frame_data)
+    return frames_data
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def extract_matches(data, match_model, metrics_configs):
     # 1. Run inference
     match_model(data)
 
     # 2. Compute metrics
-    compute_query_pose_errors(data, metrics_configs)
+    return gather_result(data, metrics_configs)
+
+
+@torch.inference_mode()
+def extract_matches_batched(data, match_model, metrics_configs):
+    # 1. Run inference on all stacked query images at once
+    match_model(data)
+
+    # 2. Compute metrics per frame
+    return [
+        gather_result(frame_data, metrics_configs)
+        for frame_data in split_batch_by_frame(data)
+    ]
+
+
+class PnPPool():
+    """
+    Solve the RANSAC PnP of the evaluated frames in `n_workers` processes, while the main process runs the
+    forward passes of the next frames. OpenCV's RANSAC stops early once the inlier ratio observed so far reaches
+    the 0.99 confidence, so the per-frame cost already adapts to the frame; frames are independent, so spreading
+    them over processes gives the same poses and inliers as the serial loop.
+    Results are returned in submission order.
+    """
+
+    def __init__(self, n_workers, metrics_configs):
+        # spawn: do not fork a process holding a CUDA context
+        self.executor = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.max_pending = 2 * n_workers  # bounds the frames kept in memory
+        self.metrics_configs = metrics_configs
+        self.pending = deque()
+
+    def submit(self, frame_data):
+        """ frame_data: matches of one frame (bs=1), returns the results of the frames finished meanwhile """
+        frame_data = {
+            k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in frame_data.items() if k in RESULT_KEYS
+        }
+        task = ransac_PnP_tasks(frame_data, self.metrics_configs)[0]
+        self.pending.append((frame_data, self.executor.submit(ransac_PnP, **task)))
+        results = []
+        while len(self.pending) > self.max_pending:
+            results.append(self._gather_oldest())
+        return results
+
+    def drain(self):
+        return [self._gather_oldest() for _ in range(len(self.pending))]
+
+    def _gather_oldest(self):
+        frame_data, future = self.pending.popleft()
+        return gather_result(frame_data, self.metrics_configs, pnp_results=[future.result()])
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def gather_result(data, metrics_configs, pnp_results=None):
+    compute_query_pose_errors(data, metrics_configs, pnp_results=pnp_results)
 
     R_errs = data["R_errs"]
     t_errs = data["t_errs"]
@@ -38,32 +124,96 @@ def extract_matches(data, match_model, metrics_configs):
 
 
 def inference_onepose_plus_worker(
-    dataset, match_model, subset_ids, cfgs, pba=None, verbose=True
+    dataset, match_model, subset_ids, cfgs, pba=None, verbose=True, batch_size=1, device="cuda", num_threads=None
+):
+    device = resolve_device(device)
+    match_model = prepare_inference_model(match_model, device, num_threads=num_threads)
+    pnp_workers = cfgs["eval_metrics"].get("pnp_workers", 0)
+    pnp_pool = PnPPool(pnp_workers, cfgs["eval_metrics"]) if pnp_workers > 0 else None
+    try:
+        if batch_size > 1:
+            return inference_onepose_plus_worker_batched(
+                dataset, match_model, subset_ids, cfgs, pba=pba, verbose=verbose, batch_size=batch_size, device=device,
+                pnp_pool=pnp_pool
+            )
+
+        results = []
+
+        if verbose:
+            subset_ids = tqdm(subset_ids) if pba is None else subset_ids
+        else:
+            assert pba is None
+            subset_ids = subset_ids
+
+        for subset_id in subset_ids:
+            data = dataset[subset_id]
+            data_c = to_device(data, device)
+
+            if pnp_pool is not None:
+                with torch.inference_mode():
+                    match_model(data_c)
+                results += pnp_pool.submit(data_c)
+            else:
+                result = extract_matches(
+                    data_c, match_model, metrics_configs=cfgs["eval_metrics"]
+                )
+                results += [result]
+
+            if pba is not None:
+                pba.update.remote(1)
+
+        if pnp_pool is not None:
+            results += pnp_pool.drain()
+        return results
+    finally:
+        if pnp_pool is not None:
+            pnp_pool.close()
+
+
+def inference_onepose_plus_worker_batched(
+    dataset, match_model, subset_ids, cfgs, pba=None, verbose=True, batch_size=8, device="cuda", pnp_pool=None
 ):
-    match_model.cuda()
+    """
+    Same as `inference_onepose_plus_worker`, but stacks `batch_size` query images per forward pass.
+    The 3D keypoints and descriptors are moved to device once and shared by all batches.
+    pnp_pool (PnPPool): if given, the poses of the frames are solved by it
+    """
+    device = resolve_device(device)
     results = []
+    batches_ids = [
+        subset_ids[i : i + batch_size] for i in range(0, len(subset_ids), batch_size)
+    ]
 
     if verbose:
-        subset_ids = tqdm(subset_ids) if pba is None else subset_ids
+        batches_ids = tqdm(batches_ids) if pba is None else batches_ids
     else:
         assert pba is None
-        subset_ids = subset_ids
-
-    for subset_id in subset_ids:
-        data = dataset[subset_id]
-        data_c = {
-            k: v.cuda() if isinstance(v, torch.Tensor) else v for k, v in data.items()
-        }
-
-        result = extract_matches(
-            data_c, match_model, metrics_configs=cfgs["eval_metrics"]
-        )
 
-        results += [result]
+    shared_3d = {}
+    for batch_ids in batches_ids:
+        data = dataset.get_batch(batch_ids)
+        for k in SHARED_3D_KEYS:
+            if k in data:
+                if k not in shared_3d:
+                    shared_3d[k] = data[k].to(device)
+                data[k] = shared_3d[k]
+        data_c = to_device(data, device)
+
+        if pnp_pool is not None:
+            with torch.inference_mode():
+                match_model(data_c)
+            for frame_data in split_batch_by_frame(data_c):
+                results += pnp_pool.submit(frame_data)
+        else:
+            results += extract_matches_batched(
+                data_c, match_model, metrics_configs=cfgs["eval_metrics"]
+            )
 
         if pba is not None:
-            pba.update.remote(1)
+            pba.update.remote(len(batch_ids))
 
+    if pnp_pool is not None:
+        results += pnp_pool.drain()
     return results
 
 
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+
+
+def so3_exp(rotvec):
+    return cv2.Rodrigues(np.asarray(rotvec, dtype=np.float64).reshape(3, 1))[0]
+
+
+def so3_log(R):
+    return cv2.Rodrigues(np.asarray(R, dtype=np.float64))[0].reshape(3)
+
+
+class ConstantVelocityPoseFilter():
+    """
+    Kalman filter of object pose (camera frame) under a constant velocity model, one step per frame.
+    State: rotation R, translation t, angular velocity w and linear velocity v. The covariance is kept
+    over the error state [dt, dtheta, dv, dw], rotation errors are applied on the left: R <- exp(dtheta) R.
+
+    Usage:
+        pose_prior = motion_model.predict()  # None before the first update
+        ...  # estimate pose_pred, seeded with pose_prior
+        motion_model.update(pose_pred)
+    """
+
+    def __init__(self, pos_process_std=0.005, rot_process_std=0.02, pos_meas_std=0.005, rot_meas_std=0.01):
+        """ Noise std in pose units (translation, usually meters) and radians per frame """
+        self.Q = np.diag([pos_process_std**2] * 3 + [rot_process_std**2] * 3) # velocity random walk
+        self.R_meas = np.diag([pos_meas_std**2] * 3 + [rot_meas_std**2] * 3)
+        self.H = np.concatenate([np.eye(6), np.zeros((6, 6))], axis=1)
+        self.reset()
+
+    def reset(self):
+        self.R = None
+        self.t = None
+        self.v = np.zeros((3,))
+        self.w = np.zeros((3,))
+        self.P = None
+        self.predicted = False
+
+    @property
+    def initialized(self):
+        return self.R is not None
+
+    def pose(self):
+        return np.concatenate([self.R, self.t[:, None]], axis=-1) # 3*4
+
+    def predict(self):
+        """ Propagate state by one frame, return predicted pose np.ndarray[3*4] (None if not initialized) """
+        if not self.initialized:
+            return None
+
+        self.R = so3_exp(self.w) @ self.R
+        self.t = self.t + self.v
+
+        F = np.eye(12)
+        F[:6, 6:] = np.eye(6)
+        Q = np.zeros((12, 12))
+        Q[6:, 6:] = self.Q
+        Q[:6, :6] = self.Q / 3 # integrated velocity noise
+        self.P = F @ self.P @ F.T + Q
+        self.predicted = True
+        return self.pose()
+
+    def update(self, pose):
+        """ Correct state with a measured pose np.ndarray[3*4] or [4*4] """
+        R_meas, t_meas = pose[:3, :3], pose[:3, 3]
+        if not self.initialized:
+            self.R, self.t = R_meas.copy(), t_meas.copy()
+            self.P = np.diag(np.concatenate([np.diag(self.R_meas), np.diag(self.Q) * 10]))
+            return
+
+        if not self.predicted:
+            self.predict()
+
+        # Innovation of error state [dt, dtheta]:
+        y = np.concatenate([t_meas - self.t, so3_log(R_meas @ self.R.T)])
+        S = self.H @ self.P @ self.H.T + self.R_meas
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        dx = K @ y
+
+        self.t = self.t + dx[:3]
+        self.R = so3_exp(dx[3:6]) @ self.R
+        self.v = self.v + dx[6:9]
+        self.w = self.w + dx[9:12]
+        self.P = (np.eye(12) - K @ self.H) @ self.P
+        self.predicted = False
@@ -0,0 +1,397 @@
+import time
+import os.path as osp
+import cv2
+import torch
+import numpy as np
+from loguru import logger
+
+from src.utils.data_io import process_resize, grayscale2tensor
+from src.utils.metric_utils import ransac_PnP, guided_PnP
+from src.utils.model_io import resolve_device, prepare_inference_model
+from src.utils.vis_utils import reproj
+from src.datasets.OnePosePlus_inference_dataset import OnePosePlusInferenceDataset
+from src.local_feature_object_detector.local_feature_2D_detector import LocalFeatureObjectDetector
+from .inference_OnePosePlus import build_model
+from .motion_model import ConstantVelocityPoseFilter
+
+
+def frame_to_grayscale(frame):
+    """
+    Convert an in-memory frame to a full resolution uint8 grayscale image.
+    Input:
+        frame: np.ndarray[H*W] / [H*W*3] (BGR) or torch.tensor[H*W] / [1*H*W] / [1*1*H*W],
+            uint8 in [0, 255] or float in [0, 1]
+    Output:
+        image: np.ndarray[H*W] uint8
+    """
+    if isinstance(frame, torch.Tensor):
+        frame = frame.detach().cpu()
+        while frame.dim() > 2 and frame.shape[0] == 1:
+            frame = frame[0]
+        if frame.dim() == 3 and frame.shape[0] == 3:
+            frame = frame.permute(1, 2, 0)  # [3*H*W] -> [H*W*3]
+        if frame.is_floating_point():
+            frame = (frame * 255).round().clamp(0, 255)
+        frame = frame.numpy()
+
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame.astype(np.uint8), cv2.COLOR_BGR2GRAY)
+    return np.ascontiguousarray(frame.astype(np.uint8))
+
+
+class PoseTrackingSession():
+    """
+    Frame-by-frame pose tracking over in-memory frames (video capture, robot image stream, ...).
+    The 2D-3D matcher, the 2D object detector, the 3D point cloud with its features and the previous
+    frame's pose stay resident between frames, and no intermediate results are read from or written to disk.
+
+    With `optical_flow=True` full 2D-3D matching only runs on keyframes. In between, the inlier
+    2D-3D correspondences of the last keyframe are propagated by pyramidal Lucas-Kanade flow and
+    the pose is solved by PnP on the tracked points. A new keyframe is matched when too few tracked
+    points survive, their reprojection error grows too large or `keyframe_interval` frames passed.
+
+    With `motion_model=True` a constant velocity pose filter predicts the pose of the next frame.
+    The prediction yields the crop of the tracked object and seeds PnP: a refinement-only PnP from the
+    predicted pose is tried first, full RANSAC PnP only runs if its inlier ratio drops below
+    `prior_inlier_ratio_drop` times the inlier ratio of the last accepted solution, or after
+    `prior_ransac_interval` consecutive guided solutions. Keyframe matches and flow-tracked points have
+    different inlier statistics, each keeps its own reference ratio.
+
+    Usage:
+        session = PoseTrackingSession.from_cfg(cfg, sfm_model_dir, K, bbox3d)
+        for pose, inliers, bbox, timings in session.run(frames):
+            ...
+    """
+
+    def __init__(
+        self,
+        match_model,
+        detector,
+        sfm_dir,
+        K,
+        bbox3d,
+        shape3d,
+        load_3d_coarse=True,
+        pad=True,
+        df=8,
+        crop_size=512,
+        min_track_inliers=20,
+        pnp_reprojection_error=7,
+        use_pycolmap_ransac=True,
+        device="cuda",
+        num_threads=None,
+        optical_flow=False,
+        keyframe_interval=10,
+        min_flow_inliers=30,
+        max_flow_reproj_error=3.0,
+        flow_fb_threshold=1.0,
+        flow_win_size=21,
+        flow_max_level=3,
+        motion_model=False,
+        prior_inlier_ratio_drop=0.8,
+        prior_ransac_interval=10,
+    ):
+        self.device = resolve_device(device)
+        self.match_model = prepare_inference_model(match_model, self.device, num_threads=num_threads)
+        self.detector = detector
+        self.K = K
+        self.bbox3d = bbox3d
+        self.df = df
+        self.crop_size = crop_size
+        self.min_track_inliers = min_track_inliers
+        self.pnp_reprojection_error = pnp_reprojection_error
+        self.use_pycolmap_ransac = use_pycolmap_ransac
+        self.optical_flow = optical_flow
+        self.keyframe_interval = keyframe_interval
+        self.min_flow_inliers = min_flow_inliers
+        self.max_flow_reproj_error = max_flow_reproj_error
+        self.flow_fb_threshold = flow_fb_threshold
+        self.flow_params = dict(
+            winSize=(flow_win_size, flow_win_size),
+            maxLevel=flow_max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+        )
+        self.motion_model = ConstantVelocityPoseFilter() if motion_model else None
+        self.prior_inlier_ratio_drop = prior_inlier_ratio_drop
+        self.prior_ransac_interval = prior_ransac_interval
+
+        # Load (and pad) 3D point cloud and its features once, keep them on device:
+        anno_3d = OnePosePlusInferenceDataset(
+            sfm_dir,
+            [],
+            shape3d=shape3d,
+            load_3d_coarse=load_3d_coarse,
+            pad=pad,
+            load_pose_gt=False,
+            demo_mode=True,
+            preload=True,
+            device=self.device,
+        )
+        self.anno_3d_path = anno_3d.avg_anno_3d_path
+        self.keypoints3d = anno_3d.keypoints3d[None]  # [1, n2, 3]
+        self.descriptors3d_db = anno_3d.avg_descriptors3d[None]  # [1, dim, n2]
+        self.descriptors3d_coarse_db = (
+            anno_3d.avg_coarse_descriptors3d[None]
+            if anno_3d.avg_coarse_descriptors3d is not None
+            else None
+        )  # [1, dim, n2]
+
+        self.reset()
+
+    @classmethod
+    def from_cfg(cls, cfg, sfm_model_dir, K, bbox3d, sfm_ws_dir=None, **kwargs):
+        """ Build matcher and detector from a hydra inference config (e.g. `configs/experiment/inference_demo.yaml`) """
+        sfm_ws_dir = sfm_ws_dir or osp.join(sfm_model_dir, "sfm_ws", "model")
+        device = resolve_device(cfg.get("device", "cuda"))
+        num_threads = cfg.get("cpu_num_threads", None)
+        detector = LocalFeatureObjectDetector(
+            sfm_ws_dir=sfm_ws_dir, output_results=False, device=device, num_threads=num_threads, **cfg.get("detector", {})
+        )
+        match_model = build_model(cfg['model']["OnePosePlus"], cfg['model']['pretrained_ckpt'])
+        return cls(
+            match_model,
+            detector,
+            sfm_model_dir,
+            K,
+            bbox3d,
+            shape3d=cfg.datamodule.shape3d_val,
+            load_3d_coarse=cfg.datamodule.load_3d_coarse,
+            pad=cfg.datamodule.pad3D,
+            df=cfg.datamodule.df,
+            device=device,
+            num_threads=num_threads,
+            **{**cfg.get("tracking", {}), **kwargs},
+        )
+
+    def reset(self):
+        """ Forget the tracking state, next frame is detected by 2D local feature matching """
+        self.frame_id = 0
+        self.previous_pose = None
+        self.previous_inliers = np.empty((0,))
+        self.pose_prior = None
+        self.inlier_ratio_refs = {}  # {"keyframe" / "flow": inlier ratio of the last accepted PnP solution}
+        self.guided_streaks = {}  # {"keyframe" / "flow": consecutive guided PnP solutions since the last RANSAC}
+        if self.motion_model is not None:
+            self.motion_model.reset()
+        self.reset_flow()
+
+    def reset_flow(self):
+        """ Drop the correspondences tracked by optical flow, next frame is a keyframe """
+        self.flow_image = None  # previous grayscale frame
+        self.flow_pts2d = None  # [N, 2] tracked 2D points in full image, float32
+        self.flow_pts3d = None  # [N, 3] their 3D points
+        self.frames_since_keyframe = 0
+
+    def _detector_input(self, image):
+        """ Resize full image to be divisible by df and convert to normalized tensor [1*1*H*W] """
+        h, w = image.shape
+        w_new, h_new = process_resize(w, h, None, self.df)
+        if (w_new, h_new) != (w, h):
+            image = cv2.resize(image, (w_new, h_new))
+        return grayscale2tensor(image.astype(np.float32))[None]
+
+    def _build_match_data(self, inp_crop):
+        data = {
+            "anno_3d_path": self.anno_3d_path,  # query-independent 3D features are cached by the model
+            "keypoints3d": self.keypoints3d,
+            "descriptors3d_db": self.descriptors3d_db,
+            "query_image": inp_crop,
+        }
+        if self.descriptors3d_coarse_db is not None:
+            data.update({"descriptors3d_coarse_db": self.descriptors3d_coarse_db})
+        return data
+
+    def _solve_pnp(self, K, pts2d, pts3d, img_hw, source):
+        """ source: "keyframe" (2D-3D matches) or "flow" (tracked points), they keep separate reference inlier ratios """
+        # Refine predicted pose, as long as it explains the matches about as well as the last accepted solution,
+        # re-run RANSAC every prior_ransac_interval frames so that the reference cannot slowly drift down:
+        inlier_ratio_ref = self.inlier_ratio_refs.get(source, None)
+        if (
+            self.pose_prior is not None
+            and inlier_ratio_ref is not None
+            and self.guided_streaks.get(source, 0) < self.prior_ransac_interval
+        ):
+            pose_pred, _, inliers, state = guided_PnP(
+                K,
+                pts2d,
+                pts3d,
+                self.pose_prior,
+                pnp_reprojection_error=self.pnp_reprojection_error,
+                min_inlier_ratio=self.prior_inlier_ratio_drop * inlier_ratio_ref,
+            )
+            if state:
+                self.inlier_ratio_refs[source] = len(inliers) / max(len(pts2d), 1)
+                self.guided_streaks[source] += 1
+                return pose_pred, inliers
+
+        pose_pred, _, inliers, _ = ransac_PnP(
+            K,
+            pts2d,
+            pts3d,
+            scale=1000,
+            pnp_reprojection_error=self.pnp_reprojection_error,
+            img_hw=img_hw,
+            use_pycolmap_ransac=self.use_pycolmap_ransac,
+        )
+        inliers = np.asarray(inliers).reshape(-1)
+        self.inlier_ratio_refs[source] = len(inliers) / max(len(pts2d), 1)
+        self.guided_streaks[source] = 0
+        return pose_pred, inliers
+
+    def _update_state(self, pose_pred, inliers):
+        self.previous_pose, self.previous_inliers = pose_pred, inliers
+        if self.motion_model is not None:
+            if len(inliers) >= self.min_track_inliers:
+                self.motion_model.update(pose_pred)
+            else:
+                self.motion_model.reset()
+        self.frame_id += 1
+
+    def _init_flow(self, image, K_crop, mkpts_query, mkpts_3d, inliers):
+        """ Keep the keyframe's inlier correspondences, with 2D points mapped from crop to full image """
+        if len(inliers) < self.min_flow_inliers:
+            self.reset_flow()
+            return
+
+        crop_to_full = self.K @ np.linalg.inv(K_crop)  # K_crop = T_crop @ K
+        pts2d = mkpts_query[inliers] @ crop_to_full[:2, :2].T + crop_to_full[:2, 2]
+        self.flow_image = image
+        self.flow_pts2d = pts2d.astype(np.float32)
+        self.flow_pts3d = mkpts_3d[inliers]
+        self.frames_since_keyframe = 0
+
+    def _track_flow(self, image, timings):
+        """
+        Propagate the tracked correspondences to image by LK flow (forward-backward checked) and solve PnP.
+        Return None if tracking is not reliable anymore and the frame needs full matching.
+        """
+        if self.flow_pts2d is None or self.frames_since_keyframe + 1 >= self.keyframe_interval:
+            return None
+
+        t = time.perf_counter()
+        pts2d, status, _ = cv2.calcOpticalFlowPyrLK(self.flow_image, image, self.flow_pts2d, None, **self.flow_params)
+        pts2d_back, status_back, _ = cv2.calcOpticalFlowPyrLK(image, self.flow_image, pts2d, None, **self.flow_params)
+        fb_error = np.linalg.norm(pts2d_back - self.flow_pts2d, axis=-1)
+        valid = status.reshape(-1).astype(bool) & status_back.reshape(-1).astype(bool) & (fb_error < self.flow_fb_threshold)
+        timings["flow"] = time.perf_counter() - t
+        if valid.sum() < self.min_flow_inliers:
+            return None
+
+        t = time.perf_counter()
+        pts2d, pts3d = pts2d[valid], self.flow_pts3d[valid]
+        pose_pred, inliers = self._solve_pnp(self.K, pts2d, pts3d, img_hw=image.shape[:2], source="flow")
+        timings["pnp"] = time.perf_counter() - t
+        if len(inliers) < self.min_flow_inliers:
+            return None
+        reproj_error = np.linalg.norm(reproj(self.K, pose_pred, pts3d[inliers]) - pts2d[inliers], axis=-1).mean()
+        if reproj_error > self.max_flow_reproj_error:
+            return None
+
+        # Only inliers are propagated further:
+        self.flow_image = image
+        self.flow_pts2d = pts2d[inliers]
+        self.flow_pts3d = pts3d[inliers]
+        self.frames_since_keyframe += 1
+
+        proj_2D_coor = reproj(self.K, pose_pred, self.bbox3d)
+        bbox = np.concatenate([np.min(proj_2D_coor, axis=0), np.max(proj_2D_coor, axis=0)]).astype(np.int32)
+        return pose_pred, inliers, bbox
+
+    @torch.inference_mode()
+    def track(self, frame, frame_name=None):
+        """
+        Estimate object pose of one frame.
+        Input:
+            frame: in-memory image, see `frame_to_grayscale`
+            frame_name[optional]: str, only used to name the detector's debug outputs (`output_results=True`)
+        Output:
+            pose_pred: np.ndarray[3*4]
+            inliers: np.ndarray[n_inliers]
+            bbox: np.ndarray[x0, y0, x1, y1]
+            timings: dict{stage: seconds}, keyframes: preprocess / detect / match / pnp,
+                optical flow frames: preprocess / flow / pnp
+        """
+        timings = {}
+        t_start = time.perf_counter()
+
+        image = frame_to_grayscale(frame)
+        timings["preprocess"] = time.perf_counter() - t_start
+
+        # Predict pose of this frame by motion model:
+        self.pose_prior = self.motion_model.predict() if self.motion_model is not None else None
+
+        # Propagate correspondences of last keyframe:
+        if self.optical_flow:
+            flow_results = self._track_flow(image, timings)
+            if flow_results is not None:
+                pose_pred, inliers, bbox = flow_results
+                timings["total"] = time.perf_counter() - t_start
+                self._update_state(pose_pred, inliers)
+                return pose_pred, inliers, bbox, timings
+            timings.pop("flow", None)
+            timings.pop("pnp", None)
+
+        # Detect object:
+        t = time.perf_counter()
+        if self.previous_pose is None or len(self.previous_inliers) < self.min_track_inliers:
+            # Detect object by 2D local feature matching (first frame or tracking lost):
+            bbox, inp_crop, K_crop = self.detector.detect(
+                self._detector_input(image), frame_name, self.K, crop_size=self.crop_size, origin_img=image
+            )
+        else:
+            # Use 3D bbox and predicted (or previous frame's) pose to yield current frame 2D bbox:
+            bbox, inp_crop, K_crop = self.detector.previous_pose_detect(
+                frame_name,
+                self.K,
+                self.pose_prior if self.pose_prior is not None else self.previous_pose,
+                self.bbox3d,
+                crop_size=self.crop_size,
+                origin_img=image,
+            )
+        timings["detect"] = time.perf_counter() - t
+
+        # Perform keypoint-free 2D-3D matching:
+        t = time.perf_counter()
+        data = self._build_match_data(inp_crop)
+        self.match_model(data)
+        mkpts_3d = data["mkpts_3d_db"].cpu().numpy() # N*3
+        mkpts_query = data["mkpts_query_f"].cpu().numpy() # N*2
+        timings["match"] = time.perf_counter() - t
+
+        # Estimate object pose by PnP:
+        t = time.perf_counter()
+        pose_pred, inliers = self._solve_pnp(
+            K_crop, mkpts_query, mkpts_3d, img_hw=[self.crop_size, self.crop_size], source="keyframe"
+        )
+        timings["pnp"] = time.perf_counter() - t
+        timings["total"] = time.perf_counter() - t_start
+
+        if self.optical_flow:
+            self._init_flow(image, K_crop, mkpts_query, mkpts_3d, inliers)
+
+        self._update_state(pose_pred, inliers)
+        return pose_pred, inliers, bbox, timings
+
+    def run(self, frames):
+        """
+        Track over a frame source.
+        Input:
+            frames: iterable of in-memory frames (generator, list, ...) or a `cv2.VideoCapture`
+        Yield:
+            (pose_pred, inliers, bbox, timings) per frame
+        """
+        if isinstance(frames, cv2.VideoCapture):
+            frames = iterate_video_capture(frames)
+
+        for frame in frames:
+            yield self.track(frame)
+
+
+def iterate_video_capture(capture):
+    """ Yield BGR frames from a `cv2.VideoCapture` until the stream ends """
+    while capture.isOpened():
+        ret, frame = capture.read()
+        if not ret:
+            logger.info("Video capture stream ended")
+            break
+        yield frame
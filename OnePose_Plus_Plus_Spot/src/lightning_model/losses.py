@@ -57,6 +57,46 @@ class Loss(nn.Module):
         else:
             raise NotImplementedError
 
+    def compute_sparse_coarse_loss(self, conf, spv_j_ids, weight=None):
+        """ Same focal loss as `compute_coarse_loss`, with the gt given as the matched grid id of each 3D point.
+        Negative loss is reduced over all entries minus the positive ones, so no dense gt is built.
+        Args:
+            conf (torch.Tensor): (N, HW0, HW1)
+            spv_j_ids (torch.Tensor): (N, HW0) matched index in HW1, -1 for unmatched
+            weight (torch.Tensor): (N, HW0, HW1)
+        """
+        if self.config["coarse_type"] == "focal":
+            conf = torch.clamp(conf, 1e-6, 1 - 1e-6)
+            alpha = self.config["focal_alpha"]
+            gamma = self.config["focal_gamma"]
+
+            b_ids, i_ids = torch.where(spv_j_ids >= 0)
+            j_ids = spv_j_ids[b_ids, i_ids]
+            conf_pos = conf[b_ids, i_ids, j_ids]
+
+            loss_pos = -alpha * torch.pow(1 - conf_pos, gamma) * conf_pos.log()
+            loss_neg = -(1 - alpha) * torch.pow(conf, gamma) * (1 - conf).log()
+            if weight is not None:
+                loss_pos = loss_pos * weight[b_ids, i_ids, j_ids]
+                loss_neg = loss_neg * weight
+
+            n_pos = loss_pos.shape[0]
+            n_neg = conf.numel() - n_pos
+            if n_pos == 0:
+                logger.warning('len of loss pos is zero!')
+                loss_mean = self.c_neg_w * loss_neg.mean()
+            elif n_neg == 0:
+                logger.warning('len of loss neg is zero!')
+                loss_mean = self.c_pos_w * loss_pos.mean()
+            else:
+                loss_pos_mean = loss_pos.mean()
+                loss_neg_mean = (loss_neg.sum() - loss_neg[b_ids, i_ids, j_ids].sum()) / n_neg
+                loss_mean = self.c_pos_w * loss_pos_mean + self.c_neg_w * loss_neg_mean
+
+            return loss_mean
+        else:
+            raise NotImplementedError
+
     def compute_fine_loss(self, expec_f, expec_f_gt):
         if self.fine_type == "l2_with_std":
             return self._compute_fine_loss_l2_std(expec_f, expec_f_gt)
@@ -122,9 +162,14 @@ class Loss(nn.Module):
         loss_scalars = {}
         c_weight = self.compute_c_weight(data)
 
-        loss_c = self.compute_coarse_loss(
-            data["conf_matrix"], data["conf_matrix_gt"], weight=c_weight
-        )
+        if "spv_j_ids" in data:
+            loss_c = self.compute_sparse_coarse_loss(
+                data["conf_matrix"], data["spv_j_ids"], weight=c_weight
+            )
+        else:
+            loss_c = self.compute_coarse_loss(
+                data["conf_matrix"], data["conf_matrix_gt"], weight=c_weight
+            )
         loss = loss_c * self.config["coarse_weight"]
         loss_scalars.update({"loss_c": loss_c.clone().detach().cpu()})
 
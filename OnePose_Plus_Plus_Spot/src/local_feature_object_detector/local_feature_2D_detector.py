@@ -7,6 +7,7 @@ import pytorch_lightning as pl
 
 from src.KeypointFreeSfM.loftr_for_sfm import LoFTR_for_OnePose_Plus, default_cfg
 from src.utils.colmap.read_write_model import read_model
+from src.utils.model_io import resolve_device, prepare_inference_model
 from src.utils.data_utils import get_K_crop_resize, get_image_crop_resize
 from src.utils.vis_utils import reproj
 
@@ -35,10 +36,33 @@ def build_2D_match_model(args):
     return matcher
 
 class LocalFeatureObjectDetector():
-    def __init__(self, sfm_ws_dir, n_ref_view=15, output_results=False, detect_save_dir=None, K_crop_save_dir=None):
+    def __init__(
+        self,
+        sfm_ws_dir,
+        n_ref_view=15,
+        output_results=False,
+        detect_save_dir=None,
+        K_crop_save_dir=None,
+        device="cuda",
+        num_threads=None,
+        ref_view_batch_size=None,
+        early_stop_inliers=None,
+    ):
+        """
+        ref_view_batch_size: number of reference views matched per batched LoFTR pass. The query backbone runs
+            once per detection and reference backbone features are precomputed. None: one full LoFTR pass per view.
+        early_stop_inliers: stop matching further reference views (batches) once one view reaches this many inliers.
+        """
+        self.device = resolve_device(device)
         matcher = build_2D_match_model(cfgs['model']) 
-        self.matcher = matcher.cuda()
-        self.db_imgs, self.db_corners_homo = self.load_ref_view_images(sfm_ws_dir, n_ref_view)
+        self.matcher = prepare_inference_model(matcher, self.device, num_threads=num_threads)
+        db_imgs, self.db_corners_homo = self.load_ref_view_images(sfm_ws_dir, n_ref_view)
+        # Reference views stay resident on device:
+        self.db_imgs = [db_img.to(self.device) for db_img in db_imgs]
+        self.early_stop_inliers = early_stop_inliers
+        self.db_batches = (
+            self.load_ref_view_batches(ref_view_batch_size) if ref_view_batch_size is not None else None
+        )
         self.output_results = output_results
         self.detect_save_dir = detect_save_dir
         self.K_crop_save_dir = K_crop_save_dir
@@ -71,49 +95,113 @@ class LocalFeatureObjectDetector():
 
         return db_imgs, db_corners_homo
 
-    @torch.no_grad()
+    @torch.inference_mode()
+    def load_ref_view_batches(self, batch_size):
+        """ Stack reference views of the same size into batches and precompute their backbone features """
+        batches_ids = []
+        for idx, db_img in enumerate(self.db_imgs):
+            if (
+                len(batches_ids) == 0
+                or len(batches_ids[-1]) == batch_size
+                or db_img.shape != self.db_imgs[batches_ids[-1][0]].shape
+            ):
+                batches_ids.append([idx])
+            else:
+                batches_ids[-1].append(idx)
+
+        db_batches = []
+        for ids in batches_ids:
+            image0 = torch.cat([self.db_imgs[idx] for idx in ids])
+            db_batches.append(
+                {"ids": ids, "image0": image0, "feats0": self.matcher.extract_backbone_features(image0)}
+            )
+        return db_batches
+
+    def estimate_view_bbox(self, idx, mkpts0, mkpts1, query_shape):
+        """ Estimate query bbox by the affine transformation between reference view idx and query """
+        if mkpts0.shape[0] < 6:
+            inliers = np.empty((0))
+            img_center = (query_shape[-1] // 2, query_shape[-2] // 2)
+            return {
+                "inliers": inliers,
+                "bbox": np.array([img_center[0] - 500, img_center[1] - 500, img_center[0] + 500, img_center[1] + 500]) # [w,h]
+            }
+
+        affine, inliers = cv2.estimateAffine2D(
+            mkpts0, mkpts1, method=cv2.RANSAC, ransacReprojThreshold=6
+        )
+
+        # Estimate box:
+        four_corner = self.db_corners_homo[idx]
+
+        bbox = (affine @ four_corner).T.astype(np.int32)  # 4*2
+
+        left_top = np.min(bbox, axis=0)
+        right_bottom = np.max(bbox, axis=0)
+
+        w, h = right_bottom - left_top
+        offset_percent = 0.0
+        x0 = left_top[0] - int(w * offset_percent)
+        y0 = left_top[1] - int(h * offset_percent)
+        x1 = right_bottom[0] + int(w * offset_percent)
+        y1 = right_bottom[1] + int(h * offset_percent)
+
+        return {
+            "inliers": inliers,
+            "bbox": np.array([x0, y0, x1, y1]),
+        }
+
+    def early_stop(self, detect_results_dict):
+        return self.early_stop_inliers is not None and any(
+            result["inliers"].sum() >= self.early_stop_inliers for result in detect_results_dict.values()
+        )
+
+    @torch.inference_mode()
     def match_worker(self, query):
+        if self.db_batches is not None:
+            return self.match_worker_batched(query)
+
         detect_results_dict = {}
+        query = query.to(self.device)
         for idx, db_img in enumerate(self.db_imgs):
 
-            match_data = {"image0": db_img.cuda(), "image1": query.cuda()}
+            match_data = {"image0": db_img, "image1": query}
             self.matcher(match_data)
             mkpts0 = match_data["mkpts0_f"].cpu().numpy()
             mkpts1 = match_data["mkpts1_f"].cpu().numpy()
 
-            if mkpts0.shape[0] < 6:
-                affine = None
-                inliers = np.empty((0))
-                img_center = (query.shape[-1] // 2, query.shape[-2] // 2)
-                detect_results_dict[idx] = {
-                    "inliers": inliers,
-                    "bbox": np.array([img_center[0] - 500, img_center[1] - 500, img_center[0] + 500, img_center[1] + 500]) # [w,h]
-                }
-                continue
-
-            affine, inliers = cv2.estimateAffine2D(
-                mkpts0, mkpts1, method=cv2.RANSAC, ransacReprojThreshold=6
-            )
-
-            # Estimate box:
-            four_corner = self.db_corners_homo[idx]
-
-            bbox = (affine @ four_corner).T.astype(np.int32)  # 4*2
-
-            left_top = np.min(bbox, axis=0)
-            right_bottom = np.max(bbox, axis=0)
-
-            w, h = right_bottom - left_top
-            offset_percent = 0.0
-            x0 = left_top[0] - int(w * offset_percent)
-            y0 = left_top[1] - int(h * offset_percent)
-            x1 = right_bottom[0] + int(w * offset_percent)
-            y1 = right_bottom[1] + int(h * offset_percent)
+            detect_results_dict[idx] = self.estimate_view_bbox(idx, mkpts0, mkpts1, query.shape)
+            if self.early_stop(detect_results_dict):
+                break
+        return detect_results_dict
 
-            detect_results_dict[idx] = {
-                "inliers": inliers,
-                "bbox": np.array([x0, y0, x1, y1]),
+    @torch.inference_mode()
+    def match_worker_batched(self, query):
+        """
+        Match query against batches of reference views in one coarse / fine LoFTR pass per batch.
+        Query backbone features are computed once and broadcast to the batch.
+        """
+        detect_results_dict = {}
+        query = query.to(self.device)
+        feats1 = self.matcher.extract_backbone_features(query)
+        for db_batch in self.db_batches:
+            n_views = len(db_batch["ids"])
+            match_data = {
+                "image0": db_batch["image0"],
+                "image1": query,
+                "feats0": db_batch["feats0"],
+                "feats1": [feat.expand(n_views, -1, -1, -1) for feat in feats1],
             }
+            self.matcher(match_data)
+            m_bids = match_data["m_bids"].cpu().numpy()
+            mkpts0 = match_data["mkpts0_f"].cpu().numpy()
+            mkpts1 = match_data["mkpts1_f"].cpu().numpy()
+
+            for b_id, idx in enumerate(db_batch["ids"]):
+                mask = m_bids == b_id
+                detect_results_dict[idx] = self.estimate_view_bbox(idx, mkpts0[mask], mkpts1[mask], query.shape)
+            if self.early_stop(detect_results_dict):
+                break
         return detect_results_dict
 
     def detect_by_matching(self, query):
@@ -130,20 +218,22 @@ class LocalFeatureObjectDetector():
         ]
         return detect_results_dict[idx_sorted[0]]["bbox"]
 
-    def crop_img_by_bbox(self, query_img_path, bbox, K=None, crop_size=512):
+    def crop_img_by_bbox(self, query_img_path, bbox, K=None, crop_size=512, origin_img=None):
         """
         Crop image by detect bbox
         Input:
             query_img_path: str,
             bbox: np.ndarray[x0, y0, x1, y1],
             K[optional]: 3*3
+            origin_img[optional]: np.ndarray[H*W] uint8 grayscale, used instead of reading query_img_path
         Output:
             image_crop: np.ndarray[crop_size * crop_size],
             K_crop[optional]: 3*3
         """
         x0, y0 = bbox[0], bbox[1]
         x1, y1 = bbox[2], bbox[3]
-        origin_img = cv2.imread(query_img_path, cv2.IMREAD_GRAYSCALE)
+        if origin_img is None:
+            origin_img = cv2.imread(query_img_path, cv2.IMREAD_GRAYSCALE)
 
         resize_shape = np.array([y1 - y0, x1 - x0])
         if K is not None:
@@ -159,52 +249,54 @@ class LocalFeatureObjectDetector():
         return image_crop, K_crop if K is not None else None
     
     def save_detection(self, crop_img, query_img_path):
-        if self.output_results and self.detect_save_dir is not None:
+        if self.output_results and self.detect_save_dir is not None and query_img_path is not None:
             cv2.imwrite(osp.join(self.detect_save_dir, osp.basename(query_img_path)), crop_img)
     
     def save_K_crop(self, K_crop, query_img_path):
-        if self.output_results and self.K_crop_save_dir is not None:
+        if self.output_results and self.K_crop_save_dir is not None and query_img_path is not None:
             np.savetxt(osp.join(self.K_crop_save_dir, osp.splitext(osp.basename(query_img_path))[0] + '.txt'), K_crop) # K_crop: 3*3
 
-    def detect(self, query_img, query_img_path, K, crop_size=512):
+    def detect(self, query_img, query_img_path, K, crop_size=512, origin_img=None):
         """
         Detect object by local feature matching and crop image.
         Input:
             query_image: np.ndarray[1*1*H*W],
-            query_img_path: str,
+            query_img_path: str or None (in-memory frame),
             K: np.ndarray[3*3], intrinsic matrix of original image
+            origin_img[optional]: np.ndarray[H*W] uint8 grayscale full image
         Output:
             bounding_box: np.ndarray[x0, y0, x1, y1]
             cropped_image: torch.tensor[1 * 1 * crop_size * crop_size] (normalized),
             cropped_K: np.ndarray[3*3];
         """
         if len(query_img.shape) != 4:
-            query_inp = query_img[None].cuda()
+            query_inp = query_img[None].to(self.device)
         else:
-            query_inp = query_img.cuda()
+            query_inp = query_img.to(self.device)
         
         # Detect bbox and crop image:
         bbox = self.detect_by_matching(
             query=query_inp,
         )
-        image_crop, K_crop = self.crop_img_by_bbox(query_img_path, bbox, K, crop_size=crop_size)
+        image_crop, K_crop = self.crop_img_by_bbox(query_img_path, bbox, K, crop_size=crop_size, origin_img=origin_img)
         self.save_detection(image_crop, query_img_path)
         self.save_K_crop(K_crop, query_img_path)
 
         # To Tensor:
         image_crop = image_crop.astype(np.float32) / 255
-        image_crop_tensor = torch.from_numpy(image_crop)[None][None].cuda()
+        image_crop_tensor = torch.from_numpy(image_crop)[None][None].to(self.device)
 
         return bbox, image_crop_tensor, K_crop
     
-    def previous_pose_detect(self, query_img_path, K, pre_pose, bbox3D_corner, crop_size=512):
+    def previous_pose_detect(self, query_img_path, K, pre_pose, bbox3D_corner, crop_size=512, origin_img=None):
         """
         Detect object by projecting 3D bbox with estimated last frame pose.
         Input:
-            query_image_path: str,
+            query_image_path: str or None (in-memory frame),
             K: np.ndarray[3*3], intrinsic matrix of original image
             pre_pose: np.ndarray[3*4] or [4*4], pose of last frame
             bbox3D_corner: np.ndarray[8*3], corner coordinate of annotated 3D bbox
+            origin_img[optional]: np.ndarray[H*W] uint8 grayscale full image
         Output:
             bounding_box: np.ndarray[x0, y0, x1, y1]
             cropped_image: torch.tensor[1 * 1 * crop_size * crop_size] (normalized),
@@ -216,12 +308,12 @@ class LocalFeatureObjectDetector():
         x1, y1 = np.max(proj_2D_coor, axis=0)
         bbox = np.array([x0, y0, x1, y1]).astype(np.int32)
 
-        image_crop, K_crop = self.crop_img_by_bbox(query_img_path, bbox, K, crop_size=crop_size)
+        image_crop, K_crop = self.crop_img_by_bbox(query_img_path, bbox, K, crop_size=crop_size, origin_img=origin_img)
         self.save_detection(image_crop, query_img_path)
         self.save_K_crop(K_crop, query_img_path)
 
         # To Tensor:
         image_crop = image_crop.astype(np.float32) / 255
-        image_crop_tensor = torch.from_numpy(image_crop)[None][None].cuda()
+        image_crop_tensor = torch.from_numpy(image_crop)[None][None].to(self.device)
 
         return bbox, image_crop_tensor, K_crop
\ No newline at end of file
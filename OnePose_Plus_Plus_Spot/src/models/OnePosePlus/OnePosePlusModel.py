@@ -20,6 +20,7 @@ from .utils.position_encoding import (
 )
 from .utils.coarse_matching import CoarseMatching
 from .utils.fine_matching import FineMatching
+from .utils.object_3d_cache import Object3DCache
 
 
 class OnePosePlus_model(nn.Module):
@@ -76,6 +77,10 @@ class OnePosePlus_model(nn.Module):
         self.loftr_fine = LocalFeatureTransformer(self.config["loftr_fine"])
         self.fine_matching = FineMatching(self.config["fine_matching"])
 
+        # Query-independent 3D branch results, used in eval mode only:
+        self.object_3d_cache = Object3DCache()
+        self.ckpt_hash = None
+
         self.loftr_backbone_pretrained = self.config["loftr_backbone"]["pretrained"]
         if self.loftr_backbone_pretrained is not None:
             logger.info(
@@ -93,6 +98,50 @@ class OnePosePlus_model(nn.Module):
                 for param in self.backbone.parameters():
                     param.requires_grad = False
 
+    def _encode_3d_keypoints(self, data):
+        kpts3d = normalize_3d_keypoints(data["keypoints3d"])
+        desc3d_db = (
+            self.kpt_3d_pos_encoding(
+                kpts3d,
+                data["descriptors3d_db"]
+                if "descriptors3d_coarse_db" not in data
+                else data["descriptors3d_coarse_db"],
+            )
+            if self.kpt_3d_pos_encoding is not None
+            else data["descriptors3d_db"]
+            if "descriptors3d_coarse_db" not in data
+            else data["descriptors3d_coarse_db"]
+        )
+        return desc3d_db
+
+    def encode_3d(self, data):
+        """
+        Query-independent part of the 3D branch.
+        If data contains `anno_3d_path` and the model is in eval mode, results are taken from
+        (or stored into) `self.object_3d_cache`, see `Object3DCache`.
+        Returns:
+            desc3d_db (torch.Tensor): [N, C, L]
+            desc3d_db_self (torch.Tensor or None): [N, L, C], 3D side of leading coarse self layers
+        """
+        if self.training or "anno_3d_path" not in data:
+            return self._encode_3d_keypoints(data), None
+
+        key = Object3DCache.make_key(data["anno_3d_path"], self.ckpt_hash)
+        entry = self.object_3d_cache.get(key, data["keypoints3d"])
+        if entry is None:
+            desc3d_db = self._encode_3d_keypoints(data)
+            entry = self.object_3d_cache.put(
+                key,
+                data["keypoints3d"],
+                desc3d_db,
+                self.loftr_coarse.forward_3d_query_independent(desc3d_db),
+            )
+        return entry["desc3d_db"], entry["desc3d_db_self"]
+
+    def invalidate_3d_cache(self, anno_3d_path=None):
+        """ Drop cached 3D features of one object, or of all objects """
+        self.object_3d_cache.invalidate(anno_3d_path)
+
     def forward(self, data):
         """
         Update:
@@ -105,6 +154,8 @@ class OnePosePlus_model(nn.Module):
                 query_image_scale: (N, 2)
                 query_image_mask(optional): (N, H, W)
             }
+            NOTE: 3D inputs (keypoints3d, descriptors3d_db, descriptors3d_coarse_db) may also
+            be given with batch dim 1, they are then shared by all N queries by broadcasting.
         """
         if (
             self.loftr_backbone_pretrained
@@ -141,19 +192,20 @@ class OnePosePlus_model(nn.Module):
             "n c h w -> n (h w) c",
         )
 
-        kpts3d = normalize_3d_keypoints(data["keypoints3d"])
-        desc3d_db = (
-            self.kpt_3d_pos_encoding(
-                kpts3d,
-                data["descriptors3d_db"]
-                if "descriptors3d_coarse_db" not in data
-                else data["descriptors3d_coarse_db"],
+        desc3d_db, desc3d_db_self = self.encode_3d(data)
+
+        if desc3d_db.size(0) != data["bs"]:
+            # One 3D model shared by a batch of queries: broadcast (views, no copy) to batch size
+            desc3d_db = desc3d_db.expand(data["bs"], -1, -1)
+            if desc3d_db_self is not None:
+                desc3d_db_self = desc3d_db_self.expand(data["bs"], -1, -1)
+            data.update(
+                {
+                    k: data[k].expand(data["bs"], *data[k].shape[1:])
+                    for k in ["keypoints3d", "descriptors3d_db", "descriptors3d_coarse_db"]
+                    if k in data
+                }
             )
-            if self.kpt_3d_pos_encoding is not None
-            else data["descriptors3d_db"]
-            if "descriptors3d_coarse_db" not in data
-            else data["descriptors3d_coarse_db"]
-        )
 
         query_mask = data["query_image_mask"].flatten(-2) if "query_image_mask" in data else None
 
@@ -161,6 +213,7 @@ class OnePosePlus_model(nn.Module):
             desc3d_db,
             query_feat_c,
             query_mask=query_mask,
+            desc3d_db_self=desc3d_db_self,
         )
 
         # 3. match coarse-level
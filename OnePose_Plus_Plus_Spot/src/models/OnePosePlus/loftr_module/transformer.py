@@ -130,7 +130,31 @@ class LocalFeatureTransformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, desc3d_db, desc2d_query, query_mask=None, return_middle_layer_features=False):
+    @property
+    def n_query_independent_layers(self):
+        """ Number of leading `self` layers, their 3D side output doesn't depend on the query """
+        n_layers = 0
+        for name in self.layer_names:
+            if name != "self":
+                break
+            n_layers += 1
+        return n_layers
+
+    def forward_3d_query_independent(self, desc3d_db):
+        """
+        Run the 3D side of the leading `self` layers, the result can be cached and passed
+        to `forward` as `desc3d_db_self` for every query against the same point cloud.
+        Args:
+           desc3d_db (torch.Tensor): [N, C, L]
+        Returns:
+           desc3d_db (torch.Tensor): [N, L, C]
+        """
+        desc3d_db = torch.einsum("bdn->bnd", desc3d_db)  # [N, L, C]
+        for layer in self.layers[: self.n_query_independent_layers]:
+            desc3d_db = layer(desc3d_db, desc3d_db)
+        return desc3d_db
+
+    def forward(self, desc3d_db, desc2d_query, query_mask=None, return_middle_layer_features=False, desc3d_db_self=None):
         """
         Args:
            desc3d_db (torch.Tensor): [N, C, L] 
@@ -139,13 +163,22 @@ class LocalFeatureTransformer(nn.Module):
            query_mask (torch.Tensor): [N, P]
            keypoints3D (torch.Tensor): [N, L, 3]
            desc2d_db_pad_mask (torch.Tensor): [N, M]
+           desc3d_db_self (torch.Tensor): [N, L, C] (optional), precomputed `forward_3d_query_independent`
         """
         self.device = desc3d_db.device
 
-        desc3d_db = torch.einsum("bdn->bnd", desc3d_db)  # [N, L, C]
+        if desc3d_db_self is not None:
+            desc3d_db = desc3d_db_self
+            n_skip_3d = self.n_query_independent_layers
+        else:
+            desc3d_db = torch.einsum("bdn->bnd", desc3d_db)  # [N, L, C]
+            n_skip_3d = 0
 
         for i, (layer, name) in enumerate(zip(self.layers, self.layer_names)):
-            if name == "self":
+            if name == "self" and i < n_skip_3d:
+                # 3D side already computed:
+                desc2d_query = layer(desc2d_query, desc2d_query, query_mask, query_mask)
+            elif name == "self":
                 src0, src1 = desc2d_query, desc3d_db
                 desc2d_query, desc3d_db = (
                     layer(desc2d_query, src0, query_mask, query_mask),
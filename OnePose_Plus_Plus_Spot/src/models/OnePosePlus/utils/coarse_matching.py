@@ -70,6 +70,12 @@ class CoarseMatching(nn.Module):
         self.border_rm = config["border_rm"]
         self.train_coarse_percent = config["train"]["train_coarse_percent"]
         self.train_pad_num_gt_min = config["train"]["train_pad_num_gt_min"]
+        # Inference only: process 3D points in chunks of this size instead of building
+        # the dense [N, L, S] conf_matrix (None: always dense)
+        self.chunk_size = config.get("chunk_size", None)
+        # Keep the dense path (and `data['conf_matrix']`) at inference, e.g. for plotting / evaluation;
+        # can also be requested per batch with `data['return_conf_matrix'] = True`
+        self.return_conf_matrix = config.get("return_conf_matrix", False)
 
         self.profiler = profiler or PassThroughProfiler
 
@@ -101,6 +107,13 @@ class CoarseMatching(nn.Module):
         # normalize
         feat_db_3d, feat_query = map(self.feat_normalizer, [feat_db_3d, feat_query])
 
+        return_conf_matrix = self.return_conf_matrix or data.get("return_conf_matrix", False)
+        if self.chunk_size is not None and not self.training and not return_conf_matrix:
+            # memory bounded, conf_matrix is never materialized (only the training losses read it)
+            with self.profiler.record_function("LoFTR/coarse-matching/get_coarse_match_chunked"):
+                data.update(**self.get_coarse_match_chunked(feat_db_3d, feat_query, data, mask_query))
+            return
+
         if self.type == "dual-softmax":
             sim_matrix = (
                 torch.einsum("nlc,nsc->nls", feat_db_3d, feat_query) / (self.temperature + 1e-4)
@@ -195,7 +208,12 @@ class CoarseMatching(nn.Module):
                     device=device,
                 )
 
-            spv_b_ids, spv_i_ids, spv_j_ids = torch.where(data['conf_matrix_gt'])
+            if 'spv_j_ids' in data:
+                # sparse GT: grid id matched by each 3D point
+                spv_b_ids, spv_i_ids = torch.where(data['spv_j_ids'] >= 0)
+                spv_j_ids = data['spv_j_ids'][spv_b_ids, spv_i_ids]
+            else:
+                spv_b_ids, spv_i_ids, spv_j_ids = torch.where(data['conf_matrix_gt'])
             assert len(spv_b_ids) != 0
             gt_pad_indices = torch.randint(
                 len(spv_b_ids),
@@ -241,6 +259,103 @@ class CoarseMatching(nn.Module):
 
         return coarse_matches
 
+    @torch.no_grad()
+    def get_coarse_match_chunked(self, feat_db_3d, feat_query, data, mask_query=None):
+        """
+        Same matches as `forward` + `get_coarse_match` at inference, computed in chunks of
+        `self.chunk_size` 3D points. Only per-row / per-column running maxima and
+        sums of the dual-softmax are kept, memory is O(chunk_size * S) instead of O(L * S).
+        NOTE: the softmax over 3D points is exp(sim - col_max) / col_sum instead of `F.softmax`,
+        so confidences match the dense path up to float rounding (< 1e-5 relative in fp32), not
+        bitwise. A match can only differ from the dense one if its confidence is within that
+        tolerance of `thr`, or if two candidates of a row / column tie within it. Exact ties in a
+        row keep a single query index (as `get_coarse_match`), and the mutual check is done on it.
+        Args:
+            feat_db_3d (torch.Tensor): [N, L, C] (normalized)
+            feat_query (torch.Tensor): [N, S, C] (normalized)
+            data (dict)
+            mask_query (torch.Tensor): [N, S] (optional)
+        Returns:
+            coarse_matches (dict): same keys as `get_coarse_match`
+        """
+        if self.type != "dual-softmax":
+            raise NotImplementedError(
+                f"Chunked coarse matching only supports dual-softmax, got {self.type}"
+            )
+        N, L, S = feat_db_3d.size(0), feat_db_3d.size(1), feat_query.size(1)
+        device = feat_db_3d.device
+        chunks = [(i, min(i + self.chunk_size, L)) for i in range(0, L, self.chunk_size)]
+
+        if mask_query is not None:
+            _inf = torch.zeros((N, 1, S), dtype=feat_query.dtype, device=device)
+            _inf[~mask_query[:, None].bool()] = -1e9
+        else:
+            _inf = None
+
+        def sim_chunk(start, end):
+            sim = torch.einsum(
+                "nlc,nsc->nls", feat_db_3d[:, start:end], feat_query
+            ) / (self.temperature + 1e-4)
+            return sim + _inf if _inf is not None else sim
+
+        # 1. softmax over 3D points (dim 1): running column max and rescaled sum of exp
+        col_max = torch.full((N, 1, S), -float("inf"), dtype=feat_query.dtype, device=device)
+        col_sum = torch.zeros((N, 1, S), dtype=feat_query.dtype, device=device)
+        for start, end in chunks:
+            sim = sim_chunk(start, end)
+            new_max = torch.maximum(col_max, sim.max(dim=1, keepdim=True)[0])
+            col_sum = col_sum * torch.exp(col_max - new_max) + torch.exp(sim - new_max).sum(
+                dim=1, keepdim=True
+            )
+            col_max = new_max
+
+        # 2. confidence per chunk; keep row max (with its query index) and running column max
+        row_conf = torch.empty((N, L), dtype=feat_query.dtype, device=device)
+        row_j_ids = torch.empty((N, L), dtype=torch.long, device=device)
+        col_conf_max = torch.zeros((N, S), dtype=feat_query.dtype, device=device)
+        for start, end in chunks:
+            sim = sim_chunk(start, end)
+            conf = torch.exp(sim - col_max) / col_sum * F.softmax(sim, 2)
+            row_conf[:, start:end], row_j_ids[:, start:end] = conf.max(dim=2)
+            col_conf_max = torch.maximum(col_conf_max, conf.max(dim=1)[0])
+            del sim, conf
+
+        # 3. threshold, border removal and mutual nearest on the row maxima
+        h1c, w1c = data["q_hw_c"]
+        valid = row_conf > self.thr
+        if "mask0" not in data:
+            if self.border_rm > 0:
+                # NOTE: keep in line with `mask_border`, which only masks top and left borders
+                border = (row_j_ids // w1c < self.border_rm) | (row_j_ids % w1c < self.border_rm)
+                valid = valid & ~border
+        else:
+            raise NotImplementedError
+        valid = valid & (row_conf == torch.gather(col_conf_max, 1, row_j_ids))
+
+        b_ids, i_ids = torch.where(valid)
+        j_ids = row_j_ids[b_ids, i_ids]
+        mconf = row_conf[b_ids, i_ids]
+
+        # 4. Update with matches in original image resolution
+        scale = data["q_hw_i"][0] / data["q_hw_c"][0]
+        scale_total = scale * data["query_image_scale"][b_ids][:, [1, 0]] if "query_image_scale" in data else scale
+        mkpts_query = (
+            torch.stack([j_ids % data["q_hw_c"][1], j_ids // data["q_hw_c"][1]], dim=1)
+            * scale_total
+        )
+        mkpts_3d_db = data["keypoints3d"][b_ids, i_ids]
+
+        return {
+            "b_ids": b_ids,
+            "i_ids": i_ids,
+            "j_ids": j_ids,
+            "gt_mask": mconf == 0,
+            "m_bids": b_ids,
+            "mkpts_3d_db": mkpts_3d_db,
+            "mkpts_query_c": mkpts_query,
+            "mconf": mconf,
+        }
+
     @property
     def n_rand_samples(self):
         return self._n_rand_samples
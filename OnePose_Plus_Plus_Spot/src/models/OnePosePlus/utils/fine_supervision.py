@@ -23,7 +23,16 @@ def fine_supervision(data, config):
         * coarse_scale
     ) # [M, 2]
 
-    fine_gt_location = data['fine_location_matrix_gt'][b_ids, i_ids, j_ids]
+    if 'spv_j_ids' in data:
+        # sparse GT: only the grid point matched by each 3D point has a fine location
+        is_gt = data['spv_j_ids'][b_ids, i_ids] == j_ids
+        fine_gt_location = torch.where(
+            is_gt[:, None],
+            data['spv_fine_location'][b_ids, i_ids],
+            torch.full_like(data['spv_fine_location'][b_ids, i_ids], -50),
+        )
+    else:
+        fine_gt_location = data['fine_location_matrix_gt'][b_ids, i_ids, j_ids]
     gt_offset = fine_gt_location - mkpts_query
     expec_f_gt = (gt_offset) / fine_scale / radius  # [M, 2]
 
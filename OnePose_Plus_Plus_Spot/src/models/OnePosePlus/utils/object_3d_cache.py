@@ -0,0 +1,67 @@
+import os.path as osp
+import torch
+from loguru import logger
+
+
+class Object3DCache():
+    """
+    Cache of the query-independent part of the 3D branch of OnePosePlus_model,
+    i.e. the point cloud features after keypoint encoding and after the leading
+    `self` attention layers of the coarse transformer.
+    The point cloud of one object never changes during a session, so these are
+    computed once and reused for all query frames.
+
+    Entries are keyed on (anno_3d_path, checkpoint hash) and additionally validated
+    against the keypoints3d they were built from (3D padding may be random).
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    @staticmethod
+    def make_key(anno_3d_path, ckpt_hash):
+        return (osp.abspath(anno_3d_path), ckpt_hash)
+
+    def get(self, key, keypoints3d):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+        if (
+            entry["keypoints3d"].shape != keypoints3d.shape
+            or entry["keypoints3d"].device != keypoints3d.device
+            or not torch.equal(entry["keypoints3d"], keypoints3d)
+        ):
+            logger.info(f"3D cache entry of {key[0]} built from other 3D points, rebuild")
+            self._entries.pop(key)
+            return None
+        return entry
+
+    def put(self, key, keypoints3d, desc3d_db, desc3d_db_self):
+        """
+        Args:
+            keypoints3d (torch.Tensor): [1, L, 3]
+            desc3d_db (torch.Tensor): [1, C, L], after keypoint encoding
+            desc3d_db_self (torch.Tensor): [1, L, C], after leading self attention layers
+        """
+        entry = {
+            "keypoints3d": keypoints3d,
+            "desc3d_db": desc3d_db,
+            "desc3d_db_self": desc3d_db_self,
+        }
+        self._entries[key] = entry
+        return entry
+
+    def invalidate(self, anno_3d_path=None):
+        """ Drop entries of one object (all checkpoints), or all entries if anno_3d_path is None """
+        if anno_3d_path is None:
+            self._entries.clear()
+            return
+        anno_3d_path = osp.abspath(anno_3d_path)
+        for key in [key for key in self._entries if key[0] == anno_3d_path]:
+            self._entries.pop(key)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,104 @@
+"""
+Benchmark COLMAP database import of keypoints and matches against the number of image pairs (exhaustive pairs).
+Usage:
+    python -m src.sfm_utils.benchmark_db_import --n_images 50 100 200
+"""
+import os
+import time
+import h5py
+import argparse
+import tempfile
+import numpy as np
+import os.path as osp
+
+from src.utils.colmap.database import COLMAPDatabase
+from src.sfm_utils.triangulation import names_to_pair, import_features, import_matches
+
+
+def make_synthetic_data(work_dir, n_images, n_kpts, n_matches, seed=0):
+    """ Features, matches and exhaustive pairs of n_images fake images, in the layout written by coarse matching """
+    rng = np.random.default_rng(seed)
+    names = [f"/seq/color/{i}.png" for i in range(n_images)]
+    pairs = [(names[i], names[j]) for i in range(n_images) for j in range(i + 1, n_images)]
+
+    feature_path = osp.join(work_dir, "feats.h5")
+    with h5py.File(feature_path, "w") as f:
+        for name in names:
+            f.create_group(name).create_dataset(
+                "keypoints", data=(rng.random((n_kpts, 2)) * 512).astype(np.float32)
+            )
+
+    matches_path = osp.join(work_dir, "matches.h5")
+    with h5py.File(matches_path, "w") as f:
+        for name0, name1 in pairs:
+            f.create_group(names_to_pair(name0, name1)).create_dataset(
+                "matches", data=rng.integers(0, n_kpts, (n_matches, 2))
+            )
+
+    pairs_path = osp.join(work_dir, "pairs.txt")
+    with open(pairs_path, "w") as f:
+        f.write("\n".join(" ".join(pair) for pair in pairs))
+    return names, pairs_path, feature_path, matches_path
+
+
+def make_database(database_path, names):
+    if osp.exists(database_path):
+        os.remove(database_path)
+    db = COLMAPDatabase.connect(database_path)
+    db.create_tables()
+    camera_id = db.add_camera(1, 512, 512, np.array([500.0, 500.0, 256.0, 256.0]))
+    image_ids = {name: db.add_image(name, camera_id, image_id=i + 1) for i, name in enumerate(names)}
+    db.commit()
+    db.close()
+    return image_ids
+
+
+def import_per_row(image_ids, database_path, pairs_path, feature_path, matches_path):
+    """ Reference: one INSERT per image / pair, as before the bulk import """
+    db = COLMAPDatabase.connect(database_path)
+    with h5py.File(feature_path, "r") as feature_file:
+        for image_name, image_id in image_ids.items():
+            db.add_keypoints(image_id, feature_file[image_name]["keypoints"].__array__() + 0.5)
+    with open(pairs_path, "r") as f:
+        pairs = [p.split(" ") for p in f.read().split("\n")]
+    with h5py.File(matches_path, "r") as match_file:
+        for name0, name1 in pairs:
+            matches = match_file[names_to_pair(name0, name1)]["matches"].__array__()
+            db.add_matches(image_ids[name0], image_ids[name1], matches)
+    db.commit()
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_images", type=int, nargs="+", default=[25, 50, 100, 200])
+    parser.add_argument("--n_kpts", type=int, default=2000)
+    parser.add_argument("--n_matches", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'images':>8} {'pairs':>8} {'per-row [s]':>12} {'bulk [s]':>10}")
+    for n_images in args.n_images:
+        with tempfile.TemporaryDirectory() as work_dir:
+            names, pairs_path, feature_path, matches_path = make_synthetic_data(
+                work_dir, n_images, args.n_kpts, args.n_matches
+            )
+            database_path = osp.join(work_dir, "database.db")
+
+            image_ids = make_database(database_path, names)
+            t = time.perf_counter()
+            import_per_row(image_ids, database_path, pairs_path, feature_path, matches_path)
+            t_row = time.perf_counter() - t
+
+            image_ids = make_database(database_path, names)
+            t = time.perf_counter()
+            import_features(image_ids, database_path, feature_path, verbose=False)
+            import_matches(image_ids, database_path, pairs_path, matches_path, feature_path,
+                           match_model="loftr", verbose=False)
+            t_bulk = time.perf_counter() - t
+
+            n_pairs = n_images * (n_images - 1) // 2
+            print(f"{n_images:>8} {n_pairs:>8} {t_row:>12.3f} {t_bulk:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,13 @@ from src.utils.colmap.read_write_model import Camera, Image
 from src.utils.colmap.read_write_model import rotmat2qvec
 from src.utils.colmap.read_write_model import write_model
 from src.utils.data_utils import get_K
+from src.utils.frame_index import load_frame_matrix
 
 
 def get_pose_from_txt(img_index, pose_dir):
     """ Read 4x4 transformation matrix from txt """
     pose_file = osp.join(pose_dir, '{}.txt'.format(img_index))
-    pose = np.loadtxt(pose_file)
+    pose = load_frame_matrix(pose_file)
     
     tvec = pose[:3, 3].reshape(3, )
     qvec = rotmat2qvec(pose[:3, :3]).reshape(4, )
@@ -24,7 +25,7 @@ def get_pose_from_txt(img_index, pose_dir):
 def get_intrin_from_txt(img_index, intrin_dir):
     """ Read 3x3 intrinsic matrix from txt """
     intrin_file = osp.join(intrin_dir, '{}.txt'.format(img_index))
-    intrin = np.loadtxt(intrin_file)
+    intrin = load_frame_matrix(intrin_file)
     
     return intrin
 
@@ -1,9 +1,17 @@
 import numpy as np
 import scipy.spatial.distance as distance
+from scipy.spatial import cKDTree
 from src.utils import path_utils
+from src.utils.frame_index import load_frame_matrix
 
 
-def get_pairswise_distances(pose_files):
+def load_camera_poses(pose_files):
+    """
+    Returns:
+        Rs: np.array [n, 3, 3], camera to world rotations
+        ts: np.array [n, 3], camera centers
+        seqs_ids: dict{seq_name: [image index]}
+    """
     Rs = []
     ts = []
 
@@ -17,7 +25,7 @@ def get_pairswise_distances(pose_files):
             seqs_ids[seq_name].append(i)
          
     for pose_file in pose_files:
-        pose = np.loadtxt(pose_file)
+        pose = load_frame_matrix(pose_file)
         R = pose[:3, :3]
         t = pose[:3, 3:]
         Rs.append(R)
@@ -28,6 +36,11 @@ def get_pairswise_distances(pose_files):
 
     Rs = Rs.transpose(0, 2, 1) # [n, 3, 3]
     ts = -(Rs @ ts)[:, :, 0] # [n, 3, 3] @ [n, 3, 1]
+    return Rs, ts, seqs_ids
+
+
+def get_pairswise_distances(pose_files):
+    Rs, ts, seqs_ids = load_camera_poses(pose_files)
 
     dist = distance.squareform(distance.pdist(ts))
     trace = np.einsum('nji,mji->mn', Rs, Rs, optimize=True)
@@ -37,17 +50,78 @@ def get_pairswise_distances(pose_files):
     return dist, dR, seqs_ids
 
 
-def covis_from_pose(img_lists, covis_pairs_out, num_matched, min_rotation=10):
-    pose_lists = [path_utils.get_gt_pose_path_by_color(color_path) for color_path in img_lists]
-    dist, dR, seqs_ids = get_pairswise_distances(pose_lists)
+def rotation_distances(Rs, query_ids, candidate_ids):
+    """ Relative rotation angles in degree, query_ids: [n], candidate_ids: [n, k] -> [n, k] """
+    trace = np.einsum('nji,nkji->nk', Rs[query_ids], Rs[candidate_ids])
+    dR = np.clip((trace - 1) / 2, -1., 1.)
+    return np.rad2deg(np.abs(np.arccos(dR)))
+
+
+def nearest_valid_kdtree(tree, seq_ids, Rs, ts, query_ids, num_valid, min_rotation):
+    """
+    Nearest cameras of one sequence to each query camera, excluding itself and the ones with rotation <= min_rotation.
+    Queries are batched, the candidate set of a query grows until it has num_valid valid cameras
+    or covers the whole sequence.
+    Returns:
+        list of np.array [<=num_valid], sorted by distance (ties by index)
+    """
+    results = [None] * len(query_ids)
+    todo = np.arange(len(query_ids))
+    k = min(num_valid + 1, len(seq_ids))
+    while len(todo) != 0:
+        dists, nn = tree.query(ts[query_ids[todo]], k=k)
+        dists, nn = dists.reshape(len(todo), k), nn.reshape(len(todo), k)
+        candidates = seq_ids[nn]  # [n, k]
+        order = np.lexsort((candidates, dists), axis=-1)
+        candidates = np.take_along_axis(candidates, order, axis=-1)
+        valid = (candidates != query_ids[todo][:, None]) & (
+            rotation_distances(Rs, query_ids[todo], candidates) > min_rotation
+        )
+
+        done = (valid.sum(-1) >= num_valid) | (k == len(seq_ids))
+        for row in np.nonzero(done)[0]:
+            results[todo[row]] = candidates[row][valid[row]][:num_valid]
+        todo = todo[~done]
+        k = min(2 * k, len(seq_ids))
+    return results
+
 
+def covis_pairs_kdtree(Rs, ts, seqs_ids, num_matched, min_rotation):
+    """
+    KD-tree over camera centers of each sequence, O(n log n) time and O(n * num_matched) memory.
+    Per sequence: of the nearest valid cameras sorted by distance, every other one of the first
+    num_matched_per_seq; if the sequence has no more than 2 * num_matched_per_seq cameras, all valid ones.
+    """
+    num_matched_per_seq = num_matched // len(seqs_ids.keys())
+    query_ids = np.arange(ts.shape[0])
+
+    pairs_per_seq = []
+    for seq_id in seqs_ids:
+        ids = np.array(seqs_ids[seq_id])
+        tree = cKDTree(ts[ids])
+        if num_matched_per_seq * 2 < len(ids):
+            nearest = nearest_valid_kdtree(tree, ids, Rs, ts, query_ids, num_matched_per_seq, min_rotation)
+            nearest = [idx[::2] for idx in nearest]
+        else:
+            nearest = nearest_valid_kdtree(tree, ids, Rs, ts, query_ids, len(ids), min_rotation)
+        pairs_per_seq.append(nearest)
+
+    # Same order as dense mode: query image, then sequence
+    pairs = []
+    for i in range(ts.shape[0]):
+        for nearest in pairs_per_seq:
+            pairs += [(i, j) for j in nearest[i]]
+    return pairs
+
+
+def covis_pairs_dense(dist, dR, seqs_ids, num_matched, min_rotation):
     valid = dR > min_rotation
     np.fill_diagonal(valid, False)
     dist = np.where(valid, dist, np.inf)
 
     pairs = []
     num_matched_per_seq = num_matched // len(seqs_ids.keys())
-    for i in range(len(img_lists)):
+    for i in range(dist.shape[0]):
         dist_i = dist[i]
         for seq_id in seqs_ids:
             ids = np.array(seqs_ids[seq_id])
@@ -59,11 +133,27 @@ def covis_from_pose(img_lists, covis_pairs_out, num_matched, min_rotation=10):
             idx = idx[np.argsort(dist_i[idx])]
             idx = idx[valid[i][idx]]
 
-            for j in idx:
-                name0 = img_lists[i]
-                name1 = img_lists[j]
+            pairs += [(i, j) for j in idx]
+    return pairs
+
+
+def covis_from_pose(img_lists, covis_pairs_out, num_matched, min_rotation=10, method='dense'):
+    """
+    method: 'dense' builds the n*n distance matrices,
+            'kdtree' searches neighbors by a KD-tree over camera centers and scales to large image sets
+            (deterministic: candidates are sorted by distance instead of argpartition order).
+    """
+    pose_lists = [path_utils.get_gt_pose_path_by_color(color_path) for color_path in img_lists]
 
-                pairs.append((name0, name1))
+    if method == 'dense':
+        dist, dR, seqs_ids = get_pairswise_distances(pose_lists)
+        pairs = covis_pairs_dense(dist, dR, seqs_ids, num_matched, min_rotation)
+    elif method == 'kdtree':
+        Rs, ts, seqs_ids = load_camera_poses(pose_lists)
+        pairs = covis_pairs_kdtree(Rs, ts, seqs_ids, num_matched, min_rotation)
+    else:
+        raise NotImplementedError
 
+    pairs = [(img_lists[i], img_lists[j]) for i, j in pairs]
     with open(covis_pairs_out, 'w') as f:
         f.write('\n'.join(' '.join([i, j]) for i, j in pairs))
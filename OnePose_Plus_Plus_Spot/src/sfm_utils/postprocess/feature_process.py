@@ -1,6 +1,5 @@
 from itertools import chain
 import h5py
-from ray.actor import ActorHandle
 from tqdm import tqdm
 import json
 import os
@@ -8,25 +7,10 @@ import os.path as osp
 import numpy as np
 from tqdm import tqdm
 from loguru import logger
-import ray
-import math
 
-from collections import defaultdict
 from pathlib import Path
 
 from src.utils.colmap import read_write_model
-from src.utils.ray_utils import ProgressBar, chunks, chunk_index, split_dict
-
-cfgs = {
-    "ray": {
-        "slurm": False,
-        "n_workers": 4,
-        "n_cpus_per_worker": 1,
-        "n_gpus_per_worker": 0.25,
-        "local_mode": False,
-    },
-}
-
 
 def get_box_path(img_path):
     return img_path.replace("color", "bbox").replace(".png", ".txt")
@@ -69,34 +53,6 @@ def id_mapping(points_idxs):
     return kp3d_id_mapping
 
 
-def gather_3d_anno(
-    keypoints_2d,
-    descriptors_2d,
-    scores_2d,
-    kp3d_ids,
-    feature_idxs,
-    kp3d_id_feature,
-    kp3d_id_score,
-):
-    """ For each 3d point, gather all corresponding 2d information """
-    kp3d_id_to_kp2d_idx = {}
-    for kp3d_id, feature_idx in zip(kp3d_ids, feature_idxs):
-        kp3d_id_to_kp2d_idx[kp3d_id] = feature_idx
-
-        if kp3d_id not in kp3d_id_feature:
-            kp3d_id_feature[kp3d_id] = descriptors_2d[:, feature_idx][None]
-            kp3d_id_score[kp3d_id] = scores_2d[feature_idx][None]
-        else:
-            kp3d_id_feature[kp3d_id] = np.append(
-                kp3d_id_feature[kp3d_id], descriptors_2d[:, feature_idx][None], axis=0
-            )
-            kp3d_id_score[kp3d_id] = np.append(
-                kp3d_id_score[kp3d_id], scores_2d[feature_idx][None], axis=0
-            )
-
-    return kp3d_id_feature, kp3d_id_score, kp3d_id_to_kp2d_idx
-
-
 def read_features(feature):
     """ decouple keypoints, descriptors and scores from feature """
     keypoints_2d = feature["keypoints"].__array__()
@@ -106,211 +62,70 @@ def read_features(feature):
     return keypoints_2d, descriptors_2d, scores_2d
 
 
-def count_features(img_lists, features, images, kp3d_id_mapping, verbose=True):
-    """ Search for valid 2d-3d correspondences; Count 3d features. """
-    kp3d_idx_feature = {}  # {new_3d_point_idx: [feature1, feature2, ...]}
-    kp3d_idx_score = {}  # {new_3d_point_idx: [score1, score2, ...]}
-    kp3d_idx_to_img_kp2d_idx = defaultdict(
-        dict
-    )  # {new_3d_point_idx: {image_name: 2d_point_idx}}
+def aggregate_track_features(img_lists, features, images, points_idxs, verbose=True):
+    """
+    Columnar aggregation of 2D features for each (merged) 3D point.
+    One pass over images concatenates the valid 2D-3D observations (track_id, image, kp2d_idx)
+    and their descriptors of all images, then the mean descriptor of each merged 3D point is
+    computed by one `np.add.at` segment sum over the observations sorted by point.
+    @param points_idxs: {new_point_id: [old_point1_id, old_point2_id, ...]}
+    Return:
+        feature_dim: int
+        avg_descriptors: [n_new_points, dim]
+        avg_scores: [n_new_points, 1] (fake score, all ones)
+        kp3d_idx_to_img_kp2d_idx: {image_name: {old_3d_point_idx: 2d_point_idx}}
+    """
+    n_points = len(points_idxs)
+    # old 3d point id => new 3d point id and rank of old point within its merged group:
+    old_ids = np.concatenate([np.asarray(v, dtype=np.int64).reshape(-1) for v in points_idxs.values()])
+    new_ids = np.concatenate(
+        [np.full(len(v), k, dtype=np.int64) for k, v in points_idxs.items()]
+    )
+    group_ranks = np.concatenate([np.arange(len(v), dtype=np.int64) for v in points_idxs.values()])
+    assert list(points_idxs.keys()) == list(range(n_points)), "new point ids should be 0...n-1 in order"
+    sorter = np.argsort(old_ids)
+    old_ids_sorted = old_ids[sorter]
+    assert np.all(np.diff(old_ids_sorted) > 0), "old point id belongs to several merged points"
 
-    inverse_dict = inverse_id_name(images)  # {image_name: id}
-    # traverse each image to find valid 2d-3d correspondence
-    logger.info("Count features begin...")
-    if verbose:
-        iter_obj = tqdm(img_lists)
-    else:
-        iter_obj = img_lists
+    kp3d_idx_to_img_kp2d_idx = {}  # {image_name: {old_3d_point_idx: 2d_point_idx}}
+    obs_old_ids, obs_descriptors = [], []
 
+    inverse_dict = inverse_id_name(images)  # {image_name: id}
+    logger.info("Aggregate track features begin...")
+    iter_obj = tqdm(img_lists) if verbose else img_lists
     for img_name in iter_obj:
-        feature = features[img_name]
-        keypoints_2d, descriptors_2d, scores_2d = read_features(feature)
+        keypoints_2d, descriptors_2d, scores_2d = read_features(features[img_name])
         feature_dim = descriptors_2d.shape[0]
+        point3D_ids = images[inverse_dict[img_name]].point3D_ids
 
-        id_ = inverse_dict[img_name]
-        image_info = images[id_]
-        point3D_ids = image_info.point3D_ids
-
-        filter_feature_idxs = (
-            []
-        )  # record valid 2d point idxs. Each of these 2d points have a correspondence with a 3d point.
-        filter_kp3d_ids = (
-            []
-        )  # record valid 3d point idxs. Each of these 3d points have a correspondence with a 2d point in this image.
-        feature_idxs = (
-            np.where(point3D_ids != -1)[0] if np.any(point3D_ids != -1) else None
-        )
-        if feature_idxs is None:
-            kp3d_idx_to_img_kp2d_idx[img_name] = {}
-        else:
-            for feature_idx in feature_idxs:
-                kp3d_id = point3D_ids[feature_idx]
-                if (
-                    kp3d_id in kp3d_id_mapping.keys()
-                ):  # select 3d points which are kept after filter
-                    filter_kp3d_ids.append(kp3d_id)
-                    filter_feature_idxs.append(feature_idx)
-
-            kp3d_idx_feature, kp3d_idx_score, kp3d_idx_to_kp2d_idx = gather_3d_anno(
-                keypoints_2d,
-                descriptors_2d,
-                scores_2d,
-                filter_kp3d_ids,
-                filter_feature_idxs,
-                kp3d_idx_feature,
-                kp3d_idx_score,
-            )
-
-            kp3d_idx_to_img_kp2d_idx[img_name] = kp3d_idx_to_kp2d_idx
-
-    return feature_dim, kp3d_idx_feature, kp3d_idx_score, kp3d_idx_to_img_kp2d_idx
-
-
-def collect_descriptors(descriptors, feature_dim, num_leaf):
-    num_descriptors = descriptors.shape[0]
-    if num_descriptors < num_leaf:
-        ret_descriptors = np.append(
-            descriptors, np.ones((feature_dim, num_leaf - num_descriptors))
-        )
-    else:
-        ret_descriptors = descriptors[:num_leaf]
-
-    return ret_descriptors
+        # valid 2d points: registered to a 3d point which is kept after filter
+        feature_idxs = np.where(point3D_ids != -1)[0]
+        kp3d_ids = point3D_ids[feature_idxs].astype(np.int64)
+        pos = np.minimum(np.searchsorted(old_ids_sorted, kp3d_ids), len(old_ids_sorted) - 1)
+        valid = old_ids_sorted[pos] == kp3d_ids
+        feature_idxs, kp3d_ids = feature_idxs[valid], kp3d_ids[valid]
 
+        kp3d_idx_to_img_kp2d_idx[img_name] = dict(zip(kp3d_ids.tolist(), feature_idxs.tolist()))
+        obs_old_ids.append(kp3d_ids)
+        obs_descriptors.append(descriptors_2d[:, feature_idxs].T)
 
-def collect_scores(scores, num_leaf):
-    num_scores = scores.shape[0]
-    if num_scores < num_leaf:
-        ret_scores = np.append(scores, np.zeros((num_leaf - num_scores, 1)), axis=0)
-    else:
-        ret_scores = scores[:num_leaf]
+    obs_old_ids = np.concatenate(obs_old_ids)
+    obs_descriptors = np.concatenate(obs_descriptors, axis=0)  # [n_obs, dim]
+    obs_group = sorter[np.searchsorted(old_ids_sorted, obs_old_ids)]
+    obs_new_ids, obs_ranks = new_ids[obs_group], group_ranks[obs_group]
 
-    return ret_scores
+    # Sort observations by (new point, old point rank in group); stable, so image order is kept:
+    order = np.lexsort((obs_ranks, obs_new_ids))
+    counts = np.bincount(obs_new_ids, minlength=n_points)
+    assert np.all(counts > 0), "3D point without any 2D observation"
 
+    # Unbuffered segment sum, accumulates in sorted order (same rounding as np.mean per point):
+    sum_descriptors = np.zeros((n_points, obs_descriptors.shape[1]), dtype=obs_descriptors.dtype)
+    np.add.at(sum_descriptors, obs_new_ids[order], obs_descriptors[order])
+    avg_descriptors = sum_descriptors / counts[:, None].astype(obs_descriptors.dtype)  # N*D
+    avg_scores = np.ones((n_points, 1))  # N*1 Fake score!
 
-def collect_3d_ann_v2(
-    kp3d_id_feature, kp3d_id_score, xyzs, points_idxs, feature_dim, num_leaf
-):
-    kp3d_position = np.empty(shape=(0, 3))
-    kp3d_descriptors = np.empty(shape=(0, feature_dim))
-    kp3d_scores = np.empty(shape=(0, 1))
-
-    for new_point_idx, old_points_idxs in points_idxs.items():
-        descriptors = np.empty(shape=(0, feature_dim))
-        scores = np.empty(shape=(0, 1))
-        for old_point_idx in old_points_idxs:
-            descriptors = np.append(descriptors, kp3d_id_feature[old_point_idx], axis=0)
-            scores = np.append(
-                scores, kp3d_id_score[old_point_idx].reshape(-1, 1), axis=0
-            )
-
-        descriptors = collect_descriptors(descriptors, feature_dim, num_leaf)
-        scores = collect_scores(scores, num_leaf)
-
-        kp3d_position = np.append(
-            kp3d_position, xyzs[new_point_idx].reshape(1, 3), axis=0
-        )
-        kp3d_descriptors = np.append(kp3d_descriptors, descriptors, axis=0)
-        kp3d_scores = np.append(kp3d_scores, scores, axis=0)
-
-    assert kp3d_descriptors.shape[0] == kp3d_position.shape[0] * num_leaf
-    assert kp3d_scores.shape[0] == kp3d_position.shape[0] * num_leaf
-
-    return kp3d_position, kp3d_descriptors, kp3d_scores
-
-
-def average_3d_ann(kp3d_id_feature, kp3d_id_score, xyzs, points_idxs, feature_dim):
-    """ 
-    average position, descriptors and scores for 3d points 
-    new_point_feature = avg(all merged 3d points features) = avg(all matched 2d points features)
-    """
-    kp3d_descriptors = np.empty(shape=(0, feature_dim))
-    kp3d_scores = np.empty(shape=(0, 1))
-    kp3d_position = np.empty(shape=(0, 3))
-
-    # idx = 0
-    # kp_position_mapping = {} # {point idx in kp3d_position: idx in filtered 3d points}
-    for new_point_idx, old_points_idxs in points_idxs.items():
-        descriptors = np.empty(shape=(0, feature_dim))
-        scores = np.empty(shape=(0, 1))
-        for old_point_idx in old_points_idxs:
-            descriptors = np.append(descriptors, kp3d_id_feature[old_point_idx], axis=0)
-            scores = np.append(
-                scores, kp3d_id_score[old_point_idx].reshape(-1, 1), axis=0
-            )
-
-        avg_descriptor = np.mean(descriptors, axis=0).reshape(1, -1)
-        avg_score = np.mean(scores, axis=0).reshape(1, -1)
-
-        kp3d_position = np.append(
-            kp3d_position, xyzs[new_point_idx].reshape(1, 3), axis=0
-        )
-
-        kp3d_descriptors = np.append(kp3d_descriptors, avg_descriptor, axis=0)
-        kp3d_scores = np.append(kp3d_scores, avg_score, axis=0)
-
-    return kp3d_position, kp3d_descriptors, kp3d_scores
-
-
-def gather_3d_ann(
-    kp3d_id_feature,
-    kp3d_id_score,
-    xyzs,
-    points_idxs,
-    pba: ActorHandle = None,
-    verbose=True,
-):
-    """ 
-    Gather affiliated 2d points' positions, (mean/concated)descriptors and scores for each 3d points
-    """
-    kp3d_descriptors = None
-    kp3d_scores = np.empty(shape=(0, 1))
-    kp3d_position = np.empty(shape=(0, 3))
-    idxs = []
-
-    if verbose:
-        if pba is None:
-            logger.info("Gather 3D ann begin...")
-            points_idxs = tqdm(points_idxs.items())
-        else:
-            points_idxs = points_idxs.items()
-    else:
-        assert pba is None
-        points_idxs = points_idxs.items()
-
-    for new_point_idx, old_points_idxs in points_idxs:
-        descriptors = None
-        scores = np.empty(shape=(0, 1))
-        for old_point_idx in old_points_idxs:
-            descriptors = (
-                np.append(descriptors, kp3d_id_feature[old_point_idx], axis=0)
-                if descriptors is not None
-                else kp3d_id_feature[old_point_idx]
-            )
-            scores = np.append(
-                scores, kp3d_id_score[old_point_idx].reshape(-1, 1), axis=0
-            )
-
-        kp3d_position = np.append(
-            kp3d_position, xyzs[new_point_idx].reshape(1, 3), axis=0
-        )
-        kp3d_descriptors = (
-            np.append(kp3d_descriptors, descriptors, axis=0)
-            if kp3d_descriptors is not None
-            else descriptors
-        )
-        kp3d_scores = np.append(kp3d_scores, scores, axis=0)
-        idxs.append(descriptors.shape[0] if descriptors is not None else 0)
-
-        if pba is not None:
-            pba.update.remote(1)
-
-    return kp3d_position, kp3d_descriptors, kp3d_scores, np.array(idxs)
-
-
-@ray.remote(num_cpus=1)
-def gather_3d_ann_ray_wrapper(*args, **kwargs):
-    return gather_3d_ann(*args, **kwargs)
+    return feature_dim, avg_descriptors, avg_scores, kp3d_idx_to_img_kp2d_idx
 
 
 def save_3d_anno(xyzs, descriptors, scores, out_path):
@@ -524,23 +339,6 @@ def mean_scores(scores, idxs):
     return avg_scores
 
 
-def mean_descriptors_and_scores(descriptors, scores, idxs):
-    cumsum_idxs = np.cumsum(idxs)
-    pre_cumsum_idxs = np.cumsum(idxs)[:-1]
-    pre_cumsum_idxs = np.insert(pre_cumsum_idxs, 0, 0)
-
-    avg_descriptors = []
-    for i, (start, end) in enumerate(zip(pre_cumsum_idxs, cumsum_idxs)):
-        descriptors_span = descriptors[start:end]
-        scores_span = scores[start:end]
-        avg_descriptors.append(np.mean(descriptors_span, axis=0, keepdims=True))
-
-    avg_descriptors = np.concatenate(avg_descriptors, axis=0)  # N*D
-    avg_scores = np.ones((avg_descriptors.shape[0], 1))  # N*1 Fake score!
-
-    return avg_descriptors, avg_scores, idxs
-
-
 def get_kpt_ann(
     cfg,
     img_lists,
@@ -559,77 +357,21 @@ def get_kpt_ann(
                         new_point_id: [0, xyzs.shape[0]]
                         old_point_id*: point idx in Points3D.bin
                         This param is used to record the relationship of points after filter and before filter.
+    @param use_ray: unused, kept for interface compatibility (aggregation is vectorized)
     """
     model_dir, anno_out_dir = get_default_path(cfg, outputs_dir)
 
     cameras, images, points3D = read_write_model.read_model(model_dir, ext=".bin")
     features = h5py.File(feature_file_path, "r")
 
-    # step 1
-    kp3d_id_mapping = id_mapping(points_idxs)
-    kp3d_id_mapping = kp3d_id_mapping
+    # Gather 2D features of each 3D point and average them:
     (
         feature_dim,
-        kp3d_id_feature,
-        kp3d_id_score,
-        kp3d_idx_to_img_kp2d_idx,
-    ) = count_features(img_lists, features, images, kp3d_id_mapping, verbose=verbose)
-
-    # step 2
-    if use_ray:
-        # Parallel gather:
-        cfg_ray = cfgs["ray"]
-        if cfg_ray["slurm"]:
-            ray.init(address=os.environ["ip_head"])
-        else:
-            ray.init(
-                num_cpus=math.ceil(cfg_ray["n_workers"] * cfg_ray["n_cpus_per_worker"]),
-                num_gpus=math.ceil(cfg_ray["n_workers"] * cfg_ray["n_gpus_per_worker"]),
-                local_mode=cfg_ray["local_mode"],
-                ignore_reinit_error=True,
-            )
-        pb = (
-            ProgressBar(len(points_idxs), "Gather 3D annotations...")
-            if verbose
-            else None
-        )
-        points_idxs_chunked = split_dict(
-            points_idxs, math.ceil(len(points_idxs) / cfg_ray["n_workers"])
-        )
-
-        kp3d_id_feature_ = ray.put(kp3d_id_feature)
-        obj_refs = [
-            gather_3d_ann_ray_wrapper.remote(
-                kp3d_id_feature_,
-                kp3d_id_score,
-                xyzs,
-                sub_points_ids,
-                pb.actor if pb is not None else None,
-                verbose=verbose,
-            )
-            for sub_points_ids in points_idxs_chunked
-        ]
-        pb.print_until_done() if pb is not None else None
-        results = ray.get(obj_refs)
-        filter_xyzs = np.concatenate([k for k, _, _, _ in results], axis=0)
-        filter_descriptors = np.concatenate([k for _, k, _, _ in results], axis=0)
-        filter_scores = np.concatenate([k for _, _, k, _ in results], axis=0)
-        idxs = np.concatenate([k for _, _, _, k in results], axis=0)
-        logger.info("Gather 3D annotation finish!")
-    else:
-        filter_xyzs, filter_descriptors, filter_scores, idxs = gather_3d_ann(
-            kp3d_id_feature, kp3d_id_score, xyzs, points_idxs, verbose=verbose
-        )
-
-    (
         avg_descriptors,
         avg_scores,
-        idxs,
-    ) = mean_descriptors_and_scores(
-        filter_descriptors,
-        filter_scores,
-        idxs,
-    )
+        kp3d_idx_to_img_kp2d_idx,
+    ) = aggregate_track_features(img_lists, features, images, points_idxs, verbose=verbose)
+    filter_xyzs = np.stack([xyzs[new_point_idx] for new_point_idx in points_idxs]).reshape(-1, 3).astype(np.float64)
 
     anno2d_out_path = osp.join(anno_out_dir, "anno_2d.json")
     save_2d_anno(
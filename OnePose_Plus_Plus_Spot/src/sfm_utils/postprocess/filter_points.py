@@ -7,24 +7,34 @@ from loguru import logger
 from src.utils.colmap import read_write_model 
 
 
+def points3d_to_arrays(points3D):
+    """
+    Convert colmap points3D dict to array-backed storage sorted by point id.
+    Return:
+        points_idxs: [n] point ids
+        xyzs: [n, 3]
+        track_lengths: [n] number of 2D observations of each point
+    """
+    points_idxs = np.array(sorted(points3D.keys()), dtype=int)
+    if len(points_idxs) == 0:
+        return points_idxs, np.empty(shape=[0, 3]), np.empty(shape=[0], dtype=int)
+    xyzs = np.stack([points3D[idx_3d].xyz for idx_3d in points_idxs]).reshape(-1, 3)
+    track_lengths = np.fromiter(
+        (len(points3D[idx_3d].point2D_idxs) for idx_3d in points_idxs),
+        dtype=int,
+        count=len(points_idxs),
+    )
+    return points_idxs, xyzs, track_lengths
+
+
 def filter_by_track_length(points3D, track_length):
     """ 
         Filter 3d points by track length.
         Return new pcds and corresponding point ids in origin pcds.
     """
-    idxs_3d = list(points3D.keys())
-    idxs_3d.sort()
-    xyzs = np.empty(shape=[0, 3])
-    points_idxs = np.empty(shape=[0], dtype=int)
-    for i in range(len(idxs_3d)):
-        idx_3d = idxs_3d[i]
-        if len(points3D[idx_3d].point2D_idxs) < track_length:
-            continue
-        xyz = points3D[idx_3d].xyz.reshape(1, -1)
-        xyzs = np.append(xyzs, xyz, axis=0)
-        points_idxs = np.append(points_idxs, idx_3d)
-    
-    return xyzs, points_idxs
+    points_idxs, xyzs, track_lengths = points3d_to_arrays(points3D)
+    keep = track_lengths >= track_length
+    return xyzs[keep].astype(np.float64), points_idxs[keep]
 
 
 def get_3d_box_pose(bbox_path):
@@ -265,36 +275,34 @@ def filter_track_length(model_path, track_length):
 def merge(xyzs, points_idxs, dist_threshold=1e-3):
     """ 
     Merge points which are close to others. ({[x1, y1], [x2, y2], ...} => [mean(x_i), mean(y_i)])
+    Neighbors are found with a KD-tree, so memory is O(n * k) instead of a dense n*n distance matrix.
     """
-    from scipy.spatial.distance import pdist, squareform
+    from scipy.spatial import cKDTree
     
     if not isinstance(xyzs, np.ndarray):
         xyzs = np.array(xyzs)
+    points_idxs = np.asarray(points_idxs)
 
-    dist = pdist(xyzs, 'euclidean')
-    distance_matrix = squareform(dist)
-    close_than_thresh = distance_matrix < dist_threshold
-
-    ret_points_count = 0 # num of return points
-    ret_points = np.empty(shape=[0, 3]) # pcds after merge
+    ret_points = [] # pcds after merge
     ret_idxs = {} # {new_point_idx: points idxs in Points3D}
+    if xyzs.shape[0] == 0:
+        return np.empty(shape=[0, 3]), ret_idxs
+
+    tree = cKDTree(xyzs)
+    neighbors = tree.query_ball_point(xyzs, r=dist_threshold)
 
-    points3D_idx_record = [] # points that have been merged
-    for j in range(distance_matrix.shape[0]):
-        idxs = close_than_thresh[j] 
+    merged = np.zeros(xyzs.shape[0], dtype=bool) # points that have been merged
+    for j in range(xyzs.shape[0]):
+        idxs = np.sort(np.asarray(neighbors[j], dtype=int))
+        # Keep only points strictly closer than threshold (ball query is inclusive):
+        dist = np.sqrt(np.sum((xyzs[idxs].astype(np.float64) - xyzs[j].astype(np.float64)) ** 2, axis=-1))
+        idxs = idxs[dist < dist_threshold]
 
-        # TODO: check
-        if np.isin(points_idxs[idxs], points3D_idx_record).any():
+        if merged[idxs].any():
             continue
 
-        points = np.mean(xyzs[idxs], axis=0) # new point
-        ret_points = np.append(ret_points, points.reshape(1, 3), axis=0)
-        ret_idxs[ret_points_count] = points_idxs[idxs]
-        ret_points_count += 1
-        
-        points3D_idx_record = points3D_idx_record + points_idxs[idxs].tolist()
+        ret_idxs[len(ret_points)] = points_idxs[idxs]
+        ret_points.append(np.mean(xyzs[idxs], axis=0)) # new point
+        merged[idxs] = True
     
-    return ret_points, ret_idxs
-
-
-    
\ No newline at end of file
+    return np.stack(ret_points).reshape(-1, 3).astype(np.float64), ret_idxs
@@ -1,4 +1,5 @@
 import os
+import math
 import h5py
 import logging
 import tqdm
@@ -8,7 +9,7 @@ import numpy as np
 import ray
 
 from pathlib import Path
-from src.utils.colmap.read_write_model import CAMERA_MODEL_NAMES, Image, read_cameras_binary, read_images_binary
+from src.utils.colmap.read_write_model import CAMERA_MODEL_NAMES, Image, read_cameras_binary, read_images_binary, read_model, write_model
 from src.utils.colmap.database import COLMAPDatabase
 
 
@@ -35,6 +36,16 @@ def geometric_verification(colmap_path, database_path, pairs_path, verbose=True)
         exit(ret)
 
 
+def read_h5_arrays(h5_file, dataset_paths):
+    """ Read whole datasets by the low level h5py API, ~4x faster than `h5_file[path].__array__()` for small datasets """
+    for path in dataset_paths:
+        dset = h5py.h5d.open(h5_file.id, path.encode())
+        array = np.empty(dset.shape, dtype=dset.dtype)
+        if array.size != 0:
+            dset.read(h5py.h5s.ALL, h5py.h5s.ALL, array)
+        yield array
+
+
 def create_db_from_model(empty_model, database_path):
     """ Create COLMAP database file from empty COLMAP binary file. """
     if database_path.exists():
@@ -59,23 +70,26 @@ def create_db_from_model(empty_model, database_path):
     return {image.name: i for i, image in images.items()}
 
 
-def import_features(image_ids, database_path, feature_path, verbose=True):
-    """ Import keypoints info into COLMAP database. """
+def import_features(image_ids, database_path, feature_path, verbose=True, chunk_size=1000):
+    """ Import keypoints info into COLMAP database, in one transaction and chunks of `chunk_size` images. """
     logging.info("Importing features into the database...")
     feature_file = h5py.File(str(feature_path), 'r')
     db = COLMAPDatabase.connect(database_path)
-    
+    db.begin_bulk_import()
+
+    items = list(image_ids.items())
+    iter_obj = range(0, len(items), chunk_size)
     if verbose:
-        iter_obj = tqdm.tqdm(image_ids.items())
-    else:
-        iter_obj = image_ids.items()
-    for image_name, image_id in iter_obj:
-        keypoints = feature_file[image_name]['keypoints'].__array__()
-        keypoints += 0.5
-        db.add_keypoints(image_id, keypoints)
-    
+        iter_obj = tqdm.tqdm(iter_obj, total=math.ceil(len(items) / chunk_size))
+    for start in iter_obj:
+        chunk = items[start:start + chunk_size]
+        keypoints = read_h5_arrays(feature_file, [f"{image_name}/keypoints" for image_name, _ in chunk])
+        db.add_keypoints_many(
+            (image_id, kpts + 0.5) for (_, image_id), kpts in zip(chunk, keypoints)
+        )
+
     feature_file.close()
-    db.commit()
+    db.end_bulk_import()
     db.close()
 
 
@@ -104,61 +118,61 @@ def in_box(keypoints, box):
 
 
 def import_matches(image_ids, database_path, pairs_path, matches_path, feature_path, match_model='superpoint', \
-                   min_match_score=None, skip_geometric_verification=False, verbose=True):
-    """ Import matches info into COLMAP database. """
+                   min_match_score=None, skip_geometric_verification=False, verbose=True, chunk_size=1000):
+    """ Import matches info into COLMAP database, in one transaction and chunks of `chunk_size` pairs. """
     logging.info("Importing matches into the database...")
 
-    feature_file = h5py.File(str(feature_path), 'r')
     with open(str(pairs_path), 'r') as f:
         pairs = [p.split(' ') for p in f.read().split('\n')]
     
     match_file = h5py.File(str(matches_path), 'r')
     db = COLMAPDatabase.connect(database_path)
+    db.begin_bulk_import()
     
+    iter_obj = range(0, len(pairs), chunk_size)
     if verbose:
-        iter_obj = tqdm.tqdm(pairs)
-    else:
-        iter_obj = pairs
+        iter_obj = tqdm.tqdm(iter_obj, total=math.ceil(len(pairs) / chunk_size))
     matched = set()
-    for name0, name1 in iter_obj:
-        id0, id1 = image_ids[name0], image_ids[name1]
-        if len({(id0, id1), (id1, id0)} & matched) > 0:
-            continue
-    
-        pair = names_to_pair(name0, name1)
-        if pair not in match_file:
-            raise ValueError(
-                f'Could not find pair {(name0, name1)}... '
-                'Maybe you matched with a different list of pairs? '
-                f'Reverse in file: {names_to_pair(name0, name1) in match_file}.'
-            )
-        
-        if match_model != 'loftr':
-            matches = match_file[pair]['matches0'].__array__()
-            valid = matches > -1
-        else:
-            matches = match_file[pair]['matches'].__array__()
-            valid = np.ones((matches.shape[0],), dtype=np.bool) # all True
+    for start in iter_obj:
+        chunk = []
+        for name0, name1 in pairs[start:start + chunk_size]:
+            id0, id1 = image_ids[name0], image_ids[name1]
+            if len({(id0, id1), (id1, id0)} & matched) > 0:
+                continue
+
+            pair = names_to_pair(name0, name1)
+            if pair not in match_file:
+                raise ValueError(
+                    f'Could not find pair {(name0, name1)}... '
+                    'Maybe you matched with a different list of pairs? '
+                    f'Reverse in file: {names_to_pair(name0, name1) in match_file}.'
+                )
 
-        if min_match_score:
-            scores = match_file[pair]['matching_scores0'].__array__()
-            valid = valid & (scores > min_match_score)
+            if match_model != 'loftr':
+                matches, = read_h5_arrays(match_file, [f"{pair}/matches0"])
+                valid = matches > -1
+            else:
+                matches, = read_h5_arrays(match_file, [f"{pair}/matches"])
+                valid = np.ones((matches.shape[0],), dtype=bool) # all True
 
-        img_type = name0.split('/')[-2]
+            if min_match_score:
+                scores, = read_h5_arrays(match_file, [f"{pair}/matching_scores0"])
+                valid = valid & (scores > min_match_score)
 
-        if match_model != 'loftr':
-            matches = np.stack([np.where(valid)[0], matches[valid]], -1)
-        else:
-            matches = matches[valid]
+            if match_model != 'loftr':
+                matches = np.stack([np.where(valid)[0], matches[valid]], -1)
+            else:
+                matches = matches[valid]
 
-        db.add_matches(id0, id1, matches)
-        matched |= {(id0, id1), (id1, id0)}
+            chunk.append((id0, id1, matches))
+            matched |= {(id0, id1), (id1, id0)}
 
+        db.add_matches_many(chunk)
         if skip_geometric_verification:
-            db.add_two_view_geometry(id0, id1, matches)
+            db.add_two_view_geometries_many(chunk)
     
     match_file.close()
-    db.commit()
+    db.end_bulk_import()
     db.close()
 
 
@@ -239,6 +253,113 @@ def main(sfm_dir, empty_sfm_model, outputs_dir, pairs, features, matches, match_
     stats = run_triangulation(colmap_path, model, database, image_dir, empty_sfm_model, verbose=verbose)
     os.system(f'colmap model_converter --input_path {model} --output_path {outputs_dir}/model.ply --output_type PLY')
 
+def get_registered_image_ids(database_path):
+    """ {image_name: image_id} of the images already in a COLMAP database """
+    db = COLMAPDatabase.connect(database_path)
+    image_ids = {name: image_id for image_id, name in db.execute("SELECT image_id, name FROM images")}
+    db.close()
+    return image_ids
+
+
+def register_new_images(empty_model, base_model, database_path, feature_path, verbose=True):
+    """
+    Add the images of `empty_model` missing from the database (cameras, images, keypoints), and extend
+    the keypoints of already registered images by the ones appended by incremental coarse matching.
+    Returns:
+        image_ids: {image_name: image_id} of all images
+        input_model: (cameras, images, points3D) of `base_model` plus the new posed images, triangulation input
+    """
+    cameras, images, points3D = read_model(str(base_model), ext='.bin')
+    empty_cameras = read_cameras_binary(str(Path(empty_model) / 'cameras.bin'))
+    empty_images = read_images_binary(str(Path(empty_model) / 'images.bin'))
+    base_name2id = {image.name: image_id for image_id, image in images.items()}
+
+    db = COLMAPDatabase.connect(database_path)
+    image_ids = {name: image_id for image_id, name in db.execute("SELECT image_id, name FROM images")}
+    num_keypoints = dict(db.execute("SELECT image_id, rows FROM keypoints"))
+    next_camera_id = max(db.execute("SELECT MAX(camera_id) FROM cameras").fetchone()[0] or 0, max(cameras, default=0)) + 1
+    next_image_id = max(max(image_ids.values(), default=0), max(images, default=0)) + 1
+
+    feature_file = h5py.File(str(feature_path), 'r')
+    iter_obj = tqdm.tqdm(empty_images.values()) if verbose else empty_images.values()
+    num_new, num_extended = 0, 0
+    for empty_image in iter_obj:
+        keypoints = feature_file[empty_image.name]['keypoints'].__array__() + 0.5
+
+        if empty_image.name not in image_ids:
+            # New image, xys are filled from the database by COLMAP:
+            camera = empty_cameras[empty_image.camera_id]
+            db.add_camera(CAMERA_MODEL_NAMES[camera.model].model_id, camera.width, camera.height, camera.params,
+                          camera_id=next_camera_id, prior_focal_length=True)
+            db.add_image(empty_image.name, next_camera_id, image_id=next_image_id)
+            db.add_keypoints(next_image_id, keypoints)
+            cameras[next_camera_id] = camera._replace(id=next_camera_id)
+            images[next_image_id] = empty_image._replace(
+                id=next_image_id, camera_id=next_camera_id, xys=np.zeros((0, 2)), point3D_ids=np.full(0, -1, int)
+            )
+            image_ids[empty_image.name] = next_image_id
+            next_camera_id += 1
+            next_image_id += 1
+            num_new += 1
+            continue
+
+        # Registered image, keypoint indices are stable and new keypoints are appended:
+        image_id = image_ids[empty_image.name]
+        n_old = num_keypoints[image_id]
+        assert keypoints.shape[0] >= n_old, f"Keypoints of {empty_image.name} are not append-only"
+        if keypoints.shape[0] > n_old:
+            db.execute("DELETE FROM keypoints WHERE image_id=?", (image_id,))
+            db.add_keypoints(image_id, keypoints)
+            num_extended += 1
+
+        if empty_image.name in base_name2id:
+            image = images.pop(base_name2id[empty_image.name])
+            images[image_id] = image._replace(
+                id=image_id,
+                xys=np.concatenate([image.xys, keypoints[image.xys.shape[0]:]]),
+                point3D_ids=np.concatenate([image.point3D_ids, np.full(keypoints.shape[0] - image.xys.shape[0], -1, int)]),
+            )
+
+    feature_file.close()
+    db.commit()
+    db.close()
+    logging.info(f"{num_new} new images registered, keypoints of {num_extended} images extended")
+    return image_ids, (cameras, images, points3D)
+
+
+def main_incremental(sfm_dir, empty_sfm_model, base_model, outputs_dir, new_pairs, features, matches, match_model='loftr', \
+                     colmap_path='colmap', skip_geometric_verification=False, min_match_score=None, image_dir=None, verbose=True):
+    """
+        Register new images into the database of an existing reconstruction and continue its tracks.
+        Only the matches of `new_pairs` (pairs with at least one new image) are imported and verified,
+        the existing points of `base_model` are kept and extended by point triangulator.
+    """
+    database = osp.join(sfm_dir, 'database.db')
+    assert Path(database).exists(), database
+    assert Path(base_model).exists(), base_model
+    assert Path(features).exists(), features
+    assert Path(new_pairs).exists(), new_pairs
+
+    model = osp.join(sfm_dir, 'model')
+    input_model = osp.join(sfm_dir, 'model_input')
+    Path(model).mkdir(exist_ok=True)
+    Path(input_model).mkdir(exist_ok=True)
+
+    image_ids, input_reconstruction = register_new_images(empty_sfm_model, base_model, database, features, verbose=verbose)
+    write_model(*input_reconstruction, path=input_model, ext='.bin')
+
+    import_matches(image_ids, database, new_pairs, matches, features, match_model,
+                min_match_score, skip_geometric_verification, verbose=verbose)
+
+    if not skip_geometric_verification:
+        geometric_verification(colmap_path, database, new_pairs, verbose=verbose)
+
+    if not image_dir:
+        image_dir = '/'
+    stats = run_triangulation(colmap_path, model, database, image_dir, input_model, verbose=verbose)
+    os.system(f'colmap model_converter --input_path {model} --output_path {outputs_dir}/model.ply --output_type PLY')
+    return stats
+
 @ray.remote(num_cpus=2, num_gpus=1, max_calls=1)  # release gpu after finishing
 def main_ray_wrapper(*args, **kwargs):
     return main(*args, **kwargs)
\ No newline at end of file
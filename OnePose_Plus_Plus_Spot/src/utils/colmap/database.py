@@ -224,6 +224,56 @@ class COLMAPDatabase(sqlite3.Connection):
             (pair_id,) + matches.shape + (array_to_blob(matches), config,
              array_to_blob(F), array_to_blob(E), array_to_blob(H)))
 
+    def begin_bulk_import(self, journal_mode="MEMORY"):
+        """
+        Faster inserts for one-shot imports: rollback journal kept in memory and no fsync until `end_bulk_import`.
+        NOTE: WAL is slower here, one large transaction is written twice (log, then checkpoint).
+        """
+        self.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.execute("PRAGMA synchronous=OFF")
+
+    def end_bulk_import(self):
+        """ Commit and switch back to the default durable settings used by COLMAP """
+        self.commit()
+        self.execute("PRAGMA synchronous=FULL")
+        self.execute("PRAGMA journal_mode=DELETE")
+
+    def add_keypoints_many(self, image_ids_keypoints):
+        """ Insert [(image_id, keypoints), ...] with a single executemany, within the current transaction """
+        rows = []
+        for image_id, keypoints in image_ids_keypoints:
+            assert(len(keypoints.shape) == 2)
+            assert(keypoints.shape[1] in [2, 4, 6])
+            keypoints = np.asarray(keypoints, np.float32)
+            rows.append((image_id,) + keypoints.shape + (array_to_blob(keypoints),))
+        self.executemany("INSERT INTO keypoints VALUES (?, ?, ?, ?)", rows)
+
+    def add_matches_many(self, image_ids_matches):
+        """ Insert [(image_id1, image_id2, matches), ...] with a single executemany """
+        self.executemany(
+            "INSERT INTO matches VALUES (?, ?, ?, ?)",
+            [self._matches_row(*item) for item in image_ids_matches])
+
+    def add_two_view_geometries_many(self, image_ids_matches, config=2):
+        """ Insert [(image_id1, image_id2, matches), ...] as verified geometries with identity F, E, H """
+        F = E = H = array_to_blob(np.eye(3, dtype=np.float64))
+        self.executemany(
+            "INSERT INTO two_view_geometries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [self._matches_row(*item) + (config, F, E, H)
+             for item in image_ids_matches])
+
+    @staticmethod
+    def _matches_row(image_id1, image_id2, matches):
+        assert(len(matches.shape) == 2)
+        assert(matches.shape[1] == 2)
+
+        if image_id1 > image_id2:
+            matches = matches[:,::-1]
+
+        pair_id = image_ids_to_pair_id(image_id1, image_id2)
+        matches = np.asarray(matches, np.uint32)
+        return (pair_id,) + matches.shape + (array_to_blob(matches),)
+
 
 def example_usage():
     import os
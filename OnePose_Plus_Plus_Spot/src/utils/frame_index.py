@@ -0,0 +1,106 @@
+import os
+import numpy as np
+import os.path as osp
+
+
+"""
+Per-sequence binary index of the small per-frame matrices (intrinsics, poses, crop transforms),
+which are otherwise stored as one text file per frame:
+
+    - seq_root
+        - frame_index.npz: {<dir_name>.ids: [n] frame indices, <dir_name>.data: [n, ...] matrices}
+        - intrin/ poses/ M/ ... (<frame_index>.txt, kept as fallback)
+
+Readers go through `load_frame_matrix(txt_path)`, which serves `seq_root/dir_name/<id>.txt`
+from the index when it has that frame and falls back to np.loadtxt otherwise. The index is authoritative,
+its frames are served without touching the txt files (which writers may skip): whatever rewrites the
+per-frame files of a sequence has to call `remove_frame_index` first (or write a new index).
+"""
+
+FRAME_INDEX_NAME = "frame_index.npz"
+
+_loaded_indices = {}  # {seq_dir: {dir_name: {frame_id: np.ndarray}} or None if absent}
+
+
+class FrameIndexWriter():
+    """ Collect per-frame matrices of one sequence, then write them as a single npz """
+
+    def __init__(self, seq_dir):
+        self.seq_dir = seq_dir
+        self.matrices = {}  # {dir_name: {frame_id: np.ndarray}}
+
+    def add(self, dir_name, frame_id, matrix):
+        self.matrices.setdefault(dir_name, {})[int(frame_id)] = np.asarray(matrix)
+
+    def alias(self, dir_name, target_dir_name):
+        """ dir_name holds the same files as target_dir_name (e.g. symlink intrin_ba -> intrin) """
+        if target_dir_name in self.matrices:
+            self.matrices[dir_name] = self.matrices[target_dir_name]
+
+    def save(self):
+        arrays = {}
+        for dir_name, frames in self.matrices.items():
+            frame_ids = sorted(frames.keys())
+            arrays[f"{dir_name}.ids"] = np.array(frame_ids, dtype=np.int64)
+            arrays[f"{dir_name}.data"] = np.stack([frames[frame_id] for frame_id in frame_ids])
+
+        index_path = osp.join(self.seq_dir, FRAME_INDEX_NAME)
+        tmp_path = osp.join(self.seq_dir, f"frame_index.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, index_path)
+        _loaded_indices.pop(osp.abspath(self.seq_dir), None)
+        return index_path
+
+
+def remove_frame_index(seq_dir):
+    """ Invalidate the index, call before rewriting the per-frame txt files of a sequence """
+    index_path = osp.join(seq_dir, FRAME_INDEX_NAME)
+    if osp.exists(index_path):
+        os.remove(index_path)
+    _loaded_indices.pop(osp.abspath(seq_dir), None)
+
+
+def load_frame_index(seq_dir):
+    """ Load (once per process) the frame index of a sequence, None if it has none """
+    seq_dir = osp.abspath(seq_dir)
+    if seq_dir not in _loaded_indices:
+        index_path = osp.join(seq_dir, FRAME_INDEX_NAME)
+        if not osp.exists(index_path):
+            _loaded_indices[seq_dir] = None
+        else:
+            index = {}
+            with np.load(index_path) as f:
+                for key in f.files:
+                    dir_name, field = key.rsplit(".", 1)
+                    index.setdefault(dir_name, {})[field] = f[key]
+            _loaded_indices[seq_dir] = {
+                dir_name: dict(zip(arrays["ids"].tolist(), arrays["data"]))
+                for dir_name, arrays in index.items()
+            }
+    return _loaded_indices[seq_dir]
+
+
+def _lookup(txt_path):
+    frame_dir, file_name = osp.split(txt_path)
+    frame_id = osp.splitext(file_name)[0]
+    if not frame_id.isdigit():
+        return None
+    index = load_frame_index(osp.dirname(frame_dir))
+    if index is None:
+        return None
+    frames = index.get(osp.basename(frame_dir), None)
+    if frames is None:
+        return None
+    return frames.get(int(frame_id), None)
+
+
+def load_frame_matrix(txt_path):
+    """ np.loadtxt(txt_path), served from the sequence frame index when available """
+    matrix = _lookup(txt_path)
+    if matrix is None:
+        return np.loadtxt(txt_path)
+    return matrix.copy()
+
+
+def frame_matrix_exists(txt_path):
+    return _lookup(txt_path) is not None or osp.exists(txt_path)
@@ -0,0 +1,153 @@
+import os
+import cv2
+import numpy as np
+import os.path as osp
+from loguru import logger
+from tqdm import tqdm
+from multiprocessing.pool import ThreadPool
+
+import torch
+
+from src.utils.data_io import process_resize, pad_bottom_right, grayscale2tensor, mask2tensor
+from src.utils.path_utils import get_gt_pose_path_by_color, get_intrin_path_by_color
+from src.utils.frame_index import load_frame_matrix
+
+
+def _load_resized(img_file, resize, df):
+    image = cv2.imread(str(img_file), cv2.IMREAD_GRAYSCALE)
+    assert image is not None, f"path: {img_file} image not properly loaded"
+    h, w = image.shape
+    w_new, h_new = process_resize(w, h, resize, df)
+    # Same (uint8) resize as read_grayscale, packed pixels match the PNG path exactly
+    return cv2.resize(image, (w_new, h_new)), (h, w)
+
+
+def pack_image_store(img_files, out_prefix, resize=None, df=None, load_pose=True, n_threads=8):
+    """
+    Pack resized grayscale images (with their intrinsics and poses) into one uint8 shard.
+    Layout:
+        <out_prefix>.bin: raw uint8 pixels of all images, concatenated
+        <out_prefix>.index.npz: img_files, offsets, shapes [N, 2] (h, w), orig_shapes [N, 2],
+                                intrinsics [N, 3, 3], poses [N, 4, 4]
+    """
+    os.makedirs(osp.dirname(osp.abspath(out_prefix)), exist_ok=True)
+    n_imgs = len(img_files)
+    offsets = np.zeros((n_imgs,), dtype=np.int64)
+    shapes = np.zeros((n_imgs, 2), dtype=np.int32)
+    orig_shapes = np.zeros((n_imgs, 2), dtype=np.int32)
+
+    offset = 0
+    tmp_bin = out_prefix + ".bin.tmp"
+    with open(tmp_bin, "wb") as f, ThreadPool(n_threads) as pool:
+        # cv2 releases the GIL, decode in threads and write in order
+        images = pool.imap(lambda img_file: _load_resized(img_file, resize, df), img_files, chunksize=16)
+        for i, (image, orig_shape) in enumerate(tqdm(images, total=n_imgs, desc="Packing images")):
+            f.write(np.ascontiguousarray(image).tobytes())
+            offsets[i] = offset
+            shapes[i] = image.shape
+            orig_shapes[i] = orig_shape
+            offset += image.size
+
+    if load_pose:
+        intrinsics = np.stack([load_frame_matrix(get_intrin_path_by_color(img_file)) for img_file in img_files])
+        poses = np.stack([load_frame_matrix(get_gt_pose_path_by_color(img_file)) for img_file in img_files])
+    else:
+        intrinsics = np.full((n_imgs, 3, 3), np.nan)
+        poses = np.full((n_imgs, 4, 4), np.nan)
+
+    tmp_index = out_prefix + ".index.tmp.npz"
+    np.savez(
+        tmp_index,
+        img_files=np.array(img_files),
+        offsets=offsets,
+        shapes=shapes,
+        orig_shapes=orig_shapes,
+        intrinsics=intrinsics,
+        poses=poses,
+    )
+    os.replace(tmp_bin, out_prefix + ".bin")
+    os.replace(tmp_index, out_prefix + ".index.npz")
+    logger.info(f"Packed {n_imgs} images ({offset / (1 << 30):.2f} GB) to {out_prefix}.bin")
+
+
+class PackedImageStore():
+    """
+    Read-only access to a shard written by `pack_image_store`.
+    The shard is memory-mapped (lazily, so each DataLoader worker maps it after fork), images are
+    uint8 views into the mapping: no PNG decode and no per-image file open.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        index = np.load(prefix + ".index.npz")
+        self.img_files = index["img_files"]
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.orig_shapes = index["orig_shapes"]
+        self.intrinsics = index["intrinsics"]
+        self.poses = index["poses"]
+        self.img_ids = {str(img_file): i for i, img_file in enumerate(self.img_files)}
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.prefix + ".bin", dtype=np.uint8, mode="r")
+        return self._data
+
+    def __contains__(self, img_file):
+        return str(img_file) in self.img_ids
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def __getstate__(self):
+        # Do not pickle the mapping to workers
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def get_image(self, img_file):
+        """ uint8 view [h, w] of the packed image """
+        i = self.img_ids[str(img_file)]
+        h, w = self.shapes[i]
+        return self.data[self.offsets[i] : self.offsets[i] + h * w].reshape(h, w)
+
+    def get_intrinsic(self, img_file):
+        return torch.from_numpy(self.intrinsics[self.img_ids[str(img_file)]])  # [3*3]
+
+    def get_pose(self, img_file):
+        return torch.from_numpy(self.poses[self.img_ids[str(img_file)]])  # [4*4]
+
+    def read_grayscale(self, img_file, resize=None, df=None, pad_to=None,
+                       ret_scales=False, ret_pad_mask=False, augmentor=None):
+        """
+        Same outputs as data_io.read_grayscale, from the packed (already resized) image.
+        Photometric augmentors are refused: data_io.read_grayscale applies them to the full
+        resolution colour image before resizing, which the store does not keep.
+        """
+        if augmentor is not None:
+            raise ValueError(
+                f"{self.prefix} only keeps resized grayscale images, augmented images have to be read from PNG files"
+            )
+        resize = tuple(resize) if resize is not None else None
+        i = self.img_ids[str(img_file)]
+        h, w = self.orig_shapes[i]
+        w_new, h_new = process_resize(w, h, resize, df)
+        image = self.get_image(img_file)
+        assert image.shape == (h_new, w_new), \
+            f"{self.prefix} packed with image size {image.shape}, requested {(h_new, w_new)}, repack it"
+        scales = torch.tensor([float(h) / float(h_new), float(w) / float(w_new)]) # [2]
+        image = image.astype('float32')
+
+        if pad_to is not None:
+            image, mask = pad_bottom_right(image, pad_to, ret_mask=ret_pad_mask)
+
+        ts_image = grayscale2tensor(image)
+        ret_val = [ts_image]
+
+        if ret_scales:
+            ret_val.append(scales)
+        if ret_pad_mask:
+            ret_val.append(mask2tensor(mask) if pad_to else None)
+        return ret_val[0] if len(ret_val) == 1 else ret_val
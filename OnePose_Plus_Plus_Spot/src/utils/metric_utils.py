@@ -204,11 +204,94 @@ def ransac_PnP(
             return np.eye(4)[:3], np.eye(4), np.array([]).astype(np.bool), state
 
 
+def reprojection_errors(K, pose, pts_2d, pts_3d):
+    """ Reprojection error [px] of each 3D-2D correspondence under pose [3*4] """
+    pts_cam = pts_3d @ pose[:3, :3].T + pose[:3, 3]
+    pts_proj = pts_cam @ K.T
+    pts_proj = pts_proj[:, :2] / np.clip(pts_proj[:, 2:], 1e-8, None)
+    errors = np.linalg.norm(pts_proj - pts_2d, axis=-1)
+    errors[pts_cam[:, 2] <= 0] = np.inf # behind camera
+    return errors
+
+
+def guided_PnP(K, pts_2d, pts_3d, pose_prior, pnp_reprojection_error=5, min_inlier_ratio=0.6):
+    """
+    Refinement-only PnP seeded with a pose prior (e.g. predicted by a motion model), without RANSAC.
+    Correspondences consistent with the prior are refined by iterative PnP (`useExtrinsicGuess`),
+    the result is rejected (state False) if the inlier ratio of the refined pose is below `min_inlier_ratio`,
+    callers then fall back to `ransac_PnP`.
+    Output: pose [3*4], pose_homo [4*4], inliers (indices), state
+    """
+    pts_2d = np.ascontiguousarray(pts_2d.astype(np.float64))
+    pts_3d = np.ascontiguousarray(pts_3d.astype(np.float64))
+    K = K.astype(np.float64)
+    failed = np.eye(4)[:3], np.eye(4), np.array([], dtype=np.int64), False
+
+    inliers = np.nonzero(reprojection_errors(K, pose_prior, pts_2d, pts_3d) < 2 * pnp_reprojection_error)[0]
+    if len(inliers) < 6 or len(inliers) < min_inlier_ratio * len(pts_2d):
+        return failed
+
+    rvec = cv2.Rodrigues(pose_prior[:3, :3].astype(np.float64))[0]
+    tvec = pose_prior[:3, 3:].astype(np.float64).copy()
+    try:
+        _, rvec, tvec = cv2.solvePnP(
+            pts_3d[inliers],
+            pts_2d[inliers],
+            K,
+            np.zeros(shape=[8, 1], dtype="float64"),
+            rvec=rvec,
+            tvec=tvec,
+            useExtrinsicGuess=True,
+            flags=cv2.SOLVEPNP_ITERATIVE,
+        )
+    except cv2.error:
+        return failed
+
+    pose = np.concatenate([cv2.Rodrigues(rvec)[0], tvec], axis=-1)
+    inliers = np.nonzero(reprojection_errors(K, pose, pts_2d, pts_3d) < pnp_reprojection_error)[0]
+    if len(inliers) < min_inlier_ratio * len(pts_2d):
+        return failed
+
+    pose_homo = np.concatenate([pose, np.array([[0, 0, 0, 1]])], axis=0)
+    return pose, pose_homo, inliers, True
+
+
+def ransac_PnP_tasks(data, configs):
+    """
+    Keyword arguments of `ransac_PnP` for each frame of a batch, numpy only, so that they can be solved
+    in other processes (see `PnPPool` in src/inference/inference_OnePosePlus_worker.py)
+    """
+    m_bids = data["m_bids"].cpu().numpy()
+    mkpts_3d = data["mkpts_3d_db"].cpu().numpy()
+    mkpts_query = data["mkpts_query_f"].cpu().numpy()
+    img_orig_size = (
+        torch.tensor(data["q_hw_i"]).numpy() * data["query_image_scale"].cpu().numpy()
+    )  # B*2
+    query_K = data["query_intrinsic"].cpu().numpy()
+
+    tasks = []
+    for bs in range(query_K.shape[0]):
+        mask = m_bids == bs
+        tasks.append(
+            dict(
+                K=query_K[bs],
+                pts_2d=mkpts_query[mask],
+                pts_3d=mkpts_3d[mask],
+                scale=configs["point_cloud_rescale"],
+                img_hw=img_orig_size[bs].tolist(),
+                pnp_reprojection_error=configs["pnp_reprojection_error"],
+                use_pycolmap_ransac=configs["use_pycolmap_ransac"],
+            )
+        )
+    return tasks
+
+
 @torch.no_grad()
 def compute_query_pose_errors(
-    data, configs, training=False
+    data, configs, training=False, pnp_results=None
 ):
     """
+    pnp_results[optional]: (pose, pose_homo, inliers, state) of `ransac_PnP` per frame, already solved elsewhere
     Update:
         data(dict):{
             "R_errs": []
@@ -218,12 +301,6 @@ def compute_query_pose_errors(
     """
     model_unit = configs['model_unit'] if 'model_unit' in configs else 'm'
 
-    m_bids = data["m_bids"].cpu().numpy()
-    mkpts_3d = data["mkpts_3d_db"].cpu().numpy()
-    mkpts_query = data["mkpts_query_f"].cpu().numpy()
-    img_orig_size = (
-        torch.tensor(data["q_hw_i"]).numpy() * data["query_image_scale"].cpu().numpy()
-    )  # B*2
     query_K = data["query_intrinsic"].cpu().numpy()
     query_pose_gt = data["query_pose_gt"].cpu().numpy()  # B*4*4
 
@@ -253,20 +330,12 @@ def compute_query_pose_errors(
                 
                 data.update({"ADD":[], "proj2D":[]})
 
+    if pnp_results is None:
+        pnp_results = [ransac_PnP(**task) for task in ransac_PnP_tasks(data, configs)]
+
     pose_pred = []
     for bs in range(query_K.shape[0]):
-        mask = m_bids == bs
-
-        mkpts_query_f = mkpts_query[mask]
-        query_pose_pred, query_pose_pred_homo, inliers, state = ransac_PnP(
-            query_K[bs],
-            mkpts_query_f,
-            mkpts_3d[mask],
-            scale=configs["point_cloud_rescale"],
-            img_hw=img_orig_size[bs].tolist(),
-            pnp_reprojection_error=configs["pnp_reprojection_error"],
-            use_pycolmap_ransac=configs["use_pycolmap_ransac"],
-        )
+        query_pose_pred, query_pose_pred_homo, inliers, state = pnp_results[bs]
         pose_pred.append(query_pose_pred_homo)
 
         if query_pose_pred is None:
@@ -1,7 +1,17 @@
+import hashlib
 from loguru import logger
 from yacs.config import CfgNode as CN
 
 
+def file_hash(file_path, chunk_size=1 << 20):
+    """ md5 of file content, used to tell checkpoints / images apart """
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def lower_config(yacs_cfg):
     if not isinstance(yacs_cfg, CN):
         return yacs_cfg
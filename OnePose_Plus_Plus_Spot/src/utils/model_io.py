@@ -133,3 +133,30 @@ def to_cuda(data):
     else:
         raise NotImplementedError
     return data
+
+
+def resolve_device(device=None):
+    """ "cuda" / "cpu" / "cuda:1" / torch.device, None or "auto" picks cuda if available """
+    if device is None or device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def to_device(data, device):
+    """ Move the tensors of a data dict to device, other entries are kept as they are """
+    return {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in data.items()}
+
+
+def prepare_inference_model(model, device, num_threads=None):
+    """
+    Move model to device and set eval mode.
+    On CPU additionally set the number of intra-op threads and use channels-last memory format
+    for the convolutional backbone (`model.backbone`), which runs the faster oneDNN conv kernels.
+    """
+    model = model.to(device).eval()
+    if device.type == "cpu":
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if hasattr(model, "backbone"):
+            model.backbone.to(memory_format=torch.channels_last)
+    return model
@@ -80,14 +80,15 @@ def add_pointcloud_to_vis3d(pointcloud_pth, dump_dir, save_name):
     vis3d.add_point_cloud(pointcloud_pth, name="filtered_pointcloud")
 
 
-def save_demo_image(pose_pred, K, image_path, box3d, draw_box=True, save_path=None):
+def save_demo_image(pose_pred, K, image_path, box3d, draw_box=True, save_path=None, image=None):
     """ 
     Project 3D bbox by predicted pose and visualize
+    @param image[optional]: already loaded BGR image, image_path is not read again if given
     """
     if isinstance(box3d, str):
         box3d = np.loadtxt(box3d)
 
-    image_full = cv2.imread(image_path)
+    image_full = cv2.imread(image_path) if image is None else image.copy()
 
     if draw_box:
         reproj_box_2d = reproj(K, pose_pred, box3d)
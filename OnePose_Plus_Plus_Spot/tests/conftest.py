@@ -0,0 +1,5 @@
+import os.path as osp
+import sys
+
+# tests import the project as `src.*`, like the top level scripts
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
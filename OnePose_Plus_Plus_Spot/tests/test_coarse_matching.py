@@ -0,0 +1,88 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.models.OnePosePlus.utils.coarse_matching import CoarseMatching
+from src.utils.profiler import PassThroughProfiler
+
+# chunked confidences are not bitwise equal to the dense dual-softmax (see get_coarse_match_chunked)
+RTOL = 1e-5
+
+
+def make_matcher(chunk_size, **kwargs):
+    config = {
+        "type": "dual-softmax",
+        "thr": 0.1,
+        "feat_norm_method": "sqrt_feat_dim",
+        "border_rm": 2,
+        "chunk_size": chunk_size,
+        "dual_softmax": {"temperature": 0.08},
+        "train": {"train_coarse_percent": 0.1, "train_pad_num_gt_min": 200},
+        **kwargs,
+    }
+    return CoarseMatching(config, profiler=PassThroughProfiler()).eval()
+
+
+def make_batch(N=2, L=700, h1c=16, w1c=16, C=64, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    S = h1c * w1c
+    feat_query = torch.randn(N, S, C, generator=generator)
+    feat_db_3d = torch.randn(N, L, C, generator=generator)
+    # plant correspondences so that a few hundred matches pass the threshold
+    j_ids = torch.randint(S, (N, L), generator=generator)
+    noise = torch.randn(N, L, C, generator=generator)
+    feat_db_3d = torch.where(
+        torch.rand(N, L, 1, generator=generator) < 0.5,
+        torch.gather(feat_query, 1, j_ids[..., None].expand(-1, -1, C)) + 0.3 * noise,
+        feat_db_3d,
+    )
+    data = {
+        "q_hw_c": (h1c, w1c),
+        "q_hw_i": (h1c * 8, w1c * 8),
+        "keypoints3d": torch.randn(N, L, 3, generator=generator),
+    }
+    return feat_db_3d, feat_query, data
+
+
+def run(matcher, feat_db_3d, feat_query, data, mask_query=None):
+    data = dict(data)
+    matcher(feat_db_3d, feat_query, data, mask_query=mask_query)
+    return data
+
+
+@pytest.mark.parametrize("chunk_size", [1, 128, 300, 1024])
+def test_chunked_matches_dense(chunk_size):
+    feat_db_3d, feat_query, data = make_batch()
+    mask_query = torch.ones(feat_query.shape[:2], dtype=torch.bool)
+    mask_query[1, -40:] = False
+
+    for mask in [None, mask_query]:
+        dense = run(make_matcher(None), feat_db_3d, feat_query, data, mask)
+        chunked = run(make_matcher(chunk_size), feat_db_3d, feat_query, data, mask)
+
+        assert len(dense["mconf"]) > 100
+        assert "conf_matrix" not in chunked
+        for key in ["b_ids", "i_ids", "j_ids", "m_bids"]:
+            assert torch.equal(dense[key], chunked[key]), key
+        for key in ["mkpts_3d_db", "mkpts_query_c"]:
+            assert torch.allclose(dense[key], chunked[key]), key
+        assert torch.allclose(dense["mconf"], chunked["mconf"], rtol=RTOL, atol=0)
+
+
+def test_return_conf_matrix_uses_dense_path():
+    feat_db_3d, feat_query, data = make_batch(N=1)
+    dense = run(make_matcher(None), feat_db_3d, feat_query, data)
+
+    from_config = run(make_matcher(128, return_conf_matrix=True), feat_db_3d, feat_query, data)
+    per_batch = run(make_matcher(128), feat_db_3d, feat_query, {**data, "return_conf_matrix": True})
+    for out in [from_config, per_batch]:
+        assert torch.equal(out["conf_matrix"], dense["conf_matrix"])
+        assert torch.equal(out["mconf"], dense["mconf"])
+
+
+def test_chunked_rejects_other_types():
+    feat_db_3d, feat_query, data = make_batch(N=1)
+    matcher = make_matcher(128)
+    matcher.type = "sinkhorn"
+    with pytest.raises(NotImplementedError):
+        run(matcher, feat_db_3d, feat_query, data)
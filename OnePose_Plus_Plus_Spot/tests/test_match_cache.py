@@ -0,0 +1,141 @@
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("ray")
+
+from src.KeypointFreeSfM.coarse_match import coarse_match, match_cache
+from src.KeypointFreeSfM.coarse_match.match_cache import PairMatchCache
+
+MATCHER_CFG = {"coarse": {"thr": 0.2}, "match_coarse": {"match_type": "dual_softmax"}}
+
+
+@pytest.fixture
+def images(tmp_path):
+    img_paths = []
+    for i in range(4):
+        img_path = tmp_path / "color" / f"{i}.png"
+        img_path.parent.mkdir(exist_ok=True)
+        img_path.write_bytes(f"image {i}".encode())
+        img_paths.append(str(img_path))
+    return img_paths
+
+
+@pytest.fixture
+def ckpt(tmp_path):
+    ckpt_path = tmp_path / "LoFTR.ckpt"
+    ckpt_path.write_bytes(b"weights")
+    return str(ckpt_path)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Deterministic last access times """
+    now = [0.0]
+
+    def time():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(match_cache.time, "time", time)
+
+
+def make_cache(tmp_path, ckpt, matcher_cfg=MATCHER_CFG, **kwargs):
+    return PairMatchCache(str(tmp_path / "match_cache.h5"), None, 8, ckpt, matcher_cfg, **kwargs)
+
+
+def fake_matches(pair_keys):
+    return {
+        pair_name: np.full((i + 1, 5), i, dtype=np.float32) for i, pair_name in enumerate(pair_keys)
+    }
+
+
+def pair_keys_of(images, pairs):
+    return {f"{images[i]} {images[j]}": (images[i], images[j]) for i, j in pairs}
+
+
+def test_hit_round_trip(tmp_path, images, ckpt):
+    pair_keys = pair_keys_of(images, [(0, 1), (1, 2)])
+    matches = fake_matches(pair_keys)
+    make_cache(tmp_path, ckpt).save(matches, pair_keys)
+
+    loaded = make_cache(tmp_path, ckpt).load(pair_keys)
+    assert loaded.keys() == matches.keys()
+    for pair_name in matches:
+        np.testing.assert_array_equal(loaded[pair_name], matches[pair_name])
+
+    # content addressed: a renamed copy of the images still hits, the reversed pair does not
+    renamed = str(tmp_path / "renamed.png")
+    with open(images[0], "rb") as f_src, open(renamed, "wb") as f_dst:
+        f_dst.write(f_src.read())
+    assert len(make_cache(tmp_path, ckpt).load({"renamed": (renamed, images[1])})) == 1
+    assert len(make_cache(tmp_path, ckpt).load({"reversed": (images[1], images[0])})) == 0
+
+
+def test_miss_on_changed_settings(tmp_path, images, ckpt):
+    pair_keys = pair_keys_of(images, [(0, 1)])
+    make_cache(tmp_path, ckpt).save(fake_matches(pair_keys), pair_keys)
+
+    assert len(make_cache(tmp_path, ckpt, {**MATCHER_CFG, "coarse": {"thr": 0.3}}).load(pair_keys)) == 0
+
+    with open(ckpt, "wb") as f:
+        f.write(b"new weights")
+    assert len(make_cache(tmp_path, ckpt).load(pair_keys)) == 0
+
+    with open(images[1], "wb") as f:
+        f.write(b"re-rendered")
+    assert len(make_cache(tmp_path, ckpt).load(pair_keys)) == 0
+
+
+def test_lru_eviction(tmp_path, images, ckpt, clock):
+    cache = make_cache(tmp_path, ckpt, max_entries=2)
+    pairs = pair_keys_of(images, [(0, 1), (1, 2), (2, 3)])
+    (name_01, keys_01), (name_12, keys_12), (name_23, keys_23) = pairs.items()
+    matches = fake_matches(pairs)
+
+    cache.save({name_01: matches[name_01]}, pairs)
+    cache.save({name_12: matches[name_12]}, pairs)
+    cache.load({name_01: keys_01})  # 0-1 is now more recent than 1-2
+    cache.save({name_23: matches[name_23]}, pairs)
+
+    assert cache.load(pairs).keys() == {name_01, name_23}
+    with h5py.File(cache.cache_path, "r") as f:
+        assert set(f.keys()) == {cache.make_key(*keys_01), cache.make_key(*keys_23)}
+
+
+class FakeDataset:
+    def __init__(self, pair_list):
+        self.pair_list = pair_list
+
+
+def test_coarse_match_pairs_reuses_cache(tmp_path, images, ckpt, monkeypatch):
+    matched = []
+
+    def match_worker(dataset, subset_ids, args, verbose=False):
+        pair_names = [dataset.pair_list[i] for i in subset_ids]
+        matched.extend(pair_names)
+        return fake_matches(pair_names)
+
+    monkeypatch.setattr(coarse_match, "match_worker", match_worker)
+    monkeypatch.setitem(coarse_match.cfgs["matcher"]["model"], "weight_path", ckpt)
+    cache_path = str(tmp_path / "match_cache.h5")
+
+    dataset = FakeDataset([f"{images[0]} {images[1]}", f"{images[1]} {images[2]}"])
+    first = coarse_match.coarse_match_pairs(dataset, match_cache_path=cache_path)
+    assert matched == dataset.pair_list
+
+    # one new pair: only it is matched, the others come from the cache in dataset pair order
+    matched.clear()
+    dataset = FakeDataset(dataset.pair_list + [f"{images[2]} {images[3]}"])
+    second = coarse_match.coarse_match_pairs(dataset, match_cache_path=cache_path)
+    assert matched == [f"{images[2]} {images[3]}"]
+    assert list(second) == dataset.pair_list
+    for pair_name in first:
+        np.testing.assert_array_equal(second[pair_name], first[pair_name])
+
+    # a changed matcher config misses all pairs
+    matched.clear()
+    monkeypatch.setattr(coarse_match, "default_cfg", {"changed": True})
+    coarse_match.coarse_match_pairs(dataset, match_cache_path=cache_path)
+    assert matched == dataset.pair_list
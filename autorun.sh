@@ -1,18 +1,7 @@
 #!/bin/bash
 
-# Define the number of loops
-num_loops=2
+# Render num_scenes scenes (SCENE 00, 01, ... with seeds 0, 1, ...) in parallel, each with its own config,
+# see src/render_scenes.py for scene manifests, retries and resuming (extra arguments are passed on)
+num_scenes=2
 
-# Loop to change the "SCENE" parameter and run the pipeline
-for ((i=0; i<num_loops; i++)); do
-    # Construct the new "SCENE" value with leading zeros
-    scene=$(printf "%02d" $i)
-
-    # Use jq to modify the "SCENE" parameter in config.json
-    jq --arg new_scene "$scene" '.SCENE = $new_scene' config.json > temp.json
-    mv temp.json config.json
-
-    # Run the pipeline using the modified config.json
-    echo "Running synthetic data pipeline for scene: ${scene}"
-    ./run.sh
-done
+python src/render_scenes.py --n_scenes $num_scenes "$@"
@@ -3,7 +3,7 @@
 from contextlib import contextmanager
 import os
 import threading
-from typing import IO, Union, Dict, List, Set, Optional, Any
+from typing import IO, Union, Dict, List, Set, Optional, Any, Iterator
 import math
 import sys
 import platform
@@ -695,6 +695,58 @@ def render(output_dir: Optional[str] = None, file_prefix: str = "rgb_", output_k
     return _WriterUtility.load_registered_outputs(load_keys, keys_with_alpha_channel) if return_data else {}
 
 
+def render_chunks(chunk_size: int, output_dir: Optional[str] = None, file_prefix: str = "rgb_",
+                  output_key: Optional[str] = "colors", load_keys: Optional[Set[str]] = None,
+                  keys_with_alpha_channel: Optional[Set[str]] = None, remove_rendered_files: bool = True,
+                  verbose: bool = False) -> Iterator[Dict[str, Union[np.ndarray, List[np.ndarray]]]]:
+    """ Render all frames in chunks of chunk_size frames, so that only one chunk is in memory at a time.
+
+    For each chunk, the frame interval of the scene is set to the chunk, the chunk is rendered and its loaded outputs
+    are yielded. As the writers write the frames from frame_start to frame_end, they can be called on each chunk
+    (appending to the existing output):
+
+        for data in bproc.renderer.render_chunks(100):
+            bproc.writer.write_bop(output_dir, depths=data["depth"], colors=data["colors"])
+
+    The original frame interval is restored afterwards.
+
+    :param chunk_size: The number of frames rendered, loaded and yielded at once.
+    :param output_dir: The directory to write files to, if this is None the temporary directory is used.
+    :param file_prefix: The prefix to use for writing the images.
+    :param output_key: The key to use for registering the output.
+    :param load_keys: Set of output keys to load when available
+    :param keys_with_alpha_channel: A set containing all keys whose alpha channels should be loaded.
+    :param remove_rendered_files: If True, the rendered files of a chunk are removed once it has been processed.
+                                  The temporary directory is usually in the shared memory, i.e. in RAM.
+    :param verbose: If True, more details about the rendering process are printed.
+    :return: Per chunk, the dict of lists of raw renderer output (see render()).
+    """
+    if chunk_size < 1:
+        raise ValueError(f"The chunk size has to be positive, got {chunk_size}")
+    frame_start, frame_end = bpy.context.scene.frame_start, bpy.context.scene.frame_end
+    if frame_end == frame_start:
+        raise RuntimeError("No camera poses have been registered, therefore nothing can be rendered. A camera "
+                           "pose can be registered via bproc.camera.add_camera_pose().")
+    try:
+        for chunk_start in range(frame_start, frame_end, chunk_size):
+            bpy.context.scene.frame_start = chunk_start
+            bpy.context.scene.frame_end = min(chunk_start + chunk_size, frame_end)
+            yield render(output_dir, file_prefix, output_key,
+                         load_keys=set(load_keys) if load_keys is not None else None,
+                         keys_with_alpha_channel=keys_with_alpha_channel, verbose=verbose)
+
+            if remove_rendered_files:
+                for reg_out in Utility.get_registered_outputs():
+                    if "%" not in reg_out["path"]:
+                        continue
+                    for frame_id in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end):
+                        output_path = reg_out["path"] % frame_id
+                        if os.path.exists(output_path):
+                            os.remove(output_path)
+    finally:
+        bpy.context.scene.frame_start, bpy.context.scene.frame_end = frame_start, frame_end
+
+
 def set_output_format(file_format: Optional[str] = None, color_depth: Optional[int] = None,
                       enable_transparency: Optional[bool] = None, jpg_quality: Optional[int] = None):
     """ Sets the output format to use for rendering. Default values defined in DefaultConfig.py.
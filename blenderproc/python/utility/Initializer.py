@@ -2,6 +2,7 @@
 
 import os
 import random
+from typing import Optional, List
 
 from numpy import random as np_random
 import bpy
@@ -58,20 +59,26 @@ def init(clean_up_scene: bool = True):
     GlobalStorage.add("bproc_init_complete", True)
 
 
-def clean_up(clean_up_camera: bool = False):
+def clean_up(clean_up_camera: bool = False, keep_objects: Optional[List] = None):
     """ Resets the scene to its clean state.
 
     This method removes all objects, camera poses and cleans up the world background.
     All (renderer) settings and the UI are kept as they are.
 
     :param clean_up_camera: If True, also the camera is set back to its clean state.
+    :param keep_objects: Objects (BlenderProc objects or blender objects) which are kept together with all data
+                         blocks they use (meshes, materials, images, ...), e.g. an asset which is loaded once and
+                         rendered in many scenes.
     """
     # Switch to right context
     if bpy.context.object is not None and bpy.context.object.mode != "OBJECT":
         bpy.ops.object.mode_set(mode='OBJECT')
 
     # Clean up
-    _Initializer.remove_all_data(clean_up_camera)
+    keep_blocks = None
+    if keep_objects:
+        keep_blocks = _Initializer.get_used_data_blocks([getattr(obj, "blender_obj", obj) for obj in keep_objects])
+    _Initializer.remove_all_data(clean_up_camera, keep_blocks)
     _Initializer.remove_custom_properties()
 
     # Create new world
@@ -135,10 +142,32 @@ class _Initializer:
                                           DefaultConfig.jpg_quality)
 
     @staticmethod
-    def remove_all_data(remove_camera: bool = True):
+    def get_used_data_blocks(blender_objects: List[bpy.types.Object]) -> set:
+        """ Returns the given objects, all data blocks they (transitively) use and the collections containing them.
+
+        :param blender_objects: The blender objects.
+        :return: The set of data blocks.
+        """
+        blocks = set(blender_objects)
+        user_map = bpy.data.user_map()
+        added = True
+        while added:
+            added = False
+            for block, users in user_map.items():
+                if block not in blocks and not users.isdisjoint(blocks):
+                    blocks.add(block)
+                    added = True
+        # Removing a collection would unlink the objects from the scene, but do not keep its other objects
+        blocks.update(collection for collection in bpy.data.collections
+                      if not blocks.isdisjoint(collection.objects))
+        return blocks
+
+    @staticmethod
+    def remove_all_data(remove_camera: bool = True, keep_blocks: Optional[set] = None):
         """ Remove all data blocks except opened scripts, the default scene and the camera.
 
         :param remove_camera: If True, also the default camera is removed.
+        :param keep_blocks: Data blocks which are not removed.
         """
         # Go through all attributes of bpy.data
         for collection in dir(bpy.data):
@@ -155,6 +184,8 @@ class _Initializer:
                     if not remove_camera and isinstance(block, (bpy.types.Object, bpy.types.Camera)) \
                             and block.name == "Camera":
                         continue
+                    if keep_blocks is not None and block in keep_blocks:
+                        continue
                     data_structure.remove(block)
 
     @staticmethod
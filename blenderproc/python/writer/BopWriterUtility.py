@@ -3,13 +3,14 @@
 import json
 import os
 import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 import shutil
 import warnings
 import datetime
 
 import numpy as np
-import png
 import cv2
 import bpy
 from mathutils import Matrix
@@ -27,7 +28,8 @@ def write_bop(output_dir: str, target_objects: Optional[List[MeshObject]] = None
               color_file_format: str = "PNG", dataset: str = "", append_to_existing_output: bool = True,
               depth_scale: float = 1.0, jpg_quality: int = 95, save_world2cam: bool = True,
               ignore_dist_thres: float = 100., m2mm: bool = True, frames_per_chunk: int = 1000,
-              calc_mask_info_coco: bool = True, delta: int = 15):
+              calc_mask_info_coco: bool = True, delta: int = 15, png_compression: Optional[int] = None,
+              num_write_threads: int = 4, json_flush_interval: int = 100):
     """Write the BOP data
 
     :param output_dir: Path to the output directory.
@@ -51,6 +53,9 @@ def write_bop(output_dir: str, target_objects: Optional[List[MeshObject]] = None
     :param frames_per_chunk: Number of frames saved in each chunk (called scene in BOP)
     :param calc_mask_info_coco: Whether to calculate gt masks, gt info and gt coco annotations.
     :param delta: Tolerance used for estimation of the visibility masks.
+    :param png_compression: zlib compression level (0-9) of the PNG images, None: OpenCV's default.
+    :param num_write_threads: Number of threads encoding and writing the images.
+    :param json_flush_interval: scene_gt.json and scene_camera.json are saved every json_flush_interval frames.
     """
     if depths is None:
         depths = []
@@ -114,7 +119,8 @@ def write_bop(output_dir: str, target_objects: Optional[List[MeshObject]] = None
     _BopWriterUtility.write_frames(chunks_dir, dataset_objects=dataset_objects, depths=depths, colors=colors,
                                    color_file_format=color_file_format, frames_per_chunk=frames_per_chunk,
                                    m2mm=m2mm, ignore_dist_thres=ignore_dist_thres, save_world2cam=save_world2cam,
-                                   depth_scale=depth_scale, jpg_quality=jpg_quality)
+                                   depth_scale=depth_scale, jpg_quality=jpg_quality, png_compression=png_compression,
+                                   num_write_threads=num_write_threads, json_flush_interval=json_flush_interval)
 
     if calc_mask_info_coco:
         # Set up the bop toolkit
@@ -202,12 +208,13 @@ class _BopWriterUtility:
                 json.dump(content, file, sort_keys=True)
 
     @staticmethod
-    def save_depth(path: str, im: np.ndarray):
+    def save_depth(path: str, im: np.ndarray, png_compression: Optional[int] = None):
         """Saves a depth image (16-bit) to a PNG file.
         From the BOP toolkit (https://github.com/thodan/bop_toolkit).
 
         :param path: Path to the output depth image file.
         :param im: ndarray with the depth image to save.
+        :param png_compression: zlib compression level (0-9), None: OpenCV's default.
         """
         if not path.endswith(".png"):
             raise ValueError('Only PNG format is currently supported.')
@@ -215,10 +222,9 @@ class _BopWriterUtility:
         im[im > 65535] = 65535
         im_uint16 = np.round(im).astype(np.uint16)
 
-        # PyPNG library can save 16-bit PNG and is faster than imageio.imwrite().
-        w_depth = png.Writer(im.shape[1], im.shape[0], greyscale=True, bitdepth=16)
-        with open(path, 'wb') as f:
-            w_depth.write(f, np.reshape(im_uint16, (-1, im.shape[1])))
+        # OpenCV saves 16-bit PNGs as well and, unlike PyPNG, releases the GIL while encoding.
+        params = [] if png_compression is None else [int(cv2.IMWRITE_PNG_COMPRESSION), png_compression]
+        cv2.imwrite(path, im_uint16, params)
 
     @staticmethod
     def write_camera(camera_path: str, depth_scale: float = 1.0):
@@ -328,9 +334,13 @@ class _BopWriterUtility:
     def write_frames(chunks_dir: str, dataset_objects: list, depths: Optional[List[np.ndarray]] = None,
                      colors: Optional[List[np.ndarray]] = None, color_file_format: str = "PNG",
                      depth_scale: float = 1.0, frames_per_chunk: int = 1000, m2mm: bool = True,
-                     ignore_dist_thres: float = 100., save_world2cam: bool = True, jpg_quality: int = 95):
+                     ignore_dist_thres: float = 100., save_world2cam: bool = True, jpg_quality: int = 95,
+                     png_compression: Optional[int] = None, num_write_threads: int = 4,
+                     json_flush_interval: int = 100):
         """Write each frame's ground truth into chunk directory in BOP format
 
+        The images are encoded and written by a thread pool, while the ground truth of the next frames is computed.
+
         :param chunks_dir: Path to the output directory of the current chunk.
         :param dataset_objects: Save annotations for these objects.
         :param depths: List of depth images in m to save
@@ -345,6 +355,10 @@ class _BopWriterUtility:
         :param m2mm: Original bop annotations and models are in mm. If true, we convert the gt annotations
                      to mm here. This is needed if BopLoader option mm2m is used.
         :param frames_per_chunk: Number of frames saved in each chunk (called scene in BOP)
+        :param png_compression: zlib compression level (0-9) of the PNG images, None: OpenCV's default.
+        :param num_write_threads: Number of threads encoding and writing the images.
+        :param json_flush_interval: The GT annotations and camera info of the current chunk are saved every
+                                    json_flush_interval frames, not only at the end of the chunk.
         """
         if depths is None:
             depths = []
@@ -400,80 +414,108 @@ class _BopWriterUtility:
             raise Exception("The amount of images stored in the depths/colors does not correspond to the amount"
                             "of images specified by frame_start to frame_end.")
 
-        for frame_id in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end):
-            # Activate frame.
-            bpy.context.scene.frame_set(frame_id)
-
-            # Reset data structures and prepare folders for a new chunk.
-            if curr_frame_id == 0:
-                chunk_gt = {}
-                chunk_camera = {}
-                os.makedirs(os.path.dirname(
-                    rgb_tpath.format(chunk_id=curr_chunk_id, im_id=0, im_type='PNG')))
-                os.makedirs(os.path.dirname(
-                    depth_tpath.format(chunk_id=curr_chunk_id, im_id=0)))
-
-            # Get GT annotations and camera info for the current frame.
-
-            # Output translation gt in m or mm
-            unit_scaling = 1000. if m2mm else 1.
-
-            chunk_gt[curr_frame_id] = _BopWriterUtility.get_frame_gt(dataset_objects, unit_scaling, ignore_dist_thres)
-            chunk_camera[curr_frame_id] = _BopWriterUtility.get_frame_camera(save_world2cam, depth_scale, unit_scaling)
-
-            if colors:
-                color_rgb = colors[frame_id]
-                color_bgr = color_rgb.copy()
-                color_bgr[..., :3] = color_bgr[..., :3][..., ::-1]
-                if color_file_format == 'PNG':
-                    rgb_fpath = rgb_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id, im_type='.png')
-                    cv2.imwrite(rgb_fpath, color_bgr)
-                elif color_file_format == 'JPEG':
-                    rgb_fpath = rgb_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id, im_type='.jpg')
-                    cv2.imwrite(rgb_fpath, color_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), jpg_quality])
-            else:
-                rgb_output = Utility.find_registered_output_by_key("colors")
-                if rgb_output is None:
-                    raise Exception("RGB image has not been rendered.")
-                color_ext = '.png' if rgb_output['path'].endswith('png') else '.jpg'
-                # Copy the resulting RGB image.
-                rgb_fpath = rgb_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id, im_type=color_ext)
-                shutil.copyfile(rgb_output['path'] % frame_id, rgb_fpath)
-
-            if depths:
-                depth = depths[frame_id]
+        if colors and color_file_format not in ['PNG', 'JPEG']:
+            raise RuntimeError(f'Unknown color_file_format={color_file_format}. Try "PNG" or "JPEG"')
+        png_params = [] if png_compression is None else [int(cv2.IMWRITE_PNG_COMPRESSION), png_compression]
+
+        def write_color(rgb_fpath: str, color_rgb: np.ndarray):
+            color_bgr = color_rgb.copy()
+            color_bgr[..., :3] = color_bgr[..., :3][..., ::-1]
+            if color_file_format == 'PNG':
+                cv2.imwrite(rgb_fpath, color_bgr, png_params)
             else:
-                # Load the resulting dist image.
-                dist_output = Utility.find_registered_output_by_key("distance")
-                if dist_output is None:
-                    raise Exception("Distance image has not been rendered.")
-                distance = _WriterUtility.load_output_file(resolve_path(dist_output['path'] % frame_id), remove=False)
-                depth = dist2depth(distance)
+                cv2.imwrite(rgb_fpath, color_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), jpg_quality])
 
+        def write_depth(depth_fpath: str, depth: np.ndarray):
             # Scale the depth to retain a higher precision (the depth is saved
             # as a 16-bit PNG image with range 0-65535).
             depth_mm = 1000.0 * depth  # [m] -> [mm]
             depth_mm_scaled = depth_mm / float(depth_scale)
-
-            # Save the scaled depth image.
-            depth_fpath = depth_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id)
-            _BopWriterUtility.save_depth(depth_fpath, depth_mm_scaled)
-
-            # Save the chunk info if we are at the end of a chunk or at the last new frame.
-            if ((curr_frame_id + 1) % frames_per_chunk == 0) or \
-                    (frame_id == num_new_frames - 1):
-
-                # Save GT annotations.
-                _BopWriterUtility.save_json(chunk_gt_tpath.format(chunk_id=curr_chunk_id), chunk_gt)
-
-                # Save camera info.
-                _BopWriterUtility.save_json(chunk_camera_tpath.format(chunk_id=curr_chunk_id), chunk_camera)
-
-                # Update ID's.
-                curr_chunk_id += 1
-                curr_frame_id = 0
-            else:
-                curr_frame_id += 1
+            _BopWriterUtility.save_depth(depth_fpath, depth_mm_scaled, png_compression)
+
+        # Image writes in flight, waiting for the oldest one bounds the memory of queued images (back-pressure)
+        # and raises its errors.
+        pending_writes = deque()
+        max_pending_writes = 2 * num_write_threads
+
+        def wait_for_writes(max_pending: int = 0):
+            while len(pending_writes) > max_pending:
+                pending_writes.popleft().result()
+
+        def save_chunk_json(chunk_id: int):
+            # Only list frames whose images are on disk, appending continues after the last listed frame
+            wait_for_writes()
+            _BopWriterUtility.save_json(chunk_gt_tpath.format(chunk_id=chunk_id), chunk_gt)
+            _BopWriterUtility.save_json(chunk_camera_tpath.format(chunk_id=chunk_id), chunk_camera)
+
+        with ThreadPoolExecutor(max_workers=num_write_threads) as pool:
+            for frame_id in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end):
+                # Activate frame.
+                bpy.context.scene.frame_set(frame_id)
+
+                # Reset data structures and prepare folders for a new chunk.
+                if curr_frame_id == 0:
+                    chunk_gt = {}
+                    chunk_camera = {}
+                    os.makedirs(os.path.dirname(
+                        rgb_tpath.format(chunk_id=curr_chunk_id, im_id=0, im_type='PNG')))
+                    os.makedirs(os.path.dirname(
+                        depth_tpath.format(chunk_id=curr_chunk_id, im_id=0)))
+
+                # Get GT annotations and camera info for the current frame.
+
+                # Output translation gt in m or mm
+                unit_scaling = 1000. if m2mm else 1.
+
+                chunk_gt[curr_frame_id] = _BopWriterUtility.get_frame_gt(dataset_objects, unit_scaling,
+                                                                         ignore_dist_thres)
+                chunk_camera[curr_frame_id] = _BopWriterUtility.get_frame_camera(save_world2cam, depth_scale,
+                                                                                 unit_scaling)
+
+                if colors:
+                    color_ext = '.png' if color_file_format == 'PNG' else '.jpg'
+                    rgb_fpath = rgb_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id, im_type=color_ext)
+                    pending_writes.append(pool.submit(write_color, rgb_fpath,
+                                                      colors[frame_id - bpy.context.scene.frame_start]))
+                else:
+                    rgb_output = Utility.find_registered_output_by_key("colors")
+                    if rgb_output is None:
+                        raise Exception("RGB image has not been rendered.")
+                    color_ext = '.png' if rgb_output['path'].endswith('png') else '.jpg'
+                    # Copy the resulting RGB image.
+                    rgb_fpath = rgb_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id, im_type=color_ext)
+                    pending_writes.append(pool.submit(shutil.copyfile, rgb_output['path'] % frame_id, rgb_fpath))
+
+                if depths:
+                    depth = depths[frame_id - bpy.context.scene.frame_start]
+                else:
+                    # Load the resulting dist image.
+                    dist_output = Utility.find_registered_output_by_key("distance")
+                    if dist_output is None:
+                        raise Exception("Distance image has not been rendered.")
+                    distance = _WriterUtility.load_output_file(resolve_path(dist_output['path'] % frame_id),
+                                                               remove=False)
+                    depth = dist2depth(distance)
+
+                # Save the scaled depth image.
+                depth_fpath = depth_tpath.format(chunk_id=curr_chunk_id, im_id=curr_frame_id)
+                pending_writes.append(pool.submit(write_depth, depth_fpath, depth))
+                wait_for_writes(max_pending_writes)
+
+                # Save the chunk info if we are at the end of a chunk or at the last new frame.
+                if ((curr_frame_id + 1) % frames_per_chunk == 0) or \
+                        (frame_id == bpy.context.scene.frame_end - 1):
+
+                    # Save GT annotations and camera info.
+                    save_chunk_json(curr_chunk_id)
+
+                    # Update ID's.
+                    curr_chunk_id += 1
+                    curr_frame_id = 0
+                else:
+                    if (curr_frame_id + 1) % json_flush_interval == 0:
+                        save_chunk_json(curr_chunk_id)
+                    curr_frame_id += 1
 
     @staticmethod
     def calc_gt_masks(chunk_dirs: List[str], dataset_objects: List[MeshObject], starting_frame_id: int = 0,
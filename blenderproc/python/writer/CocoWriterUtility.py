@@ -1,7 +1,6 @@
 """Allows rendering the content of the scene in the coco file format."""
 
 import datetime
-from itertools import groupby
 import json
 import os
 import shutil
@@ -24,7 +23,9 @@ def write_coco_annotations(output_dir: str, instance_segmaps: Optional[List[np.n
                            append_to_existing_output: bool = True, segmap_output_key: str = "segmap",
                            segcolormap_output_key: str = "segcolormap", rgb_output_key: str = "colors",
                            jpg_quality: int = 95, label_mapping: Optional[LabelIdMapping] = None,
-                           file_prefix: str = "", indent: Optional[Union[int, str]] = None):
+                           file_prefix: str = "", indent: Optional[Union[int, str]] = None,
+                           existing_coco_annotations: Optional[dict] = None,
+                           write_annotations_file: bool = True) -> dict:
     """ Writes coco annotations in the following steps:
     1. Locate the seg images
     2. Locate the rgb maps
@@ -60,6 +61,13 @@ def write_coco_annotations(output_dir: str, instance_segmaps: Optional[List[np.n
                    only insert newlines. None (the default) selects the most compact representation.
                    Using a positive integer indent indents that many spaces per level.
                    If indent is a string (such as "\t"), that string is used to indent each level.
+    :param existing_coco_annotations: The coco annotations returned by the previous call, the new annotations are
+                                      appended to them instead of to the coco_annotations.json file. Together with
+                                      write_annotations_file, this avoids reading and rewriting the whole file for
+                                      every chunk of bproc.renderer.render_chunks.
+    :param write_annotations_file: If false, coco_annotations.json is not written (only the images are), pass the
+                                   returned annotations to the next call and write the file with the last one.
+    :return: The coco annotations, including the existing ones.
     """
     instance_segmaps = [] if instance_segmaps is None else list(instance_segmaps)
     colors = [] if colors is None else list(colors)
@@ -96,13 +104,16 @@ def write_coco_annotations(output_dir: str, instance_segmaps: Optional[List[np.n
 
     coco_annotations_path = os.path.join(output_dir, "coco_annotations.json")
     # Calculate image numbering offset, if append_to_existing_output is activated and coco data exists
-    if append_to_existing_output and os.path.exists(coco_annotations_path):
+    if existing_coco_annotations is None and append_to_existing_output and os.path.exists(coco_annotations_path):
         with open(coco_annotations_path, 'r', encoding="utf-8") as fp:
             existing_coco_annotations = json.load(fp)
-        image_offset = max(image["id"] for image in existing_coco_annotations["images"]) + 1
+    if existing_coco_annotations is not None:
+        # continue the numbering of the existing images, also when rendering a frame interval which does not start
+        # at 0 (e.g. bproc.renderer.render_chunks)
+        image_offset = max(image["id"] for image in existing_coco_annotations["images"]) + 1 \
+            - bpy.context.scene.frame_start
     else:
         image_offset = 0
-        existing_coco_annotations = None
 
     # collect all RGB paths
     new_coco_image_paths = []
@@ -167,9 +178,11 @@ def write_coco_annotations(output_dir: str, instance_segmaps: Optional[List[np.n
                                                                existing_coco_annotations,
                                                                label_mapping)
 
-    print("Writing coco annotations to " + coco_annotations_path)
-    with open(coco_annotations_path, 'w', encoding="utf-8") as fp:
-        json.dump(coco_output, fp, indent=indent)
+    if write_annotations_file:
+        print("Writing coco annotations to " + coco_annotations_path)
+        with open(coco_annotations_path, 'w', encoding="utf-8") as fp:
+            json.dump(coco_output, fp, indent=indent)
+    return coco_output
 
 
 def binary_mask_to_rle(binary_mask: np.ndarray) -> Dict[str, List[int]]:
@@ -180,11 +193,16 @@ def binary_mask_to_rle(binary_mask: np.ndarray) -> Dict[str, List[int]]:
     :return: Mask in RLE format
     """
     rle: Dict[str, List[int]] = {'counts': [], 'size': list(binary_mask.shape)}
-    counts = rle.get('counts')
-    for i, (value, elements) in enumerate(groupby(binary_mask.ravel(order='F'))):
-        if i == 0 and value == 1:
-            counts.append(0)
-        counts.append(len(list(elements)))
+    flat_mask = binary_mask.ravel(order='F')
+    if flat_mask.size == 0:
+        return rle
+    # The runs start where the value changes, the counts are their lengths
+    run_starts = np.flatnonzero(flat_mask[1:] != flat_mask[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], run_starts, [flat_mask.size]))).tolist()
+    # The counts start with the (possibly empty) run of 0s
+    if flat_mask[0] == 1:
+        counts.insert(0, 0)
+    rle['counts'] = counts
     return rle
 
 
@@ -285,22 +303,28 @@ class _CocoWriterUtility:
             image_id = len(images)
             images.append(_CocoWriterUtility.create_image_info(image_id, image_path, inst_segmap.shape))
 
-            # Go through all objects visible in this image
-            instances = np.unique(inst_segmap)
-            # Remove background
-            instances = np.delete(instances, np.where(instances == 0))
-            for inst in instances:
-                if inst in instance_2_category_map:
+            # Go through all objects visible in this image, all of them from one scan of the segmap
+            for inst, (run_starts, run_ends) in _CocoWriterUtility.get_instance_runs(inst_segmap).items():
+                # Skip background
+                if inst == 0 or inst not in instance_2_category_map:
+                    continue
+                # Add coco info for object in this image
+                if mask_encoding_format == 'rle':
+                    annotation = _CocoWriterUtility.create_rle_annotation_info(len(annotations) + 1,
+                                                                               image_id,
+                                                                               instance_2_category_map[inst],
+                                                                               run_starts, run_ends,
+                                                                               inst_segmap.shape)
+                else:
                     # Calc object mask
                     binary_inst_mask = np.where(inst_segmap == inst, 1, 0)
-                    # Add coco info for object in this image
                     annotation = _CocoWriterUtility.create_annotation_info(len(annotations) + 1,
                                                                            image_id,
                                                                            instance_2_category_map[inst],
                                                                            binary_inst_mask,
                                                                            mask_encoding_format)
-                    if annotation is not None:
-                        annotations.append(annotation)
+                if annotation is not None:
+                    annotations.append(annotation)
 
         new_coco_annotations = {
             "info": info,
@@ -413,6 +437,76 @@ class _CocoWriterUtility:
         }
         return annotation_info
 
+    @staticmethod
+    def get_instance_runs(inst_segmap: np.ndarray) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """ Splits the instance segmap, flattened in column-major order (as COCOs RLE), into runs of equal values.
+
+        :param inst_segmap: The instance segmentation map with the shape [H, W].
+        :return: For each instance (in ascending order), the start and end (exclusive) indices of its runs.
+        """
+        flat_segmap = inst_segmap.ravel(order='F')
+        if flat_segmap.size == 0:
+            return {}
+        run_starts = np.concatenate(([0], np.flatnonzero(flat_segmap[1:] != flat_segmap[:-1]) + 1))
+        run_ends = np.append(run_starts[1:], flat_segmap.size)
+        run_values = flat_segmap[run_starts]
+
+        # Group the runs by instance, the stable sort keeps the runs of an instance in order
+        order = np.argsort(run_values, kind='stable')
+        instances, first_runs = np.unique(run_values[order], return_index=True)
+        return {inst: (run_starts[runs], run_ends[runs])
+                for inst, runs in zip(instances, np.split(order, first_runs[1:]))}
+
+    @staticmethod
+    def create_rle_annotation_info(annotation_id: int, image_id: int, category_id: int, run_starts: np.ndarray,
+                                   run_ends: np.ndarray, mask_shape: Tuple[int, int]) \
+            -> Optional[Dict[str, Union[str, int]]]:
+        """Creates info section of coco annotation with an RLE mask from the runs of the object (see
+        get_instance_runs), same result as create_annotation_info with its binary mask and the 'rle' format.
+
+        :param annotation_id: integer to uniquly identify the annotation
+        :param image_id: integer to uniquly identify image
+        :param category_id: Id of the category
+        :param run_starts: Start indices of the runs of the object in the column-major flattened mask.
+        :param run_ends: End indices (exclusive) of the runs.
+        :param mask_shape: The shape [H, W] of the mask.
+        """
+        height, width = mask_shape
+        area = int((run_ends - run_starts).sum())
+        if area < 1:
+            return None
+
+        # A run which continues in the next column covers the last and the first row
+        first_cols = run_starts // height
+        last_cols = (run_ends - 1) // height
+        wraps = last_cols > first_cols
+        rmin = int(np.where(wraps, 0, run_starts % height).min())
+        rmax = int(np.where(wraps, height - 1, (run_ends - 1) % height).max())
+        cmin, cmax = int(first_cols.min()), int(last_cols.max())
+        bounding_box = [cmin, rmin, cmax - cmin + 1, rmax - rmin + 1]
+
+        # Alternating counts of 0s (before each run, possibly empty for the first one) and 1s, then the trailing 0s
+        counts = np.empty(2 * len(run_starts), dtype=np.int64)
+        counts[0] = run_starts[0]
+        counts[2::2] = run_starts[1:] - run_ends[:-1]
+        counts[1::2] = run_ends - run_starts
+        counts = counts.tolist()
+        if run_ends[-1] < height * width:
+            counts.append(int(height * width - run_ends[-1]))
+
+        annotation_info: Dict[str, Union[str, int]] = {
+            "id": annotation_id,
+            "image_id": image_id,
+            "category_id": category_id,
+            "iscrowd": 0,
+            "area": area,
+            "bbox": bounding_box,
+            "segmentation": {'counts': counts, 'size': [height, width]},
+            "width": width,
+            "height": height,
+        }
+        return annotation_info
+
     @staticmethod
     def bbox_from_binary_mask(binary_mask: np.ndarray) -> List[int]:
         """ Returns the smallest bounding box containing all pixels marked "1" in the given image mask.
@@ -1,8 +1,16 @@
-# create some synthetic data
-echo "Running the synthetic data pipeline"
-blenderproc run src/synthetic_data_pipeline_st.py
+# stop at the first failing step, so that src/render_scenes.py sees crashed scenes
+set -e
 
-# convert the data from BOP to onePose format
+# all steps read their parameters from $CONFIG_FILE (set per scene by src/render_scenes.py)
+export CONFIG_FILE=${CONFIG_FILE:-config.json}
+
+# create some synthetic data (unless already rendered by a persistent worker of src/render_scenes.py --persistent)
+if [ -z "$SKIP_RENDER" ]; then
+    echo "Running the synthetic data pipeline"
+    blenderproc run src/synthetic_data_pipeline_st.py
+fi
+
+# write the Box.txt of the object (and the ARKit-style Frames.txt / ARposes.txt / intrinsics.txt)
 echo "Running the BOP to onePose data conversion"
 python src/transform_data.py
 
@@ -12,28 +20,41 @@ python src/visualise_data.py
 
 # read params from config.json (`brew install jq` if necessary)
 echo "Creating the animation gif and removing the separate frames"
-DATA_DIR=$(jq -r '.DATA_DIR' config.json)
+DATA_DIR=$(jq -r '.DATA_DIR' $CONFIG_FILE)
 DATA_DIR=output/$DATA_DIR # new default location of output --> output dir
-SCENE=$(jq -r '.SCENE' config.json)
-ANNOTATED_FRAMES="$DATA_DIR/scene_$SCENE-annotate/onepose_data/annotated_frames"
-ONEPOSE_DATA="$DATA_DIR/scene_$SCENE-annotate/onepose_data"
-BOP_DATA="$DATA_DIR/scene_$SCENE-annotate/bop_data/train_pbr/000000"
+SCENE=$(jq -r '.SCENE' $CONFIG_FILE)
+SEQ_DIR="$DATA_DIR/scene_$SCENE-annotate"
+ANNOTATED_FRAMES="$SEQ_DIR/onepose_data/annotated_frames"
+ONEPOSE_DATA="$SEQ_DIR/onepose_data"
+BOP_DATA="$SEQ_DIR/bop_data/train_pbr" # all chunks
+CPU_THREADS=$(jq -r '.CPU_THREADS // 0' $CONFIG_FILE) # CPU budget of the scene, 0: parse_bop_data.py default
 
 # create the animation gif
 # convert -delay 2 -loop 0 "$ANNOTATED_FRAMES/*.png" "$ONEPOSE_DATA/synthetic_data_annotated.gif"
 ffmpeg -framerate 30 -i $ANNOTATED_FRAMES/%06d.png -c:v libx264 -pix_fmt yuv420p $ONEPOSE_DATA/synthetic_data_annotated.mp4
-ffmpeg -framerate 30 -i $BOP_DATA/rgb/%06d.png -c:v libx264 -pix_fmt yuv420p $ONEPOSE_DATA/Frames.m4v
 
 # remove the separate frames again
 rm -rf $ANNOTATED_FRAMES
 
-# remove the BOP_DATA dir
-rm -rf $DATA_DIR/scene_$SCENE-annotate/bop_data
-
-# remove the depth frames
-
 # move the content of $ONEPOSE_DATA one level up and remove the now empty $ONEPOSE_DATA dir
-mv $ONEPOSE_DATA/* $DATA_DIR/scene_$SCENE-annotate/
+mv $ONEPOSE_DATA/* $SEQ_DIR/
 rmdir $ONEPOSE_DATA
 
-echo "Done"
\ No newline at end of file
+# crop the rendered frames around the projected 3D box and write the parsed OnePose++ layout
+# (color/, color_full/, intrin_ba/, poses_ba/, ../box3d_corners.txt) directly, no Frames.m4v round trip
+# the intrinsics / poses are only written to frame_index.npz, OnePose++ reads them from there
+N_WORKERS_ARG=""
+if [ "$CPU_THREADS" -gt 0 ]; then
+    N_WORKERS_ARG="--n_workers $CPU_THREADS"
+fi
+python OnePose_Plus_Plus_Spot/parse_bop_data.py \
+    --bop_dir $BOP_DATA \
+    --box_file $SEQ_DIR/Box.txt \
+    --out_dir $SEQ_DIR \
+    --no_txt \
+    $N_WORKERS_ARG
+
+# remove the BOP_DATA dir
+rm -rf $SEQ_DIR/bop_data
+
+echo "Done"
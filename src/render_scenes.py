@@ -0,0 +1,296 @@
+"""Render many synthetic scenes in parallel.
+
+Each scene of the manifest gets its own config file (config.json updated with the scene entry) and runs the
+whole run.sh pipeline (render, conversion, visualisation) in its own process, so the scenes no longer share
+(and mutate) config.json and N of them can render at the same time. Every worker gets its share of the CPU
+threads. Crashed scenes are cleaned and retried, finished scenes are recorded in a ledger, so an interrupted
+run resumes where it stopped.
+
+With --persistent, the rendering is done by long-lived Blender workers (RENDER_QUEUE mode of
+src/synthetic_data_pipeline_st.py): each of them starts Blender and loads the robot once, then takes scene jobs from
+a queue directory. run.sh only runs the conversion / visualisation steps (SKIP_RENDER=1) of the rendered scenes.
+
+Usage:
+    # scenes 00 .. 09 of config.json, seeds 0 .. 9
+    python src/render_scenes.py --n_scenes 10 --n_workers 4
+
+    # manifest: JSON list (or JSON lines) of scene entries overriding config.json, e.g.
+    # [{"SCENE": "00", "SEED": 0, "N_FRAMES": 100, "N_Z_LVLS": 2, "RND_CAM": 1, "MODEL": "nerf"}, ...]
+    python src/render_scenes.py --manifest scenes.json --n_workers 4 --cpu_threads 8
+
+    # render with persistent Blender workers, for many short scenes
+    python src/render_scenes.py --n_scenes 100 --n_workers 4 --persistent
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+
+BASE_CONFIG = Path("config.json")
+
+
+def load_manifest(manifest_path: Path) -> list:
+    text = Path(manifest_path).read_text().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def default_manifest(n_scenes: int) -> list:
+    return [{"SCENE": f"{i:02d}", "SEED": i} for i in range(n_scenes)]
+
+
+def scene_dir(config: dict) -> Path:
+    return Path("output") / config.get("DATA_DIR", "data") / f"scene_{config['SCENE']}-annotate"
+
+
+class Ledger:
+    """Append-only JSON lines record of scene attempts, a scene is complete once it has a 'done' entry"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def scene_statuses(self) -> dict:
+        """{scene: set of recorded statuses}"""
+        statuses = {}
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    statuses.setdefault(entry["scene"], set()).add(entry["status"])
+        return statuses
+
+    def record(self, **entry):
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), **entry}) + "\n")
+
+
+class WorkerPool:
+    """Persistent Blender workers rendering the scene jobs of a queue directory, crashed workers are restarted
+
+    Queue protocol (see run_worker in src/synthetic_data_pipeline_st.py):
+        <name>.json: scene config, claimed by a worker by renaming it to <name>.running.<worker id>
+                     <name> is scene_<SCENE>.<job id>, unique per attempt, so that the files of a failed attempt
+                     (e.g. the .failed written by _monitor once its worker exited) never match the retry
+        <name>.done / <name>.failed: written by the worker when the scene is rendered / crashed (a crashed worker
+                                     exits and leaves its .running file to the pool)
+        STOP: workers exit once the queue is empty
+    A worker rendering one scene for longer than render_timeout seconds is killed, the scene then fails and is retried.
+    """
+
+    def __init__(self, queue_dir: Path, n_workers: int, log_dir: Path, max_jobs: int, render_timeout: float = 0):
+        self.queue_dir = Path(queue_dir)
+        # jobs of an interrupted run are re-enqueued by their scenes
+        shutil.rmtree(self.queue_dir, ignore_errors=True)
+        self.queue_dir.mkdir(parents=True)
+        self.log_dir = log_dir
+        self.max_jobs = max_jobs
+        self.render_timeout = render_timeout
+        self.job_ids = itertools.count()
+        self.startup_failures = 0
+        self.broken = False
+        self.stopping = False
+        self.procs = [self._start(worker_id) for worker_id in range(n_workers)]
+        self.monitor = threading.Thread(target=self._monitor, daemon=True)
+        self.monitor.start()
+
+    def _start(self, worker_id: int) -> subprocess.Popen:
+        env = {**os.environ, "RENDER_QUEUE": str(self.queue_dir), "WORKER_ID": str(worker_id),
+               "MAX_JOBS": str(self.max_jobs)}
+        with open(self.log_dir / f"worker_{worker_id}.log", "a") as log:
+            # own process group, to kill blender together with the blenderproc cli
+            return subprocess.Popen(["blenderproc", "run", "src/synthetic_data_pipeline_st.py"], env=env,
+                                    stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def _kill(self, worker_id: int):
+        """Stop a (hanging) worker, _monitor then fails its job and starts a new one"""
+        proc = self.procs[worker_id]
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                proc.wait(timeout=10)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+    def _monitor(self):
+        while not self.stopping and not self.broken:
+            for worker_id, proc in enumerate(self.procs):
+                returncode = proc.poll()
+                if returncode is None:
+                    continue
+                # A worker which died while rendering (e.g. segfault) could not report its job
+                running_files = list(self.queue_dir.glob(f"*.running.{worker_id}"))
+                for running_file in running_files:
+                    failed_file = self.queue_dir / (running_file.name.split(".running.")[0] + ".failed")
+                    if not failed_file.exists():
+                        failed_file.write_text(f"worker {worker_id} exited with code {returncode}")
+                    running_file.unlink()
+                if returncode != 0 and not running_files:
+                    self.startup_failures += 1
+                if self.startup_failures > 3 * len(self.procs):
+                    print(f"Workers keep failing without rendering, see {self.log_dir}/worker_*.log")
+                    self.broken = True
+                    break
+                if self.stopping:
+                    break
+                # Crashed or recycled after max_jobs scenes
+                self.procs[worker_id] = self._start(worker_id)
+            time.sleep(1)
+
+    def render(self, config: dict) -> bool:
+        """Enqueue the scene and wait until a worker rendered it"""
+        name = f"scene_{config['SCENE']}.{next(self.job_ids)}"
+        tmp_file = self.queue_dir / f"{name}.json.tmp"
+        tmp_file.write_text(json.dumps(config, indent=2))
+        os.replace(tmp_file, self.queue_dir / f"{name}.json")
+
+        claimed = None  # (worker id, time) once a worker took the job, the timeout does not count the queueing
+        while not (self.queue_dir / f"{name}.done").exists():
+            if (self.queue_dir / f"{name}.failed").exists():
+                return False
+            if self.broken:
+                raise RuntimeError(f"Persistent workers are broken, see {self.log_dir}/worker_*.log")
+            if claimed is None:
+                running_files = list(self.queue_dir.glob(f"{name}.running.*"))
+                if running_files:
+                    claimed = (int(running_files[0].name.rsplit(".", 1)[1]), time.time())
+            elif self.render_timeout > 0 and time.time() - claimed[1] > self.render_timeout:
+                if (self.queue_dir / f"{name}.running.{claimed[0]}").exists():
+                    print(f"[{name}] not rendered after {self.render_timeout}s, killing worker {claimed[0]}")
+                    self._kill(claimed[0])
+                claimed = (claimed[0], float("inf"))  # wait for the .failed of _monitor
+            time.sleep(0.5)
+        # the workers can render, only count consecutive failures to start
+        self.startup_failures = 0
+        return True
+
+    def close(self):
+        (self.queue_dir / "STOP").touch()
+        self.stopping = True
+        self.monitor.join()
+        for proc in self.procs:
+            proc.wait()
+
+
+def render_scene(config: dict, config_dir: Path, log_dir: Path, ledger: Ledger, max_retries: int,
+                 workers: WorkerPool = None) -> bool:
+    """Run run.sh for one scene, retry (from a clean scene directory) up to max_retries times"""
+    scene = str(scene_dir(config))
+    config_file = config_dir / f"scene_{config['SCENE']}.json"
+    config_file.write_text(json.dumps(config, indent=2))
+    env = {**os.environ, "CONFIG_FILE": str(config_file)}
+    if workers is not None:
+        env["SKIP_RENDER"] = "1"  # rendered by a persistent worker
+
+    for attempt in range(1, max_retries + 2):
+        # Partial output of a crashed or interrupted run, the BOP writer would append to it
+        if scene_dir(config).exists():
+            print(f"[{scene}] removing partial output")
+            shutil.rmtree(scene_dir(config))
+
+        ledger.record(scene=scene, status="started", attempt=attempt)
+        start = time.time()
+        with open(log_dir / f"scene_{config['SCENE']}.log", "a") as log:
+            log.write(f"\n===== attempt {attempt} =====\n")
+            log.flush()
+            returncode = 0
+            if workers is not None and not workers.render(config):
+                log.write(f"rendering failed, see {workers.queue_dir}/scene_{config['SCENE']}.*.failed\n")
+                returncode = 1
+            if returncode == 0:
+                returncode = subprocess.call(["bash", "run.sh"], env=env, stdout=log, stderr=subprocess.STDOUT)
+        seconds = round(time.time() - start, 1)
+
+        status = "done" if returncode == 0 else "failed"
+        ledger.record(scene=scene, status=status, attempt=attempt, returncode=returncode, seconds=seconds)
+        print(f"[{scene}] attempt {attempt} {status} after {seconds}s")
+        if returncode == 0:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifest", type=Path, default=None, help="JSON / JSON lines list of scene entries")
+    parser.add_argument("--n_scenes", type=int, default=None, help="without manifest: scenes 00 .. n_scenes-1")
+    parser.add_argument("--n_workers", type=int, default=2, help="scenes rendered concurrently")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="render threads per worker, default: cores / n_workers")
+    parser.add_argument("--max_retries", type=int, default=2)
+    parser.add_argument("--ledger", type=Path, default=None, help="default: output/<DATA_DIR>/render_ledger.jsonl")
+    parser.add_argument("--persistent", action="store_true", help="render with long-lived Blender workers")
+    parser.add_argument("--max_jobs_per_worker", type=int, default=50, help="with --persistent: restart a worker "
+                        "after this many scenes (bounds blender memory growth), 0: never")
+    parser.add_argument("--render_timeout", type=float, default=3600, help="with --persistent: kill a worker "
+                        "rendering one scene for longer than this many seconds (the scene is retried), 0: never")
+    args = parser.parse_args()
+    assert (args.manifest is None) != (args.n_scenes is None), "Give either --manifest or --n_scenes"
+
+    base_config: dict = json.loads(BASE_CONFIG.read_text())
+    base_config["DBG"] = 0  # a worker must not wait for a debugger
+    manifest = load_manifest(args.manifest) if args.manifest else default_manifest(args.n_scenes)
+    cpu_threads = args.cpu_threads or max(1, (os.cpu_count() or 1) // args.n_workers)
+    configs = [{**base_config, "CPU_THREADS": cpu_threads, **entry} for entry in manifest]
+
+    data_dir = Path("output") / base_config.get("DATA_DIR", "data")
+    config_dir = data_dir / "configs"
+    log_dir = data_dir / "logs"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    ledger = Ledger(args.ledger or data_dir / "render_ledger.jsonl")
+    statuses = ledger.scene_statuses()
+    todo = []
+    for config in configs:
+        scene = str(scene_dir(config))
+        if "done" in statuses.get(scene, set()):
+            continue
+        if scene not in statuses and scene_dir(config).exists():
+            # Not rendered by this orchestrator (e.g. by the old autorun.sh), never delete it
+            print(f"[{scene}] exists without ledger entry, skipped (remove it to render it again)")
+            continue
+        todo.append(config)
+    print(f"{len(configs) - len(todo)} scenes done or skipped, rendering {len(todo)} with {args.n_workers} workers "
+          f"x {cpu_threads} threads")
+
+    workers = None
+    if args.persistent and todo:
+        workers = WorkerPool(data_dir / "render_queue", args.n_workers, log_dir, args.max_jobs_per_worker,
+                             args.render_timeout)
+
+    failed = []
+    try:
+        # with persistent workers, convert the rendered scenes while the workers render the next ones
+        with ThreadPoolExecutor(max_workers=args.n_workers * (2 if workers else 1)) as executor:
+            futures = {
+                executor.submit(render_scene, config, config_dir, log_dir, ledger, args.max_retries, workers): config
+                for config in todo
+            }
+            for future in as_completed(futures):
+                if not future.result():
+                    failed.append(str(scene_dir(futures[future])))
+    finally:
+        if workers is not None:
+            workers.close()
+
+    if failed:
+        print(f"{len(failed)} scenes failed after {args.max_retries} retries, see {log_dir}: {failed}")
+        raise SystemExit(1)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import os
+import json
+from pathlib import Path
+
+
+# per-scene config file written by src/render_scenes.py (exported as $CONFIG_FILE by run.sh), config.json otherwise
+CONFIG = Path(os.environ.get("CONFIG_FILE", "config.json"))
+
+
+def load_config():
+    with open(CONFIG) as f:
+        return json.load(f)
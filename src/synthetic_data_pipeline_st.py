@@ -2,184 +2,327 @@ import blenderproc as bproc
 from blenderproc.python.loader.HavenEnvironmentLoader import (
     get_random_world_background_hdr_img_path_from_haven,
 )
+from blenderproc.python.utility.DefaultConfig import DefaultConfig
 
+import bpy
 import numpy as np
 import mathutils
 import os
+import time
+import traceback
 from pathlib import Path
 import json
 import random
 import loguru
 
+# the repo root is on the PYTHONPATH of `blenderproc run`
+from src.scene_config import CONFIG
+
+
 ######################## GLOBALS ########################
-CONFIG = Path("config.json")
-configs = json.load(open(CONFIG))
-SCENE = configs.get("SCENE", 1)
-DBG = bool(configs.get("DBG", 0))
-COCO = bool(configs.get("COCO", 0))
-RND_CAM = bool(configs.get("RND_CAM", 0))
-N_FRAMES = int(configs.get("N_FRAMES", 1))
-# how many different heights should be sampled
-# for each z-level, N_FRAMES are generated
-N_Z_LVLS = configs.get("N_Z_LVLS", 1)
-DATA_DIR: Path = Path("output") / Path(configs.get("DATA_DIR", "data"))
-OUTPUT_DIR: Path = DATA_DIR / f"scene_{SCENE}-annotate"
-MODEL: str = configs.get("MODEL", "nerf")
-assert MODEL in [
-    "nerf",
-    "urdf",
-    "poly",
-], "MODEL must be either 'nerf' or 'urdf' or 'poly'"
+# persistent worker mode (src/render_scenes.py --persistent): Blender and the robot are loaded once, then the
+# scene configs of this queue directory are rendered one after the other
+RENDER_QUEUE = os.environ.get("RENDER_QUEUE", None)
+WORKER_ID = os.environ.get("WORKER_ID", str(os.getpid()))
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 0))  # exit after MAX_JOBS scenes, 0: never
+HAVEN_DIR = "resources/haven/"
+MODELS = ["nerf", "urdf", "poly"]
 #########################################################
 
 
-if DBG:
-    import debugpy
-    import warnings
+def read_config(config_file):
+    configs = json.load(open(config_file))
+    scene = configs.get("SCENE", 1)
+    config = {
+        "SCENE": scene,
+        "DBG": bool(configs.get("DBG", 0)),
+        "COCO": bool(configs.get("COCO", 0)),
+        "RND_CAM": bool(configs.get("RND_CAM", 0)),
+        "N_FRAMES": int(configs.get("N_FRAMES", 1)),
+        # how many different heights should be sampled
+        # for each z-level, N_FRAMES are generated
+        "N_Z_LVLS": configs.get("N_Z_LVLS", 1),
+        "OUTPUT_DIR": Path("output") / Path(configs.get("DATA_DIR", "data")) / f"scene_{scene}-annotate",
+        "MODEL": configs.get("MODEL", "nerf"),
+        "SEED": configs.get("SEED", None),  # fixed seed for reproducible scenes
+        "CPU_THREADS": int(configs.get("CPU_THREADS", 0)),  # render threads, 0: all cores
+        # frames rendered and written at once (bounds the memory of long sequences), 0: all frames
+        "RENDER_CHUNK": int(configs.get("RENDER_CHUNK", 0)),
+    }
+    assert config["MODEL"] in MODELS, "MODEL must be either 'nerf' or 'urdf' or 'poly'"
+    return config
 
-    warnings.warn("Waiting for debugger Attach...", UserWarning)
-    debugpy.listen(5678)
-    debugpy.wait_for_client()
 
-# init bproc & set scene
-bproc.init()
-bproc.world.set_world_background_hdr_img(
-    get_random_world_background_hdr_img_path_from_haven("resources/haven/")
-)
+def load_robot(model):
+    if model == "nerf":
+        robot = bproc.loader.load_obj(filepath="spot/nerf/nerf_spot.dae")
+        robot = robot[0]
+        # Set pose of object via local-to-world transformation matrix
+        robot.set_local2world_mat(
+            [
+                [1, 0, 0, 0],
+                [0, 1, 0, 0],
+                [0, 0, 1, 0],
+                [0, 0, 0, 1],
+            ]
+        )
+        # Set category id which will be used in the BopWriter
+        robot.set_cp("category_id", 1)
 
-# load robot & set pose
-if MODEL == "nerf":
-    robot = bproc.loader.load_obj(filepath="spot/nerf/nerf_spot.dae")
-    robot = robot[0]
-    # Set pose of object via local-to-world transformation matrix
-    robot.set_local2world_mat(
-        [
-            [1, 0, 0, 0],
-            [0, 1, 0, 0],
-            [0, 0, 1, 0],
-            [0, 0, 0, 1],
-        ]
-    )
-    # Set category id which will be used in the BopWriter
-    robot.set_cp("category_id", 1)
-
-elif MODEL == "poly":
-    robot = bproc.loader.load_obj(filepath="spot/blender/poly_01.dae")
-    robot = robot[0]
-    robot.set_cp("category_id", 1)
-
-elif MODEL == "urdf":
-    # NOTE: the urdf contains spot's body twice, because the base link, i.e. the one w/o parent, has to be removed.
-    #       now it's the first child of the base link and everything works properly
-    robot = bproc.loader.load_urdf(urdf_file="spot/spot_basic.urdf")
-    robot.remove_link_by_index(index=0)
-    robot.set_ascending_category_ids()
-
-poi = np.array([0, 0, 0])
-
-if RND_CAM:
-    # Add translational random walk on top of the POI
-    poi_drift = bproc.sampler.random_walk(
-        total_length=N_FRAMES,
-        dims=3,
-        step_magnitude=0.0005,
-        window_size=10,
-        interval=[-0.003, 0.003],
-        distribution="uniform",
-    )
+    elif model == "poly":
+        robot = bproc.loader.load_obj(filepath="spot/blender/poly_01.dae")
+        robot = robot[0]
+        robot.set_cp("category_id", 1)
 
-    # Rotational camera shaking as a random walk: Sample an axis angle representation
-    camera_shaking_rot_angle = bproc.sampler.random_walk(
-        total_length=N_FRAMES,
-        dims=1,
-        step_magnitude=np.pi / 64,
-        window_size=10,
-        interval=[-np.pi / 12, np.pi / 12],
-        distribution="uniform",
-        order=2,
-    )
+    elif model == "urdf":
+        # NOTE: the urdf contains spot's body twice, because the base link, i.e. the one w/o parent, has to be removed.
+        #       now it's the first child of the base link and everything works properly
+        robot = bproc.loader.load_urdf(urdf_file="spot/spot_basic.urdf")
+        robot.remove_link_by_index(index=0)
+        robot.set_ascending_category_ids()
 
-    camera_shaking_rot_axis = bproc.sampler.random_walk(
-        total_length=N_FRAMES, dims=3, window_size=10, distribution="normal"
-    )
+    return robot
 
-    camera_shaking_rot_axis /= np.linalg.norm(
-        camera_shaking_rot_axis, axis=1, keepdims=True
-    )
-x_offset = 1.0
-y_offset = 1.0
-# random initial position of camera
-if RND_CAM:
-    x_offset = random.uniform(0.5, 4.0)
-    y_offset = random.uniform(0.5, 4.0)
-
-
-for z in np.linspace(0.5, 1.5, N_Z_LVLS):
-    for i in range(N_FRAMES):
-        x = x_offset * np.sin(i / (1 * N_FRAMES) * 2 * np.pi)
-        y = y_offset * np.cos(i / (1 * N_FRAMES) * 2 * np.pi)
-        z = z
-
-        location_cam = np.array([x, y, z])
-        rotation_matrix = bproc.camera.rotation_from_forward_vec(poi - location_cam)
-
-        if RND_CAM:
-            # Compute rotation based on vector going from location towards poi + drift
-            rotation_matrix = bproc.camera.rotation_from_forward_vec(
-                poi + poi_drift[i] - location_cam
-            )
 
-            # random walk axis-angle -> rotation matrix
-            R_rand = np.array(
-                mathutils.Matrix.Rotation(
-                    camera_shaking_rot_angle[i], 3, camera_shaking_rot_axis[i]
+def add_camera_poses(config):
+    N_FRAMES, N_Z_LVLS, RND_CAM = config["N_FRAMES"], config["N_Z_LVLS"], config["RND_CAM"]
+    poi = np.array([0, 0, 0])
+
+    if RND_CAM:
+        # Add translational random walk on top of the POI
+        poi_drift = bproc.sampler.random_walk(
+            total_length=N_FRAMES,
+            dims=3,
+            step_magnitude=0.0005,
+            window_size=10,
+            interval=[-0.003, 0.003],
+            distribution="uniform",
+        )
+
+        # Rotational camera shaking as a random walk: Sample an axis angle representation
+        camera_shaking_rot_angle = bproc.sampler.random_walk(
+            total_length=N_FRAMES,
+            dims=1,
+            step_magnitude=np.pi / 64,
+            window_size=10,
+            interval=[-np.pi / 12, np.pi / 12],
+            distribution="uniform",
+            order=2,
+        )
+
+        camera_shaking_rot_axis = bproc.sampler.random_walk(
+            total_length=N_FRAMES, dims=3, window_size=10, distribution="normal"
+        )
+
+        camera_shaking_rot_axis /= np.linalg.norm(
+            camera_shaking_rot_axis, axis=1, keepdims=True
+        )
+    x_offset = 1.0
+    y_offset = 1.0
+    # random initial position of camera
+    if RND_CAM:
+        x_offset = random.uniform(0.5, 4.0)
+        y_offset = random.uniform(0.5, 4.0)
+
+    for z in np.linspace(0.5, 1.5, N_Z_LVLS):
+        for i in range(N_FRAMES):
+            x = x_offset * np.sin(i / (1 * N_FRAMES) * 2 * np.pi)
+            y = y_offset * np.cos(i / (1 * N_FRAMES) * 2 * np.pi)
+            z = z
+
+            location_cam = np.array([x, y, z])
+            rotation_matrix = bproc.camera.rotation_from_forward_vec(poi - location_cam)
+
+            if RND_CAM:
+                # Compute rotation based on vector going from location towards poi + drift
+                rotation_matrix = bproc.camera.rotation_from_forward_vec(
+                    poi + poi_drift[i] - location_cam
+                )
+
+                # random walk axis-angle -> rotation matrix
+                R_rand = np.array(
+                    mathutils.Matrix.Rotation(
+                        camera_shaking_rot_angle[i], 3, camera_shaking_rot_axis[i]
+                    )
                 )
+
+                # Add the random walk to the camera rotation
+                rotation_matrix = R_rand @ rotation_matrix
+
+            cam2world_matrix = bproc.math.build_transformation_mat(
+                location_cam, rotation_matrix
             )
 
-            # Add the random walk to the camera rotation
-            rotation_matrix = R_rand @ rotation_matrix
+            bproc.camera.add_camera_pose(cam2world_matrix)
 
-        cam2world_matrix = bproc.math.build_transformation_mat(
-            location_cam, rotation_matrix
+
+def enable_outputs():
+    """ Once per process, the output nodes stay in the (kept) scene across clean_up """
+    bproc.renderer.set_max_amount_of_samples(30)
+    bproc.renderer.enable_depth_output(True)
+    bproc.renderer.enable_segmentation_output(map_by=["category_id", "instance", "name"])
+
+
+def set_up_scene(config):
+    """ Seed, render threads and background of the scene, before anything else random is sampled """
+    if config["SEED"] is not None:
+        random.seed(config["SEED"])
+        np.random.seed(config["SEED"])
+    if config["CPU_THREADS"] > 0:
+        bproc.renderer.set_cpu_threads(config["CPU_THREADS"])
+    bproc.world.set_world_background_hdr_img(
+        get_random_world_background_hdr_img_path_from_haven(HAVEN_DIR)
+    )
+
+
+def write_outputs(config, robot, data, coco_annotations=None, last_chunk=True):
+    """
+    Write (append) the rendered frames from frame_start to frame_end.
+    The COCO annotations of the previous chunks are kept in memory (returned), and only written with the last chunk.
+    """
+    OUTPUT_DIR, MODEL = config["OUTPUT_DIR"], config["MODEL"]
+    if config["COCO"]:
+        loguru.logger.info("Writing COCO annotations...")
+        coco_annotations = bproc.writer.write_coco_annotations(
+            os.path.join(OUTPUT_DIR, "coco_data"),
+            instance_segmaps=data["instance_segmaps"],
+            instance_attribute_maps=data["instance_attribute_maps"],
+            colors=data["colors"],
+            color_file_format="JPEG",
+            existing_coco_annotations=coco_annotations,
+            write_annotations_file=last_chunk,
         )
 
-        bproc.camera.add_camera_pose(cam2world_matrix)
+    if MODEL in ["nerf", "poly"]:
+        bproc.writer.write_bop(
+            os.path.join(OUTPUT_DIR, "bop_data"),
+            target_objects=[robot],
+            depths=data["depth"],
+            colors=data["colors"],
+            m2mm=False,
+            calc_mask_info_coco=False,
+        )
 
-# render results & save to disk
-bproc.renderer.set_max_amount_of_samples(30)
-bproc.renderer.enable_depth_output(True)
-bproc.renderer.enable_segmentation_output(map_by=["category_id", "instance", "name"])
+    elif MODEL == "urdf":
+        bproc.writer.write_bop(
+            os.path.join(OUTPUT_DIR, "bop_data"),
+            target_objects=robot.links,
+            depths=data["depth"],
+            colors=data["colors"],
+            m2mm=False,
+            calc_mask_info_coco=False,
+        )
+    return coco_annotations
 
-data = bproc.renderer.render()
-# bproc.writer.write_gif_animation(OUTPUT_DIR, data)
 
-if COCO:
-    loguru.logger.info("Writing COCO annotations...")
-    bproc.writer.write_coco_annotations(
-        os.path.join(OUTPUT_DIR, "coco_data"),
-        instance_segmaps=data["instance_segmaps"],
-        instance_attribute_maps=data["instance_attribute_maps"],
-        colors=data["colors"],
-        color_file_format="JPEG",
-    )
+def render_scene(config, robot):
+    add_camera_poses(config)
 
-if MODEL in ["nerf", "poly"]:
-    bproc.writer.write_bop(
-        os.path.join(OUTPUT_DIR, "bop_data"),
-        target_objects=[robot],
-        depths=data["depth"],
-        colors=data["colors"],
-        m2mm=False,
-        calc_mask_info_coco=False,
-    )
+    # render results & save to disk, RENDER_CHUNK frames at a time
+    frame_end = bpy.context.scene.frame_end
+    n_frames = frame_end - bpy.context.scene.frame_start
+    coco_annotations = None
+    for data in bproc.renderer.render_chunks(config["RENDER_CHUNK"] or max(n_frames, 1)):
+        # bproc.writer.write_gif_animation(OUTPUT_DIR, data)
+        last_chunk = bpy.context.scene.frame_end == frame_end
+        coco_annotations = write_outputs(config, robot, data, coco_annotations, last_chunk)
+        del data  # free the chunk before the next one is rendered
 
 
-elif MODEL == "urdf":
-    bproc.writer.write_bop(
-        os.path.join(OUTPUT_DIR, "bop_data"),
-        target_objects=robot.links,
-        depths=data["depth"],
-        colors=data["colors"],
-        m2mm=False,
-        calc_mask_info_coco=False,
-    )
+def claim_job(queue_dir):
+    """ Atomically take the next <job>.json of the queue, returns (job name, claimed file) or None """
+    for job_file in sorted(queue_dir.glob("*.json")):
+        running_file = queue_dir / f"{job_file.stem}.running.{WORKER_ID}"
+        try:
+            os.rename(job_file, running_file)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        return job_file.stem, running_file
+    return None
+
+
+def finish_job(queue_dir, name, running_file, status, content):
+    """ Write <job>.done / <job>.failed, which render_scenes.py waits for """
+    tmp_file = queue_dir / f"{name}.{status}.{WORKER_ID}.tmp"
+    tmp_file.write_text(content)
+    os.replace(tmp_file, queue_dir / f"{name}.{status}")
+    if status == "done":
+        # a failed job keeps it, the worker exits and render_scenes.py cleans it up
+        running_file.unlink()
+
+
+def run_worker(queue_dir):
+    """
+    Render the jobs (scene configs) of queue_dir until it contains a STOP file and no more jobs.
+    Between jobs the scene is reset with clean_up, only the robot (and its meshes, materials and textures) is kept.
+    """
+    queue_dir = Path(queue_dir)
+    model, robot, robot_objects = None, None, []
+    n_jobs = 0
+    while MAX_JOBS == 0 or n_jobs < MAX_JOBS:
+        job = claim_job(queue_dir)
+        if job is None:
+            if (queue_dir / "STOP").exists():
+                break
+            time.sleep(0.5)
+            continue
+
+        name, running_file = job
+        start = time.time()
+        try:
+            config = read_config(running_file)
+            loguru.logger.info(f"Worker {WORKER_ID}: rendering {name} to {config['OUTPUT_DIR']}")
+            if config["MODEL"] != model:
+                bproc.clean_up(clean_up_camera=True)
+                robot = load_robot(config["MODEL"])
+                model = config["MODEL"]
+                robot_objects = [obj for obj in bpy.context.scene.objects if obj.type != "CAMERA"]
+                if n_jobs == 0:
+                    enable_outputs()
+                else:
+                    # pass index of enable_segmentation_output for the newly loaded objects
+                    for index, obj in enumerate(bproc.object.get_all_mesh_objects()):
+                        obj.blender_obj.pass_index = index + 1
+            else:
+                # new camera (poses, keyframes) and world, keep the robot
+                bproc.clean_up(clean_up_camera=True, keep_objects=robot_objects)
+            # the new camera has blender's defaults, restore the ones of bproc.init
+            bproc.camera.set_intrinsics_from_blender_params(
+                DefaultConfig.fov, DefaultConfig.resolution_x, DefaultConfig.resolution_y,
+                DefaultConfig.clip_start, DefaultConfig.clip_end, DefaultConfig.pixel_aspect_x,
+                DefaultConfig.pixel_aspect_y, DefaultConfig.shift_x, DefaultConfig.shift_y, DefaultConfig.lens_unit
+            )
+
+            set_up_scene(config)
+            render_scene(config, robot)
+        except Exception:
+            finish_job(queue_dir, name, running_file, "failed", traceback.format_exc())
+            # the blender state is unknown now, let render_scenes.py start a fresh worker
+            raise
+        finish_job(queue_dir, name, running_file, "done", json.dumps({"seconds": round(time.time() - start, 1)}))
+        n_jobs += 1
+
+
+if RENDER_QUEUE:
+    bproc.init()
+    run_worker(RENDER_QUEUE)
+
+else:
+    configs = read_config(CONFIG)
+    if configs["DBG"]:
+        import debugpy
+        import warnings
+
+        warnings.warn("Waiting for debugger Attach...", UserWarning)
+        debugpy.listen(5678)
+        debugpy.wait_for_client()
+
+    # init bproc & set scene
+    bproc.init()
+    set_up_scene(configs)
+
+    # load robot & set pose
+    robot = load_robot(configs["MODEL"])
+
+    enable_outputs()
+    render_scene(configs, robot)
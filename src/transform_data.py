@@ -3,15 +3,15 @@ import numpy as np
 from scipy.spatial.transform import Rotation as R
 import json
 
+from scene_config import load_config
+
 
 # more information about the BOP format can be found here:
 # https://github.com/thodan/bop_toolkit/blob/master/docs/bop_datasets_format.md
 
-
 ######################## GLOBALS ########################
 global SCENE, DBG, N_FRAMES, INPUT_DIR, ONEPOSE_DATA
-CONFIG = Path("config.json")
-configs = json.load(open(CONFIG))
+configs = load_config()
 SCENE = configs.get("SCENE", 1)
 DBG = bool(configs.get("DBG", 0))
 N_FRAMES = configs.get("N_FRAMES", 1)
@@ -4,11 +4,12 @@ from transforms3d import affines
 from pathlib import Path
 import json
 
+from scene_config import load_config
+
 
 ######################## GLOBALS ########################
 global MODEL, SCENE, DBG, N_FRAMES, INPUT_DIR, ONEPOSE_DATA
-CONFIG = Path("config.json")
-configs = json.load(open(CONFIG))
+configs = load_config()
 SCENE = configs.get("SCENE", 1)
 DBG = bool(configs.get("DBG", 0))
 N_FRAMES = configs.get("N_FRAMES", 1)